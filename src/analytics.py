@@ -4,13 +4,14 @@ import operator
 import string
 import re
 import db
+import planner
+import sketch
 import os
-from nltk.util import ngrams
+from util import ngrams
 
-up_dir = os.path.dirname(os.path.dirname(__file__))
+up_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 stop_words_file = up_dir + '/stopwords.txt'
-stop_words = set(line.strip() for line in open(stop_words_file))
-stop_words.add('')
+_stop_words = None
 
 punc = string.punctuation
 # Not sure what codec these two characters are from
@@ -28,20 +29,41 @@ CHANNEL_EXPR = re.compile('(?<=<#)(.*?)(?=>)')
 USER_EXPR = re.compile('(?<=<@)(.*?)(?=>)')
 
 
-def get_top(f):
-    def wrapper(*args, **kwargs):
-        counter = f(*args, **kwargs)
-        return dict(counter.most_common(kwargs['count']))
-    return wrapper
+def get_stop_words():
+    '''
+    Loads the stop word list on first use so importing this module
+    doesn't touch the filesystem
+    '''
+    global _stop_words
+    if _stop_words is None:
+        with open(stop_words_file) as f:
+            words = set(line.strip() for line in f)
+        words.add('')
+        _stop_words = words
+    return _stop_words
 
 
-@get_top
-def favorite_reacts_of_user(user, count=5):
-    return db.get_reacts_by_user(user)
+def favorite_reacts_of_user(team_id, user, count=5, offset=0):
+    return db.get_reacts_by_user(team_id, user, count, offset)
 
 
-def favorite_reacts_of_users(users, count=5):
-    return {user: favorite_reacts_of_user(user, count) for user in users}
+def favorite_reacts_of_users(team_id, users=None, count=5, user_count=10, user_offset=0):
+    '''
+    Args:
+        team_id     (str)  : Slack team ID
+        users       (list) : Slack user IDs, or None for a page of the team's
+                             most active reacters
+        count       (int)  : Reacts per user
+        user_count  (int)  : Users per page when users is None
+        user_offset (int)  : Users to skip when users is None
+
+    Returns:
+        dict: user ID -> {react name: count}, in page order
+    '''
+    if users is None:
+        users = list(db.get_react_usage_totals(team_id, user_count, user_offset))
+    reacts = db.get_top_reacts_by_users(team_id, users, count)
+    return {user: reacts.get(user, {}) for user in users}
 
 
 def get_top_by_value(data, count=5, sort_key=operator.itemgetter(1)):
@@ -65,70 +87,129 @@ def translate(token, users, channels):
 		str: translated word
 	'''
     find = CHANNEL_EXPR.search(token)
-    if channel:
+    if find:
         channel_id = find.group(0)
         return channels.get(channel_id, token)
 
     find = USER_EXPR.search(token)
-    if search:
+    if find:
         user_id = find.group(0)
         return users.get(user_id, token)
 
     return token
 
 
-def get_unique_words(msgs, users, channels):
-    ''' 
-Args: 
-msgs     (list) : list of message IDs 
-users    (list) : list of "escaped" Slack users
-    channels (list) : list of "escaped" Slack channels
-
-Returns: 
-Counter: All unique words used in the given messages
-'''
+def message_words(text):
+    ''' Returns the set of non stop words in a message, lowercased and stripped of punctuation '''
+    translator = str.maketrans('', '', punc)
+    stop_words = get_stop_words()
+    return {w.translate(translator) for w in text.lower().split(' ') if w not in stop_words}
+
+
+def message_phrases(text):
+    ''' Returns the three word phrases in a message that count towards common phrases '''
+    if any(omit in text for omit in omit_phrases):
+        return []
+    return [phrase for phrase in ngrams(text.split(' '), 3)
+            if all(word not in punc for word in phrase)]
+
+
+def text_counts(text):
+    '''
+    Returns:
+        tuple: (Counter of the message's unique words, Counter of its phrases
+                joined by spaces) as stored in WordCounts and PhraseCounts
+    '''
+    if not text:
+        return Counter(), Counter()
+    return Counter(message_words(text)), Counter(' '.join(p) for p in message_phrases(text))
+
+
+def count_unique_words(team_id, msgs, shards=None):
+    '''
+    Args:
+        team_id (str)  : Slack team ID
+        msgs    (list) : list of message IDs
+        shards  (int)  : If given, count the messages in this many parallel shards
+
+    Returns:
+        Counter: untranslated words used in the given messages, counted once per message
+    '''
+    if shards:
+        import recompute
+        return recompute.unique_words(team_id, msgs, shards)
 
-    disp_names = {users[user]: users[user]['display_name'] for user in users}
     unique_words = Counter()
-    translator = str.maketrans('', '', punc)
-    msgs = db.get_message_text_from_ids(msgs)
+    msgs = db.get_message_text_from_ids(team_id, msgs)
 
-    for msg_id in msgs:
-        msg_text = msgs[msg_id].lower()
+    # MessageID order, as recompute.unique_words merges its shards
+    for msg_id in sorted(msgs):
+        msg_text = msgs[msg_id]
 
         if not msg_text:
             continue
 
-        tokenized = {w.translate(translator) for w in msg_text.split(
-            ' ') if w.lower() not in stop_words}
-        for token in tokenized:
-            key = translate(token, disp_names, channels)
-            unique_words[key] += 1
+        unique_words.update(message_words(msg_text))
 
     return unique_words
 
 
-@get_top
-def react_buzzword(react_name, users, channels, count=5):
+def translate_words(words, users, channels):
+    '''
+    Returns:
+        Counter: words with escaped users and channels replaced by their names
+    '''
+    disp_names = {user: users[user]['display_name'] for user in users}
+    translated = Counter()
+    for token, count in words.items():
+        translated[translate(token, disp_names, channels)] += count
+    return translated
+
+
+def get_unique_words(team_id, msgs, users, channels, shards=None):
+    ''' 
+Args: 
+team_id  (str)  : Slack team ID
+msgs     (list) : list of message IDs 
+users    (list) : list of "escaped" Slack users
+    channels (list) : list of "escaped" Slack channels
+shards   (int)  : If given, count the messages in this many parallel shards
+
+Returns: 
+Counter: All unique words used in the given messages
+'''
+    return translate_words(count_unique_words(team_id, msgs, shards), users, channels)
+
+
+def react_buzzword(team_id, react_name, users, channels, count=5, shards=None, offset=0, strategy=None):
     ''' 
 	Finds the words most used in messages with the given react
 
 	Args: 
+		team_id    (str)  : Slack team ID
 		react_name (str)  : Slack react name
 		users      (list) : List of "escaped" Slack users
 	    channels   (list) : List of "escaped" Slack channels
 	    count 	   (int)  : Number of results
+	    shards     (int)  : If given, count in this many parallel shards. Only
+	                        for the command line, see planner.py
+	    offset     (int)  : Number of results to skip
+	    strategy   (str)  : Forces a planner path, see planner.py
 
 	Returns: 
-		Counter: The most common words used in messages with the given react
+		dict: The most common words used in messages with the given react
 '''
 
-    msgs = db.get_messages_with_react(react_name, False)
-    return get_unique_words(msgs, users, channels)
+    def scan():
+        msgs = db.get_messages_with_react(team_id, react_name, False)
+        return count_unique_words(team_id, msgs, shards)
+
+    # The planner caches the raw words, so every caller's names are applied to them
+    return planner.execute(team_id, 'react_buzzword', (react_name, ), count, offset, scan,
+                           strategy=strategy, finish=lambda words: translate_words(words, users, channels))
 
 
-@get_top
-def most_reacted_to_posts(count=5):
+def most_reacted_to_posts(team_id, user_id=None, count=5, offset=0):
     ''' 
     Gets the messages with the most total reactions
 
@@ -136,49 +217,182 @@ def most_reacted_to_posts(count=5):
     by that user. Else, the every message is considered.
 
 	Args: 
+        team_id (str) : Slack team ID
         user_id (str) : Slack user ID
         count (list)  : Number of results
+        offset (int)  : Number of results to skip
 
 	Returns: 
-    	Counter: messages with the most reactions
+    	list: (message text, reaction count) for the messages with the most reactions
 	'''
 
     query = '''
 	        SELECT MessageText, SUM(Count) FROM Messages
-	        INNER JOIN MessageReacts ON Messages.MessageID=MessageReacts.MessageID
+	        INNER JOIN MessageReacts ON Messages.TeamID=MessageReacts.TeamID
+	            AND Messages.MessageID=MessageReacts.MessageID
+	        WHERE Messages.TeamID = %s AND (%s IS NULL OR Messages.UserID = %s)
+	        GROUP BY Messages.MessageID, MessageText
+	        ORDER BY SUM(Count) DESC, Messages.MessageID
+	        LIMIT %s OFFSET %s
 	    	'''
 
-    msgs = db.execute(query)
-    msgs = {msg[0] : msg[1] for msg in msgs}
-    return Counter(msgs)
+    msgs = db.execute(query, (team_id, user_id, user_id, count, offset))
+    return [(msg[0], msg[1]) for msg in msgs]
 
 
-@get_top
-def get_common_phrases(count=10):
-    phrase_counter = Counter()
-    texts = db.get_all_message_texts()
-    for msg in texts:
-        if any(omit in msg for omit in omit_phrases):
-            continue
-        words = msg.split(' ')
-        for phrase in ngrams(words, 3):
-            if all(word not in punc for word in phrase):
-                phrase_counter[phrase] += 1
-    return phrase_counter
+def get_common_phrases(team_id, count=10, shards=None, offset=0, strategy=None):
+    '''
+    Returns:
+        dict: phrase tuple -> uses, most common first
+    '''
+    def scan():
+        if shards:
+            import recompute
+            return recompute.recompute(team_id, shards)[1]
+
+        phrase_counter = Counter()
+        for msg in db.iter_message_texts(team_id):
+            if msg:
+                for phrase in message_phrases(msg):
+                    phrase_counter[phrase] += 1
+        return phrase_counter
 
+    def aggregate(count, offset):
+        return {tuple(phrase.split(' ')): uses
+                for phrase, uses in db.get_top_phrases(team_id, count, offset)}
 
-@get_top
-def most_unique_reacts_on_a_post(count=5):
+    return planner.execute(team_id, 'common_phrases', (), count, offset, scan, aggregate, strategy)
+
+
+def most_unique_reacts_on_a_post(team_id, channel_id=None, count=5, offset=0):
+    '''
+    Returns:
+        list: (message text, distinct react count) for the messages with the
+              most distinct reacts
+    '''
     query = '''
 			SELECT MessageText, Count(DISTINCT ReactName) FROM Messages
-			INNER JOIN MessageReacts ON Messages.MessageID=MessageReacts.MessageID
-			GROUP BY MessageID
+			INNER JOIN MessageReacts ON Messages.TeamID=MessageReacts.TeamID
+			    AND Messages.MessageID=MessageReacts.MessageID
+			WHERE Messages.TeamID = %s AND MessageReacts.Count > 0
+			AND (%s IS NULL OR Messages.MessageID LIKE %s || '%%')
+			GROUP BY Messages.MessageID, MessageText
+			ORDER BY Count(DISTINCT ReactName) DESC, Messages.MessageID
+			LIMIT %s OFFSET %s
 			'''
-    msgs = db.execute(query)
-    counts = {msg[0] : msgs[1] for msg in msgs}
-    return Counter(counts)
-
-
-@get_top
-def users_with_most_reacts(count=5):
-    return Counter(db.get_react_usage_totals())
+    msgs = db.execute(query, (team_id, channel_id, channel_id, count, offset))
+    return [(msg[0], msg[1]) for msg in msgs]
+
+
+def react_pairs(team_id, react_name, count=5, offset=0):
+    '''
+    Returns:
+        list: (react, message count) for the reacts most often used on the
+              same messages as react_name
+    '''
+    return db.get_react_pairs(team_id, react_name, count, offset)
+
+
+def users_with_most_reacts(team_id, count=5, offset=0):
+    return db.get_react_usage_totals(team_id, count, offset)
+
+
+def most_active(team_id, count=5, offset=0):
+    return db.get_most_active_users(team_id, count, offset)
+
+
+def build_sketches(team_id):
+    '''
+    Rebuilds a team's sketches by streaming its data from the database and
+    stores them. From then on writers merge in what they ingest, see
+    observe_message and observe_react.
+    '''
+    sketches = sketch.TeamSketches()
+    for text in db.iter_message_texts(team_id):
+        if text:
+            sketches.add_message_phrases(message_phrases(text))
+    for user_id, count in db.get_react_usage_totals(team_id).items():
+        if count > 0:
+            sketches.reactors.add(user_id, int(count))
+    for react_name, count in db.get_react_counts(team_id).items():
+        if count > 0:
+            sketches.react_counts.add(react_name, int(count))
+            sketches.distinct_reacts.add(react_name)
+    for react_name, text in db.iter_react_message_texts(team_id):
+        if text:
+            sketches.add_react_words(react_name, message_words(text))
+    sketch.save(team_id, sketches)
+    return sketches
+
+
+def get_sketches(team_id):
+    return sketch.get(team_id) or sketch.load(team_id) or build_sketches(team_id)
+
+
+def observe_message(team_id, text):
+    if text:
+        sketch.observe(team_id, sketch.TeamSketches.add_message_phrases, message_phrases(text))
+
+
+def observe_react(team_id, user_id, react_name, first_msg_id=None):
+    '''
+    Updates the team's sketches for a new reaction. first_msg_id is given when
+    this is the first of this react on the message, so its words are counted
+    once per message like get_unique_words does.
+    '''
+    sketch.observe(team_id, sketch.TeamSketches.add_react, user_id, react_name)
+    if first_msg_id:
+        text = db.get_stored_message_text(team_id, first_msg_id)
+        if text:
+            sketch.observe(team_id, sketch.TeamSketches.add_react_words, react_name, message_words(text))
+
+
+def get_common_phrases_approx(team_id, count=10, offset=0):
+    '''
+    Approximate get_common_phrases in bounded memory
+
+    Returns:
+        list: (phrase, estimated count, max overestimate) tuples
+    '''
+    return get_sketches(team_id).phrases.top(offset + count)[offset:]
+
+
+def users_with_most_reacts_approx(team_id, count=5, offset=0):
+    '''
+    Returns:
+        list: (user ID, estimated reacts, max overestimate) tuples
+    '''
+    return get_sketches(team_id).reactors.top(offset + count)[offset:]
+
+
+def react_buzzword_approx(team_id, react_name, users, channels, count=5, offset=0):
+    '''
+    Approximate react_buzzword in bounded memory
+
+    Returns:
+        list: (word, estimated count, max overestimate) tuples
+    '''
+    words = get_sketches(team_id).react_words.get(react_name)
+    if words is None:
+        return []
+    disp_names = {user: users[user]['display_name'] for user in users}
+    return [(translate(word, disp_names, channels), est, err)
+            for word, est, err in words.top(offset + count)[offset:]]
+
+
+def react_count_approx(team_id, react_name):
+    '''
+    Returns:
+        tuple: (estimated uses of the react, max overestimate)
+    '''
+    counts = get_sketches(team_id).react_counts
+    return counts.estimate(react_name), counts.error_bound()
+
+
+def distinct_reacts_approx(team_id):
+    '''
+    Returns:
+        tuple: (estimated number of distinct reacts used, relative standard error)
+    '''
+    distinct = get_sketches(team_id).distinct_reacts
+    return distinct.count(), distinct.relative_error()
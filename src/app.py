@@ -2,7 +2,15 @@ from flask import Flask, request, make_response, render_template, abort
 from bot import VALID_COMMANDS, EVENT_TYPE_SLASH_COMMAND, EVENT_TYPE_API_EVENT, Bot
 import log
 from celery import Celery
+import hmac
 import os
+import time
+from util import sign_request
+
+# When set, requests must carry a valid X-Slack-Signature as well as the verification token
+SIGNING_SECRET = os.getenv('SLACK_SIGNING_SECRET')
+# Signed requests older than this are rejected as replays
+MAX_SIGNATURE_AGE = 60 * 5
 
 app = Flask(__name__)
 app.config['CELERY_BROKER_URL'] = os.getenv('REDIS_URL', 'redis://localhost:6379')
@@ -24,6 +32,20 @@ pyBot = Bot()
 celery = make_celery(app)
 
 
+def verify_signature(request):
+    if not SIGNING_SECRET:
+        return True
+    timestamp = request.headers.get('X-Slack-Request-Timestamp', '')
+    signature = request.headers.get('X-Slack-Signature', '')
+    try:
+        if abs(time.time() - int(timestamp)) > MAX_SIGNATURE_AGE:
+            return False
+    except ValueError:
+        return False
+    expected = sign_request(SIGNING_SECRET, timestamp, request.get_data())
+    return hmac.compare_digest(expected, signature)
+
+
 @celery.task
 def queue_bot_event(token, event_type, event):
     return pyBot.on_event(token, event_type, event)
@@ -31,8 +53,8 @@ def queue_bot_event(token, event_type, event):
 
 @app.route("/install", methods=['GET'])
 def pre_install():
-    client_id = bot.Bot.oauth['client_id']
-    scope = ['channels:read', 'channels:history', 'reactions:read', 'team:read']
+    client_id = pyBot.oauth['client_id']
+    scope = ['channels:read', 'channels:history', 'reactions:read', 'team:read', 'emoji:read']
     return render_template('install.html', client_id=client_id, scope=scope)
 
 
@@ -45,6 +67,8 @@ def thanks():
 
 @app.route('/listening', methods=['GET', 'POST'])
 def hears():
+    if not verify_signature(request):
+        return make_response('Invalid request signature', 403, {"X-Slack-No-Retry": 1})
     slack_event = request.get_json()
 
     if 'challenge' in slack_event:
@@ -53,9 +77,8 @@ def hears():
         })
 
     if 'event' in slack_event:
-        task = queue_bot_event.apply(args=(slack_event.get('token'), EVENT_TYPE_API_EVENT, slack_event))
-        task.wait()
-        if not task:
+        # Only appends to the event log, the writers do the DB work
+        if not pyBot.on_event(slack_event.get('token'), EVENT_TYPE_API_EVENT, slack_event):
             message = "Invalid Slack verification token"
             # By adding "X-Slack-No-Retry" : 1 to our response headers, we turn off
             # Slack's automatic retries during development.
@@ -71,17 +94,18 @@ def get_help_response():
 @app.route('/react_analytics', methods=['GET', 'POST'])
 def on_slash_command():
     print('slash_command')
+    if not verify_signature(request):
+        abort(403)
     slash_command = parse_slash_command(request)
     text = slash_command['text']
     response_text = 'use [/reacts help] for options'
     if text.lower().strip() == 'help':
         return make_response(get_help_response(), 200)
     if text.split(' ')[0] in VALID_COMMANDS:
-        task = queue_bot_event.apply(args=(slash_command['token'], EVENT_TYPE_SLASH_COMMAND, slash_command))
-        task.wait()
-        if not task:
+        if not pyBot.verify_token(slash_command['token']):
             response_text = 'Invalid token'
         else:
+            queue_bot_event.delay(slash_command['token'], EVENT_TYPE_SLASH_COMMAND, slash_command)
             response_text = ''
     return make_response(response_text, 200)
 
@@ -91,7 +115,8 @@ def parse_slash_command(request):
     result = {'token': request.form.get('token', None),
               'command': request.form.get('command', None),
               'text': request.form.get('text', None),
-              'user_id': request.form.get('user_id')}
+              'user_id': request.form.get('user_id'),
+              'team_id': request.form.get('team_id')}
 
     if not result['token']:
         abort(400)
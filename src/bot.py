@@ -1,13 +1,20 @@
 import os
-from multiprocessing import Queue
-from multiprocessing import Process, Lock
+import json
+from multiprocessing import Lock
 import re
-from slackclient import SlackClient
+import time
+import traceback
+from collections import defaultdict
 import analytics
+import coalesce
+import emoji_catalog
+import eventlog
 import logging
-from util import React, Message
+import planner
+import sketch
+import trending
+from util import React, Message, msg_id_string, parse_page, chunk_blocks, truncate
 import db
-from time import sleep
 
 EVENT_TYPE_SLASH_COMMAND = 0
 EVENT_TYPE_API_EVENT = 1
@@ -19,18 +26,49 @@ REACT_BUZZWORDS = 'buzzwords'
 MOST_REACTS = 'most_reacts'
 COMMON_PHRASES = 'common_phrases'
 MOST_ACTIVE = 'most_active'
-
-VALID_COMMANDS = {MOST_USED_REACTS: '[_optional_ *@User*]',
-                  MOST_UNIQUE_REACTS_ON_POST: '[_optional_ *@User*]',
-                  MOST_REACTED_TO_MESSAGES: '[_optional_ *@User*]',
-                  REACT_BUZZWORDS: '[_required_ :react:, :react2: ...]',
-                  MOST_REACTS: '',
-                  COMMON_PHRASES: '',
-                  MOST_ACTIVE: ''}
+TRENDING = 'trending'
+REACT_PAIRS = 'pairs'
+STATS = 'stats'
+
+# Message subtypes that are someone posting text. Every other subtype is a
+# notice (joins, topic changes, bot posts, thread reply updates) without a
+# user's text, and isn't stored.
+POSTED_MESSAGE_SUBTYPES = {'thread_broadcast', 'file_share', 'me_message'}
+
+# Appended to a command to answer from the bounded memory sketches
+APPROX_FLAG = 'approx'
+
+# Accepted by every command that returns a ranked list
+PAGE_ARGS = ' [_optional_ count=N page=N]'
+
+VALID_COMMANDS = {MOST_USED_REACTS: '[_optional_ *@User*]' + PAGE_ARGS,
+                  MOST_UNIQUE_REACTS_ON_POST: '[_optional_ *#Channel*]' + PAGE_ARGS,
+                  MOST_REACTED_TO_MESSAGES: '[_optional_ *@User*]' + PAGE_ARGS,
+                  REACT_BUZZWORDS: '[_required_ :react:, :react2: ...] [_optional_ approx]' + PAGE_ARGS,
+                  MOST_REACTS: '[_optional_ approx]' + PAGE_ARGS,
+                  COMMON_PHRASES: '[_optional_ approx]' + PAGE_ARGS,
+                  MOST_ACTIVE: PAGE_ARGS.lstrip(),
+                  TRENDING: '[_optional_ hour|day]' + PAGE_ARGS,
+                  REACT_PAIRS: '[_required_ :react:]' + PAGE_ARGS,
+                  STATS: ''}
 
 TIMER_INTERVAL = 2
-
+# How often a writer looks for entries orphaned by other writers
+CLAIM_INTERVAL = 30
+LAG_LOG_INTERVAL = 60
+# Caps how long a writer blocks on an empty log, so coalesced writes still
+# flush on time when events stop. BLOCK 0 would wait forever.
+READ_BLOCK_MS = max(1, int(min(5000, coalesce.COALESCE_WINDOW * 1000) if coalesce.enabled() else 5000))
+
+# In-memory state updated by event handlers, held back until the batch
+# transaction storing the events commits, see handle_log_entries
+STAGED_UPDATES = (coalesce.buffer, trending.staged, sketch.staged)
+
+# team_id -> (read at, tokens) for every workspace that has installed the
+# app, filled in from the Teams table as teams are seen and re-read once
+# older than TEAM_TOKENS_MAX_AGE so reinstalls and uninstalls are picked up
 authed_teams = {}
+TEAM_TOKENS_MAX_AGE = float(os.environ.get('TEAM_TOKENS_MAX_AGE', 300))
 
 
 class Bot(object):
@@ -42,21 +80,62 @@ class Bot(object):
                       # scope that your app will need.
                       "scope": 'bot'}
         self.verification = os.environ.get("VERIFICATION_TOKEN")
-        self.bot_client = SlackClient(os.environ.get('BOT_ACCESS_TOKEN'))
-        self.workspace_client = SlackClient(os.environ.get('ACCESS_TOKEN'))
-        self.event_queue = Queue()
+        # Slack clients are created on first use so importing the app stays
+        # cheap in every gunicorn/celery worker
+        self.clients = {}
         self.name = "reactanalyticsbot"
         self.emoji = ":robot_face:"
+        # Log entries handled but waiting on a coalesced write before being acknowledged
+        self.held_acks = []
+        # Teams whose emoji.list is due, fetched between batches
+        self.emoji_to_sync = set()
         self.users_lock = Lock()
         self.reacts_lock = Lock()
-        self.users = {}
-        self.channels = {}
-        self.reacts_list = set()
-        self.start()
+        # Workspace data is kept per team_id
+        self.users = defaultdict(dict)
+        self.channels = defaultdict(dict)
+
+    def team_tokens(self, team_id):
+        cached = authed_teams.get(team_id)
+        if cached is None or time.time() - cached[0] > TEAM_TOKENS_MAX_AGE:
+            team = db.get_team(team_id)
+            if team:
+                authed_teams[team_id] = cached = (time.time(), team)
+            else:
+                authed_teams.pop(team_id, None)
+                cached = None
+        return cached[1] if cached else None
+
+    def client_for(self, team_id, token_type):
+        client = self.clients.get((team_id, token_type))
+        if client is not None and client.revoked:
+            # Slack rejected the token, a reinstall may have stored a new one
+            authed_teams.pop(team_id, None)
+
+        team = self.team_tokens(team_id)
+        if team:
+            key = (team_id, token_type)
+            token = team[token_type]
+        else:
+            # Single workspace deployments configured through the environment
+            key = (None, token_type)
+            token = os.environ.get('BOT_ACCESS_TOKEN' if token_type == 'bot_token' else 'ACCESS_TOKEN')
+
+        client = self.clients.get(key)
+        if client is None or client.token != token or client.revoked:
+            client = self.clients[key] = self.make_client(token)
+        return client
 
-    def start(self):
-        p = Process(target=self.event_handler_loop)
-        p.start()
+    def bot_client(self, team_id):
+        return self.client_for(team_id, 'bot_token')
+
+    def workspace_client(self, team_id):
+        return self.client_for(team_id, 'access_token')
+
+    @staticmethod
+    def make_client(token):
+        from slack_api import SlackWebClient
+        return SlackWebClient(token)
 
     '''
     API INTERACTIONS
@@ -65,20 +144,16 @@ class Bot(object):
     def verify_token(self, token):
         return self.verification == token
 
-    def load_users(self):
-        users_response = self.workspace_client.api_call('users.list',
-                                                        scope=self.oauth['scope'])
+    def load_users(self, team_id):
+        client = self.workspace_client(team_id)
+        for users_response in client.paginate('users.list', scope=self.oauth['scope']):
+            if not users_response['ok']:
+                print('Failed to load users')
+                print(users_response)
+                return
 
-        if not users_response['ok']:
-            print('Failed to load users')
-            print(users_response)
-            return
-
-        should_continue = True
-        while should_continue:
-            next_users = users_response['members']
             with self.users_lock:
-                for user in next_users:
+                for user in users_response['members']:
                     user_id = user['id']
                     user_name = user['name']
                     user_info = {'user_name': user_name}
@@ -86,65 +161,80 @@ class Bot(object):
                         user_info['display_name'] = user['profile']['display_name']
                     else:
                         user_info['display_name'] = user_name
-                    self.users[user_id] = user_info
-            if 'response_metadata' in users_response:
-                next_cursor = users_response['response_metadata']['next_cursor']
-
-                if not next_cursor:
-                    should_continue = False
-                else:
-                    users_response = self.workspace_client.api_call('users.list',
-                                                                    scope=self.oauth['scope'],
-                                                                    cursor=next_cursor)
-                    should_continue = users_response['ok']
-            else:
-                should_continue = False
+                    self.users[team_id][user_id] = user_info
 
     # Given a channel ID checks if it's a direct message
-    def is_dm_channel(self, channel_id):
-        im_list_response = self.workspace_client.api_call('im.list')
+    def is_dm_channel(self, team_id, channel_id):
+        im_list_response = self.workspace_client(team_id).api_call('im.list')
         if im_list_response['ok']:
             im_channels = [im['id'] for im in im_list_response['ims']]
             return channel_id in im_channels
         else:
             return False
 
-    def load_reacts(self):
-        resp = self.workspace_client.api_call('emoji.list')
+    def load_reacts(self, team_id):
+        # Only needed once per team, emoji_changed events keep the stored catalog current
+        resp = self.workspace_client(team_id).api_call('emoji.list')
         if resp['ok']:
             with self.reacts_lock:
-                self.reacts_list = {react for react in resp['emoji'].keys()}
+                emoji_catalog.sync(team_id, resp['emoji'])
         else:
             print('Failed to load reacts')
             print(resp)
-
-    def send_dm(self, user_id, message):
-        new_dm = self.bot_client.api_call('im.open',
-                                          user=user_id)
-
-        if not new_dm['ok']:
-            return False
-
-        channel_id = new_dm['channel']['id']
-        post_msg = self.bot_client.api_call('chat.postMessage',
-                                            channel=channel_id,
-                                            username=self.name,
-                                            text=message)
+            emoji_catalog.sync_failed(team_id, resp.get('error'))
+
+    def team_emoji(self, team_id):
+        if emoji_catalog.sync_due(team_id):
+            if db.in_batch():
+                # Never wait on Slack with a batch transaction open, the
+                # writer syncs once the batch is stored, see sync_emoji
+                self.emoji_to_sync.add(team_id)
+            else:
+                self.load_reacts(team_id)
+        return emoji_catalog.get(team_id)
+
+    def sync_emoji(self):
+        ''' Downloads emoji.list for the teams whose reacts were normalized without it '''
+        teams, self.emoji_to_sync = self.emoji_to_sync, set()
+        for team_id in sorted(teams):
+            if emoji_catalog.sync_due(team_id):
+                self.load_reacts(team_id)
+
+    def normalize_react(self, team_id, react_name):
+        return emoji_catalog.normalize(team_id, react_name, self.team_emoji(team_id))
+
+    def send_dm(self, team_id, user_id, message):
+        # The DM channel is cached by the client so im.open only runs once per user
+        post_msg = self.bot_client(team_id).post_dm(user_id, message, username=self.name)
         return post_msg['ok']
 
     def auth(self, code):
-        response = self.bot_client.api_call('oauth.access',
-                                            client_id=self.oauth['client_id'],
-                                            client_secret=self.oauth['client_secret'],
-                                            code=code)
+        response = self.make_client(None).api_call('oauth.access',
+                                                   client_id=self.oauth['client_id'],
+                                                   client_secret=self.oauth['client_secret'],
+                                                   code=code)
         if response['ok']:
             team_id = response['team_id']
-            bot_token = response['bot']['bot_access_token']
-            self.bot_client = SlackClient(bot_token)
-
-    def auth_token(self, token):
-        auth_response = self.workspace_client.api_call('auth.test',
-                                                       token=token)
+            team = {'team_id': team_id,
+                    'bot_user_id': response['bot']['bot_user_id'],
+                    'bot_token': response['bot']['bot_access_token'],
+                    'access_token': response['access_token']}
+            first_install = db.team_count() == 0
+            db.save_team(team_id, team['bot_user_id'], team['bot_token'], team['access_token'])
+            if first_install:
+                # Data recorded before teams were tracked belongs to the original install
+                db.claim_unscoped_rows(team_id)
+            else:
+                # A brand new team's aggregates are complete from its first message
+                db.mark_text_counts_complete(team_id)
+            authed_teams[team_id] = (time.time(), team)
+            self.clients.pop((team_id, 'bot_token'), None)
+            self.clients.pop((team_id, 'access_token'), None)
+        return response['ok']
+
+    def auth_token(self, team_id, token):
+        auth_response = self.workspace_client(team_id).api_call('auth.test',
+                                                                token=token)
         return auth_response['ok']
 
 
@@ -153,20 +243,28 @@ class Bot(object):
     '''
 
     def on_event(self, token, event_type, slack_event):
-        if self.verify_token(token):
-            evnt = Event(event_type, slack_event)
-            self.event_queue.put(evnt)
-        else:
+        if not self.verify_token(token):
             return False
 
+        if event_type == EVENT_TYPE_API_EVENT:
+            # Stored by the writer processes, see run_writer
+            eventlog.append(event_type, slack_event)
+        else:
+            self.handle_event(Event(event_type, slack_event))
+        return True
+
     def handle_api_event(self, event):
         print('handle_api_event')
         slack_event = event.event_info
         event_type = slack_event['event']['type']
 
-        if 'subtype' in slack_event['event']:
-            if slack_event['event']['subtype'] == 'message_deleted':
-                event_type = 'message_deleted'
+        subtype = slack_event['event'].get('subtype')
+        if subtype == 'message_deleted':
+            event_type = 'message_deleted'
+        elif subtype == 'message_changed':
+            event_type = 'message_changed'
+        elif event_type == 'message' and subtype and subtype not in POSTED_MESSAGE_SUBTYPES:
+            return
 
         if event_type == 'reaction_added':
             return self.reaction_added(slack_event)
@@ -176,193 +274,431 @@ class Bot(object):
             return self.message_posted(slack_event)
         elif event_type == 'message_deleted':
             return self.message_removed(slack_event)
+        elif event_type == 'message_changed':
+            return self.message_edited(slack_event)
+        elif event_type == 'emoji_changed':
+            return emoji_catalog.apply_change(slack_event['team_id'], slack_event['event'])
 
-    def message_removed(self, slack_event):
-        db.remove_message(Message('', slack_event['channel'], slack_event['ts'], '', ''))
+    @staticmethod
+    def message_removed(slack_event):
+        team_id = slack_event['team_id']
+        event = slack_event['event']
+        msg_id = msg_id_string(event['channel'], event['deleted_ts'])
+        db.delete_message(team_id, msg_id, analytics.text_counts)
+        # Buffered counts for the message would otherwise bring its MessageReacts back.
+        # Its UserReacts deltas stay, delete_message already took its reacts out.
+        coalesce.discard_message(team_id, msg_id)
 
     @staticmethod
-    def reaction_added(slack_event):
+    def message_edited(slack_event):
+        team_id = slack_event['team_id']
+        event = slack_event['event']
+        message = event['message']
+        msg = Message(team_id, event['channel'], message['ts'],
+                      message.get('user', ''), message.get('text', ''))
+        db.edit_message(msg, analytics.text_counts)
+
+    def reaction_added(self, slack_event):
+        team_id = slack_event['team_id']
         event = slack_event['event']
-        react_name = event['reaction']
+        react_name = self.normalize_react(team_id, event['reaction'])
         user_id = event['user']
         channel_id = event['item']['channel']
         time_stamp = event['item']['ts']
-        db.add_react(React('', channel_id, time_stamp, user_id, react_name))
-
-    @staticmethod
-    def reaction_removed(slack_event):
+        react = React(team_id, channel_id, time_stamp, user_id, react_name)
+        first_on_message = coalesce.add_react(react)
+        analytics.observe_react(team_id, user_id, react_name,
+                                react.msg_id if first_on_message else None)
+        trending.observe_react(team_id, react_name, float(event.get('event_ts') or 0))
+
+    def reaction_removed(self, slack_event):
+        team_id = slack_event['team_id']
         event = slack_event['event']
-        react_name = event['reaction']
+        react_name = self.normalize_react(team_id, event['reaction'])
         user_id = event['user']
         channel_id = event['item']['channel']
         time_stamp = event['item']['ts']
 
-        db.remove_react(React('', channel_id, time_stamp, user_id, react_name))
+        coalesce.remove_react(React(team_id, channel_id, time_stamp, user_id, react_name))
 
     @staticmethod
     def message_posted(slack_event):
-        try:
-            event = slack_event['event']
-            channel_id = event['channel']
-            user_id = event['user']
-            time_stamp = event['ts']
-            text = event['text']
-            msg = Message('', channel_id, time_stamp, user_id, text)
-            db.add_message(msg)
-        except:
-            logging.getLogger(__name__).error('Failed to unpack slack event')
+        # Subtypes without a user are filtered out by handle_api_event, so
+        # malformed events raise here and handle_log_entries quarantines them
+        team_id = slack_event['team_id']
+        event = slack_event['event']
+        channel_id = event['channel']
+        user_id = event['user']
+        time_stamp = event['ts']
+        text = event['text']
+        msg = Message(team_id, channel_id, time_stamp, user_id, text)
+        db.add_message(msg, analytics.text_counts)
+        analytics.observe_message(team_id, text)
+        trending.observe_phrases(team_id, analytics.message_phrases(text), float(time_stamp))
 
     def handle_slash_command(self, event):
         event = event.event_info
         token = event['token']
+        team_id = event['team_id']
 
-        if not self.auth_token(token):
+        if not self.auth_token(team_id, token):
             logging.getLogger(__name__).warning('Not authed')
             return
 
-        if not self.users:
-            self.load_users()
+        if not self.users[team_id]:
+            self.load_users(team_id)
 
-        text = event['text'].split(' ')
+        text, page = parse_page(event['text'])
+        text = text.split(' ')
         user_id = event['user_id']
         command = text[0]
         args = ""
 
+        approx = APPROX_FLAG in text[1:]
+        if approx:
+            text = [t for t in text if t != APPROX_FLAG]
+
         # check if there are any args
         if len(text) > 1:
             args = ' '.join(text[1:])
         try:
             if command == MOST_USED_REACTS:
-                response = self.most_used_reacts(args)
+                response = self.most_used_reacts(team_id, args, page)
             elif command == MOST_REACTED_TO_MESSAGES:
-                response = self.most_reacted_to_message(args)
+                response = self.most_reacted_to_message(team_id, args, page)
             elif command == MOST_UNIQUE_REACTS_ON_POST:
-                response = self.most_unique_reacts_on_post(args)
+                response = self.most_unique_reacts_on_post(team_id, args, page)
             elif command == REACT_BUZZWORDS:
-                response = self.react_buzzwords(args)
+                response = self.react_buzzwords(team_id, args, page, approx)
             elif command == MOST_REACTS:
-                response = self.most_reacts(args)
+                response = self.most_reacts(team_id, args, page, approx)
             elif command == COMMON_PHRASES:
-                response = self.common_phrases()
+                response = self.common_phrases(team_id, page, approx)
             elif command == MOST_ACTIVE:
-                response = self.most_active()
+                response = self.most_active(team_id, page)
+            elif command == TRENDING:
+                response = self.trending(team_id, args, page)
+            elif command == REACT_PAIRS:
+                response = self.react_pairs(team_id, args, page)
+            elif command == STATS:
+                response = self.stats()
+            # Responses are generators, so results are formatted and sent
+            # a message at a time as they're produced
+            self.send_lines(team_id, user_id, response)
         except Exception as e:
-            self.send_dm(user_id, 'There was an error processing your request')
+            self.send_dm(team_id, user_id, 'There was an error processing your request')
             raise e
 
-        self.send_dm(user_id, response)
+    def send_lines(self, team_id, user_id, lines):
+        if isinstance(lines, str):
+            lines = lines.split('\n')
+        for blocks in chunk_blocks(lines):
+            fallback = truncate(blocks[0]['text']['text'], 150)
+            resp = self.bot_client(team_id).post_dm(user_id, fallback, username=self.name,
+                                                    blocks=json.dumps(blocks))
+            if not resp.get('ok'):
+                # Stop rather than send the rest of the results with a gap in them
+                raise RuntimeError('chat.postMessage failed: %s' % resp.get('error'))
+
+    @staticmethod
+    def page_footer(page, results):
+        if results >= page.count:
+            return ['_page %d, use page=%d for more_' % (page.number, page.number + 1)]
+        return []
 
-    def user_exists(self, user):
-        if user in self.users:
+    def user_exists(self, team_id, user):
+        if user in self.users[team_id]:
             return True
         else:
-            self.load_users()
-            return user in self.users
-
-    def common_phrases(self):
-        phrases = analytics.get_common_phrases()
-        result_str = ['Common Phrases:']
-        for p in phrases:
-            result_str.append(' '.join(p))
-        return '\n'.join(result_str)
-
-    def most_reacted_to_message(self, text):
+            self.load_users(team_id)
+            return user in self.users[team_id]
+
+    def display_name(self, team_id, user_id):
+        if self.user_exists(team_id, user_id):
+            return self.users[team_id][user_id]['display_name']
+        return user_id
+
+    def common_phrases(self, team_id, page, approx=False):
+        if approx:
+            yield 'Common Phrases (approximate):'
+            phrases = analytics.get_common_phrases_approx(team_id, page.count, page.offset)
+            for p, count, error in phrases:
+                yield ' '.join(p) + ' : ~' + str(count) + ' (+/- ' + str(error) + ')'
+        else:
+            yield 'Common Phrases:'
+            phrases = analytics.get_common_phrases(team_id, page.count, offset=page.offset)
+            for p in phrases:
+                yield ' '.join(p)
+        for line in self.page_footer(page, len(phrases)):
+            yield line
+
+    def most_reacted_to_message(self, team_id, text, page):
         re_object = re.search('(?<=\@)(.*?)(?=\|)', text)
-        
+
         title = 'Most reacted to posts'
+        user_id = None
         if re_object:
             user_id = re_object.group(0)
-            title += ' for ' + self.users[user_id] + ':'
-            
-        msgs = analytics.most_reacted_to_posts(user_id)
-
-        result_str = []
-        result_str.append(title)
-        for msg, count in msgs.items():
-            result_str.append(msg + ' : ' + str(count))
-
-        return '\n'.join(result_str)
-
-    def most_reacts(self, args):
-        user_reacts = analytics.users_with_most_reacts()
+            title += ' for ' + self.display_name(team_id, user_id) + ':'
+
+        msgs = analytics.most_reacted_to_posts(team_id, user_id, page.count, page.offset)
+
+        yield title
+        for msg, count in msgs:
+            yield truncate(msg) + ' : ' + str(count)
+        for line in self.page_footer(page, len(msgs)):
+            yield line
+
+    def most_reacts(self, team_id, args, page, approx=False):
+        if approx:
+            yield 'Users that react the most (approximate)'
+            user_reacts = analytics.users_with_most_reacts_approx(team_id, page.count, page.offset)
+            for user, count, error in user_reacts:
+                yield '<@' + user + '>: ~' + str(count) + ' (+/- ' + str(error) + ')'
+            distinct, rel_error = analytics.distinct_reacts_approx(team_id)
+            yield '~%d distinct reacts used (+/- %.1f%%)' % (distinct, rel_error * 100)
+        else:
+            user_reacts = analytics.users_with_most_reacts(team_id, page.count, page.offset)
 
-        result_str = ['Users that react the most']
-        for user, count in user_reacts.items():
-            if self.user_exists(user):
-                result_str.append('<@' + user + '>: ' + str(count))
-            else:
-                print(user + 'not in users dictionary')
-        return '\n'.join(result_str)
-
-    def most_active(self):
-        most_active = analytics.most_active()
-        result_str = ['Most active users:']
-        for user in most_active:
-            if self.user_exists(user):
-                result_str.append('<@' + user + '>')
+            yield 'Users that react the most'
+            for user, count in user_reacts.items():
+                if self.user_exists(team_id, user):
+                    yield '<@' + user + '>: ' + str(count)
+                else:
+                    print(user + 'not in users dictionary')
+        for line in self.page_footer(page, len(user_reacts)):
+            yield line
+
+    def most_active(self, team_id, page):
+        most_active = analytics.most_active(team_id, page.count, page.offset)
+        yield 'Most active users:'
+        for user, count in most_active:
+            if self.user_exists(team_id, user):
+                yield '<@' + user + '>: ' + str(count) + ' messages'
             else:
                 print(str(user) + 'not in users dictionary')
-        return '\n'.join(result_str)
+        for line in self.page_footer(page, len(most_active)):
+            yield line
 
-    def most_used_reacts(self, text):
+    def most_used_reacts(self, team_id, text, page):
         user_id = re.search('(?<=\@)(.*?)(?=\|)', text)
 
-        users = list(user_id.group(0)) if user_id else self.users
-        result = analytics.favorite_reacts_of_users(users)
-
-        return_str = ['Most used reacts:']
-        for r in result:
-            line = ':' + str(r[0]) + ': : ' + str(r[1])
-            return_str.append(line)
-        return '\n'.join(result_str)
-
-    def most_unique_reacts_on_post(self, text):
+        if user_id:
+            result = analytics.favorite_reacts_of_users(team_id, [user_id.group(0)], page.count)
+        else:
+            # A page of users, each with their top reacts
+            result = analytics.favorite_reacts_of_users(team_id, user_count=page.count,
+                                                        user_offset=page.offset)
+
+        yield 'Most used reacts:'
+        for user, reacts in result.items():
+            if not reacts:
+                continue
+            react_str = ' '.join([':' + str(r) + ': ' + str(c) for r, c in reacts.items()])
+            yield '<@' + user + '>: ' + react_str
+        if not user_id:
+            for line in self.page_footer(page, len(result)):
+                yield line
+
+    def most_unique_reacts_on_post(self, team_id, text, page):
         channel_id = re.search('(?<=\#)(.*?)(?=\|)', text)
-        result_str = ['Messages with most unique reacts:']
+        yield 'Messages with most unique reacts:'
         if not channel_id:
-            result = analytics.most_unique_reacts_on_a_post()
+            result = analytics.most_unique_reacts_on_a_post(team_id, None, page.count, page.offset)
         else:
-            result = analytics.most_unique_reacts_on_a_post(channel_id.group(0))
-
-        for msg_id, reacts in result.items():
-            text = db.get_message_text('', msg_id)
-            if text:
-                react_str = ''.join([':' + r + ': ' for r in reacts.keys()])
-                result_str.append(text + ' : ' + react_str)
+            result = analytics.most_unique_reacts_on_a_post(team_id, channel_id.group(0),
+                                                            page.count, page.offset)
 
-        return '\n'.join(result_str)
+        for msg_text, count in result:
+            if msg_text:
+                yield truncate(msg_text) + ' : ' + str(count)
+        for line in self.page_footer(page, len(result)):
+            yield line
 
-    def react_buzzwords(self, text):
+    def react_buzzwords(self, team_id, text, page, approx=False):
         if not text.strip():
-            return 'specify at least one react'
-
-        result_str = []
+            yield 'specify at least one react'
+            return
 
         reacts = re.findall('(?<=:)(.*?)(?=:)', text)
-        reacts = {r for r in reacts if r.strip(' ')}
+        # Looked up under the same names reacts are stored with
+        reacts = {self.normalize_react(team_id, r) for r in reacts if r.strip(' ')}
 
         for r in reacts:
-            try:
-                react_buzzwords = analytics.react_buzzword(r, self.users, self.channels, 10)
+            if approx:
+                yield self.react_buzzwords_approx(team_id, r, page)
+                continue
 
-                result_str.append(':' + r + ':: ')
-                if react_buzzwords:
-                    result_str.append(', '.join([word for word in react_buzzwords.keys()]))
-                else:
-                    result_str.append('React not used')
+            react_buzzwords = analytics.react_buzzword(team_id, r, self.users[team_id],
+                                                       self.channels[team_id], page.count,
+                                                       offset=page.offset)
+
+            yield ':' + r + ':: '
+            if react_buzzwords:
+                yield ', '.join([word for word in react_buzzwords.keys()])
+            else:
+                yield 'React not used'
+
+    def react_pairs(self, team_id, text, page):
+        react = re.search('(?<=:)(.*?)(?=:)', text)
+        if not react or not react.group(0).strip():
+            yield 'specify a react'
+            return
 
-            except Exception as e:
-                logging.getLogger(__name__).exception(e.message, e.args)
-                return 'something went wrong'
+        react_name = self.normalize_react(team_id, react.group(0))
+        pairs = analytics.react_pairs(team_id, react_name, page.count, page.offset)
+
+        yield 'Reacts used most with :' + react_name + ':'
+        if not pairs:
+            yield 'No reacts used alongside it yet'
+        for other, count in pairs:
+            yield ':' + other + ': on ' + str(count) + ' messages'
+        for line in self.page_footer(page, len(pairs)):
+            yield line
+
+    def trending(self, team_id, text, page):
+        window = trending.DAY if trending.DAY in text.split() else trending.HOUR
+        result = trending.trending(team_id, window, page.count, page.offset)
+
+        yield 'Trending in the last %s:' % window
+        for kind, title, fmt in ((trending.KIND_REACT, 'Reacts', ':%s:'),
+                                 (trending.KIND_PHRASE, 'Phrases', '%s')):
+            yield '*' + title + '*'
+            if not result[kind]:
+                yield 'Nothing trending'
+            for name, count, baseline, ratio in result[kind]:
+                yield '%s : %d (x%.1f usual)' % (fmt % name, count, ratio)
+        for line in self.page_footer(page, max(len(r) for r in result.values())):
+            yield line
 
-        return '\n'.join(result_str)
+    @staticmethod
+    def stats():
+        ''' How this worker's queries have been served since it started '''
+        yield '*Database reads and writes by route*'
+        for line in db.route_metric_lines() or ['none yet']:
+            yield line
+        yield '*Analytics queries by path*'
+        for line in planner.metric_lines() or ['none yet']:
+            yield line
+
+    def react_buzzwords_approx(self, team_id, react_name, page):
+        uses, uses_error = analytics.react_count_approx(team_id, react_name)
+        words = analytics.react_buzzword_approx(team_id, react_name, self.users[team_id],
+                                                self.channels[team_id], page.count, page.offset)
+        header = ':' + react_name + ':: (~' + str(uses) + ' uses, +' + str(uses_error) + ')'
+        if not words:
+            return header + '\nReact not used'
+        return header + '\n' + ', '.join([word + ' (~' + str(count) + ' +/- ' + str(error) + ')'
+                                          for word, count, error in words])
+
+    def run_writer(self, consumer):
+        '''
+        Consumes the event log as one member of the writers group. Entries are
+        acknowledged once stored, so anything in flight when a writer dies is
+        replayed, by the same writer on restart or by another one after
+        eventlog.CLAIM_IDLE_MS.
+        '''
+        eventlog.ensure_group()
+
+        # Replay whatever this consumer had read but not acknowledged. Each
+        # batch is flushed straight away so its entries are acknowledged before
+        # the pending list is read again, and entries that still fail are left
+        # for claim_stale rather than retried here forever.
+        replayed = set()
+        entries = eventlog.read(consumer, pending=True)
+        while entries and not replayed.issuperset(entry[0] for entry in entries):
+            replayed.update(entry[0] for entry in entries)
+            self.handle_log_entries(entries)
+            self.flush_writes(force=True)
+            entries = eventlog.read(consumer, pending=True)
 
-    def event_handler_loop(self):
+        try:
+            self.consume(consumer)
+        finally:
+            # Don't lose the trend counts, sketch updates or react counts held in memory
+            trending.checkpoint()
+            sketch.checkpoint()
+            self.flush_writes(force=True)
+
+    def consume(self, consumer):
+        last_claim = last_lag_log = 0
         while True:
-            while not self.event_queue.empty():
-                event = self.event_queue.get()
-                self.handle_event(event)
-            sleep(100)
+            trending.maybe_checkpoint()
+            sketch.maybe_checkpoint()
+            now = time.time()
+            if now - last_claim > CLAIM_INTERVAL:
+                last_claim = now
+                self.handle_log_entries(eventlog.claim_stale(consumer, on_give_up=self.give_up_on_entry))
+            if now - last_lag_log > LAG_LOG_INTERVAL:
+                last_lag_log = now
+                eventlog.log_lag()
+                coalesce.log_metrics()
+                db.log_route_metrics()
+            self.handle_log_entries(eventlog.read(consumer, block_ms=READ_BLOCK_MS))
+            self.flush_writes()
+            self.sync_emoji()
+
+    def handle_log_entries(self, entries):
+        '''
+        Stores a batch of entries in one transaction. Each event runs in its
+        own savepoint, and one that raises is rolled back and moved to the
+        DeadLetters table while the rest of the batch commits. Connection
+        errors abort the whole batch, which is then retried. Count changes
+        are summed and written just before the commit, see db.batch().
+        '''
+        if not entries:
+            return
+        handled = []
+        for staged in STAGED_UPDATES:
+            staged.stage()
+        try:
+            with db.batch():
+                for entry_id, event_type, event_info in entries:
+                    marks = [staged.mark() for staged in STAGED_UPDATES]
+                    try:
+                        with db.savepoint():
+                            self.handle_event(Event(event_type, event_info))
+                    except Exception as e:
+                        if db.is_transient(e):
+                            raise
+                        for staged, mark in zip(STAGED_UPDATES, marks):
+                            staged.discard_staged(mark)
+                        logging.getLogger(__name__).exception('Quarantining event ' + entry_id)
+                        db.add_dead_letter(entry_id, event_type, event_info, traceback.format_exc())
+                    handled.append(entry_id)
+        except Exception:
+            # Nothing is acknowledged, so the whole batch is retried once claimed
+            for staged in STAGED_UPDATES:
+                staged.discard_staged()
+            logging.getLogger(__name__).exception('Failed to store a batch of %d events' % len(entries))
+            return
+        for staged in STAGED_UPDATES:
+            staged.commit_staged()
+        self.held_acks.extend(handled)
+        self.flush_writes()
+
+    def flush_writes(self, force=False):
+        '''
+        Applies coalesced react counts once they're due and acknowledges the
+        entries they came from. Until then those entries stay pending, so a
+        writer dying with counts in memory has them replayed.
+        '''
+        try:
+            flushed = coalesce.flush_if_due(force)
+        except Exception:
+            logging.getLogger(__name__).exception('Failed to flush coalesced react counts')
+            return
+        if flushed:
+            eventlog.ack(self.held_acks)
+            self.held_acks = []
+
+    @staticmethod
+    def give_up_on_entry(entry):
+        entry_id, event_type, event_info = entry
+        logging.getLogger(__name__).error('Dropping event %s after %d attempts: %s'
+                                          % (entry_id, eventlog.MAX_DELIVERIES, event_info))
+        db.add_dead_letter(entry_id, event_type, event_info,
+                           'gave up after %d deliveries' % eventlog.MAX_DELIVERIES)
 
     def handle_event(self, event):
         if event.type == EVENT_TYPE_API_EVENT:
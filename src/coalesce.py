@@ -0,0 +1,194 @@
+'''
+Write coalescing for react counts.
+
+A message going viral gets hundreds of reacts a second, and each one
+increments the same MessageReacts row, so writers queue up on its row lock.
+With REACT_COALESCE_MS set, writers add reacts to the Reactions table right
+away but only buffer the count changes, then apply one delta per
+(message, react) and (user, react) at most REACT_COALESCE_MS later.
+Counts are never more than that stale, and the writer flushes before
+acknowledging the events that went into a flush and before it exits.
+'''
+import os
+import threading
+import time
+
+import db
+import log
+
+COALESCE_WINDOW = float(os.environ.get('REACT_COALESCE_MS', 0)) / 1000.0
+# Flushed early once this many distinct rows are waiting
+MAX_PENDING_ROWS = int(os.environ.get('REACT_COALESCE_MAX_ROWS', 5000))
+
+
+def enabled():
+    return COALESCE_WINDOW > 0
+
+
+class ReactBuffer(object):
+    def __init__(self, window=COALESCE_WINDOW, max_rows=MAX_PENDING_ROWS):
+        self.window = window
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.message_deltas = {}
+        self.user_deltas = {}
+        # When the oldest change still waiting was buffered
+        self.oldest = None
+        self.pending_events = 0
+        # Changes made by a batch transaction that hasn't committed yet, see stage()
+        self.staged = None
+        self.metrics = {'events': 0, 'rows_written': 0, 'flushes': 0,
+                        'errors': 0, 'max_staleness_ms': 0.0}
+
+    def stage(self):
+        ''' Holds further changes back until commit_staged() or discard_staged() '''
+        self.staged = []
+
+    def mark(self):
+        return len(self.staged) if self.staged is not None else 0
+
+    def commit_staged(self):
+        staged, self.staged = self.staged or [], None
+        for op in staged:
+            op[0](*op[1:])
+
+    def discard_staged(self, mark=None):
+        ''' Drops the changes staged since mark, or all of them and stops staging '''
+        if mark is None:
+            self.staged = None
+        elif self.staged is not None:
+            del self.staged[mark:]
+
+    def add(self, react, delta):
+        if self.staged is not None:
+            self.staged.append((self.add_now, react, delta))
+        else:
+            self.add_now(react, delta)
+
+    def discard_message(self, team_id, msg_id):
+        ''' Drops buffered counts for a message that's been deleted '''
+        if self.staged is not None:
+            self.staged.append((self.discard_message_now, team_id, msg_id))
+        else:
+            self.discard_message_now(team_id, msg_id)
+
+    def discard_message_now(self, team_id, msg_id):
+        with self.lock:
+            for key in [k for k in self.message_deltas if k[0] == team_id and k[1] == msg_id]:
+                del self.message_deltas[key]
+            if not self.message_deltas and not self.user_deltas:
+                self.oldest = None
+
+    def add_now(self, react, delta):
+        message_key = (react.team_id, react.msg_id, react.react_name)
+        user_key = (react.team_id, react.user_id, react.react_name)
+        with self.lock:
+            self.message_deltas[message_key] = self.message_deltas.get(message_key, 0) + delta
+            self.user_deltas[user_key] = self.user_deltas.get(user_key, 0) + delta
+            self.pending_events += 1
+            if self.oldest is None:
+                self.oldest = time.time()
+
+    def is_empty(self):
+        with self.lock:
+            return self.oldest is None
+
+    def is_due(self):
+        with self.lock:
+            if self.oldest is None:
+                return False
+            return (time.time() - self.oldest >= self.window or
+                    len(self.message_deltas) + len(self.user_deltas) >= self.max_rows)
+
+    def flush(self):
+        ''' Applies everything buffered in one transaction, keeping it buffered if that fails '''
+        with self.lock:
+            if self.oldest is None:
+                return
+            message_deltas, self.message_deltas = self.message_deltas, {}
+            user_deltas, self.user_deltas = self.user_deltas, {}
+            oldest, self.oldest = self.oldest, None
+            events, self.pending_events = self.pending_events, 0
+        try:
+            db.apply_react_deltas(message_deltas, user_deltas)
+        except BaseException:
+            # Including SystemExit from SIGTERM, the entries behind these
+            # counts mustn't be acknowledged until they're written
+            with self.lock:
+                self.metrics['errors'] += 1
+                for key, delta in message_deltas.items():
+                    self.message_deltas[key] = self.message_deltas.get(key, 0) + delta
+                for key, delta in user_deltas.items():
+                    self.user_deltas[key] = self.user_deltas.get(key, 0) + delta
+                self.oldest = min(oldest, self.oldest or oldest)
+                self.pending_events += events
+            raise
+        with self.lock:
+            self.metrics['flushes'] += 1
+            self.metrics['events'] += events
+            self.metrics['rows_written'] += (len([d for d in message_deltas.values() if d]) +
+                                             len([d for d in user_deltas.values() if d]))
+            self.metrics['max_staleness_ms'] = max(self.metrics['max_staleness_ms'],
+                                                   1000 * (time.time() - oldest))
+
+
+buffer = ReactBuffer()
+
+
+def add_react(react):
+    '''
+    Stores a react, buffering the count increments when coalescing is on
+
+    Returns:
+        bool: True if this is the first of this react on the message
+    '''
+    if not enabled():
+        return db.add_react(react)
+    first_on_message = db.record_reaction(react)
+    buffer.add(react, 1)
+    return first_on_message
+
+
+def remove_react(react):
+    if not enabled():
+        return db.remove_react(react)
+    db.remove_reaction(react)
+    buffer.add(react, -1)
+
+
+def discard_message(team_id, msg_id):
+    if enabled():
+        buffer.discard_message(team_id, msg_id)
+
+
+def flush_if_due(force=False):
+    '''
+    Returns:
+        bool: True if nothing is left buffered
+    '''
+    if force or buffer.is_due():
+        buffer.flush()
+    return buffer.is_empty()
+
+
+def metrics():
+    '''
+    Returns:
+        dict: react events flushed, rows actually written for them, writes
+              saved by coalescing, flushes, failed flushes and the stalest
+              flush seen
+    '''
+    with buffer.lock:
+        result = dict(buffer.metrics)
+    # Every event would otherwise have written a message row and a user row
+    result['writes_coalesced'] = 2 * result['events'] - result['rows_written']
+    return result
+
+
+def log_metrics():
+    if enabled():
+        m = metrics()
+        log.log_info('react coalescing: %d events, %d rows written, %d writes coalesced, '
+                     '%d flushes, %d failed, max staleness %.0fms'
+                     % (m['events'], m['rows_written'], m['writes_coalesced'],
+                        m['flushes'], m['errors'], m['max_staleness_ms']))
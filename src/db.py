@@ -1,53 +1,663 @@
 import traceback
 import os
-import psycopg2
+import json
+import threading
+import time
 import log
+from collections import Counter, defaultdict
+from itertools import combinations
+from contextlib import contextmanager
 from functools import wraps
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# Optional streaming replica for the heavy analytics reads
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+# Reads go back to the primary while the replica is further behind than this
+MAX_REPLICA_LAG = float(os.environ.get('MAX_REPLICA_LAG', 30))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 10))
+# Heroku Postgres needs SSL, a local database for load testing usually doesn't have it
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require')
 
+ROUTE_PRIMARY = 'primary'
+ROUTE_REPLICA = 'replica'
+ROUTE_FALLBACK = 'replica_fallback'
 
-def get_connection():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+# Kinds of change queued by _defer()
+REACTIONS = 'reactions'
+MESSAGE_REACTS = 'MessageReacts'
+USER_REACTS = 'UserReacts'
+WORD_COUNTS = 'WordCounts'
+PHRASE_COUNTS = 'PhraseCounts'
+MESSAGE_DELETED = 'message_deleted'
 
+# A message's Slack timestamp in epoch seconds, taken from the end of its MessageID
+MESSAGE_TS = "CAST(substring(MessageID from '([0-9]+[.][0-9]+)$') AS DOUBLE PRECISION)"
 
-def psycopg2_cur(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
+# Every table carries a TeamID and every index leads with it, so a team's
+# queries only ever touch that team's slice of the index
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS Teams (
+           TeamID TEXT PRIMARY KEY,
+           BotUserID TEXT,
+           BotToken TEXT,
+           AccessToken TEXT,
+           InstalledAt TIMESTAMP DEFAULT now())''',
+    '''CREATE TABLE IF NOT EXISTS Messages (
+           MessageID TEXT,
+           TeamID TEXT,
+           UserID TEXT,
+           MessageText TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS MessageReacts (
+           MessageID TEXT,
+           ReactName TEXT,
+           Count INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS UserReacts (
+           UserID TEXT,
+           TeamID TEXT,
+           ReactName TEXT,
+           Count INTEGER)''',
+    'ALTER TABLE MessageReacts ADD COLUMN IF NOT EXISTS TeamID TEXT',
+    'CREATE INDEX IF NOT EXISTS messages_team_msg_idx ON Messages (TeamID, MessageID)',
+    'CREATE INDEX IF NOT EXISTS messages_team_user_idx ON Messages (TeamID, UserID)',
+    'CREATE INDEX IF NOT EXISTS message_reacts_team_msg_idx ON MessageReacts (TeamID, MessageID, ReactName)',
+    'CREATE INDEX IF NOT EXISTS message_reacts_team_react_idx ON MessageReacts (TeamID, ReactName)',
+    'CREATE INDEX IF NOT EXISTS user_reacts_team_user_idx ON UserReacts (TeamID, UserID, ReactName)',
+    # Who reacted with what on each message, so deleting a message can take
+    # its reacts back out of UserReacts
+    '''CREATE TABLE IF NOT EXISTS Reactions (
+           TeamID TEXT,
+           MessageID TEXT,
+           UserID TEXT,
+           ReactName TEXT,
+           PRIMARY KEY (TeamID, MessageID, UserID, ReactName))''',
+    # Text aggregates maintained by delta on every post, edit and delete.
+    # WordCounts counts each word once per message like get_unique_words.
+    '''CREATE TABLE IF NOT EXISTS WordCounts (
+           TeamID TEXT,
+           Word TEXT,
+           Count INTEGER,
+           PRIMARY KEY (TeamID, Word))''',
+    '''CREATE TABLE IF NOT EXISTS PhraseCounts (
+           TeamID TEXT,
+           Phrase TEXT,
+           Count INTEGER,
+           PRIMARY KEY (TeamID, Phrase))''',
+    # Lets exports and time windowed reads range scan a team's messages by time
+    'CREATE INDEX IF NOT EXISTS messages_team_ts_idx ON Messages (TeamID, (' + MESSAGE_TS + '))',
+    # ...and their reacts, which exports copy a day at a time
+    'CREATE INDEX IF NOT EXISTS message_reacts_team_ts_idx ON MessageReacts (TeamID, (' + MESSAGE_TS + '))',
+    # When a message was stored, which exports pick up new messages by since
+    # a replayed event or a backfill can store one with an old timestamp
+    'ALTER TABLE Messages ADD COLUMN IF NOT EXISTS StoredAt TIMESTAMPTZ DEFAULT now()',
+    'CREATE INDEX IF NOT EXISTS messages_team_stored_idx ON Messages (TeamID, StoredAt)',
+    # Custom emoji from emoji.list, AliasFor is set instead of URL for aliases
+    '''CREATE TABLE IF NOT EXISTS Emoji (
+           TeamID TEXT,
+           Name TEXT,
+           AliasFor TEXT,
+           URL TEXT,
+           PRIMARY KEY (TeamID, Name))''',
+    # Teams whose emoji.list has been stored, even if it had no custom emoji
+    '''CREATE TABLE IF NOT EXISTS EmojiSync (
+           TeamID TEXT PRIMARY KEY,
+           SyncedAt TIMESTAMP DEFAULT now())''',
+    # Per bucket usage of reacts and phrases for trend detection, see trending.py
+    '''CREATE TABLE IF NOT EXISTS TrendCounts (
+           TeamID TEXT,
+           Kind TEXT,
+           Name TEXT,
+           Bucket INTEGER,
+           Count INTEGER,
+           PRIMARY KEY (TeamID, Bucket, Kind, Name))''',
+    # Events that failed to be stored, kept with the error instead of being retried
+    '''CREATE TABLE IF NOT EXISTS DeadLetters (
+           ID SERIAL PRIMARY KEY,
+           TeamID TEXT,
+           EntryID TEXT,
+           EventType INTEGER,
+           Event TEXT,
+           Error TEXT,
+           FailedAt TIMESTAMP DEFAULT now())''',
+    'CREATE INDEX IF NOT EXISTS dead_letters_team_idx ON DeadLetters (TeamID, FailedAt)',
+    # How many messages carry both of two reacts. Each pair is stored once
+    # with ReactA < ReactB, and indexed from both sides so a react's top
+    # neighbours are two index range scans.
+    '''CREATE TABLE IF NOT EXISTS ReactPairs (
+           TeamID TEXT,
+           ReactA TEXT,
+           ReactB TEXT,
+           Count INTEGER,
+           PRIMARY KEY (TeamID, ReactA, ReactB))''',
+    'CREATE INDEX IF NOT EXISTS react_pairs_team_a_count_idx ON ReactPairs (TeamID, ReactA, Count DESC)',
+    'CREATE INDEX IF NOT EXISTS react_pairs_team_b_count_idx ON ReactPairs (TeamID, ReactB, Count DESC)',
+    'CREATE INDEX IF NOT EXISTS phrase_counts_team_count_idx ON PhraseCounts (TeamID, Count DESC)',
+    # When a team's WordCounts and PhraseCounts were last known to cover all
+    # its messages, i.e. rebuilt, or the team was installed with none stored
+    '''CREATE TABLE IF NOT EXISTS AggregateState (
+           TeamID TEXT PRIMARY KEY,
+           TextCountsRebuiltAt TIMESTAMP)''',
+    # Serialized approximate-mode sketches, see sketch.py. SketchesBuiltAt is
+    # when they were last rebuilt from the tables, NULL if they never were.
+    '''CREATE TABLE IF NOT EXISTS Sketches (
+           TeamID TEXT,
+           Part TEXT,
+           Data BYTEA,
+           PRIMARY KEY (TeamID, Part))''',
+    'ALTER TABLE AggregateState ADD COLUMN IF NOT EXISTS SketchesBuiltAt TIMESTAMP',
+]
+
+# Unique keys that let react counts be upserted by delta and stop a message
+# being stored twice. Created by create_tables once any duplicate rows left
+# from before them are merged.
+UNIQUE_KEYS = [('MessageReacts', 'message_reacts_team_msg_react_key', ('TeamID', 'MessageID', 'ReactName')),
+               ('UserReacts', 'user_reacts_team_user_react_key', ('TeamID', 'UserID', 'ReactName')),
+               ('Messages', 'messages_team_msg_key', ('TeamID', 'MessageID'))]
+
+
+_metrics_lock = threading.Lock()
+_metrics = defaultdict(lambda: {'calls': 0, 'errors': 0, 'seconds': 0.0})
+_replica_state = {'checked_at': 0.0, 'lag': None}
+
+
+def _record(route, seconds, error=False):
+    with _metrics_lock:
+        metrics = _metrics[route]
+        metrics['calls'] += 1
+        metrics['seconds'] += seconds
+        if error:
+            metrics['errors'] += 1
+
+
+def route_metrics():
+    '''
+    Returns:
+        dict: route -> calls, errors, total seconds and the last measured
+              replica lag, for this process
+    '''
+    with _metrics_lock:
+        result = {route: dict(metrics) for route, metrics in _metrics.items()}
+    result['replica_lag'] = _replica_state['lag']
+    return result
+
+
+def route_metric_lines():
+    '''
+    Returns:
+        list: a line per route with its calls, errors and average time,
+              and the replica lag when there's a replica
+    '''
+    metrics = route_metrics()
+    lag = metrics.pop('replica_lag')
+    lines = ['%s: %d calls, %d errors, %.1fms avg'
+             % (route, m['calls'], m['errors'], 1000 * m['seconds'] / max(1, m['calls']))
+             for route, m in sorted(metrics.items())]
+    if DATABASE_REPLICA_URL:
+        lines.append('replica lag: ' + ('unreachable' if lag is None else '%.1fs' % lag))
+    return lines
+
+
+def log_route_metrics():
+    for line in route_metric_lines():
+        log.log_info('db ' + line)
+
+
+def _connect(dsn):
+    import psycopg2
+    return psycopg2.connect(dsn, sslmode=DATABASE_SSLMODE)
+
+
+def replica_lag():
+    '''
+    Seconds the replica is behind the primary, re-measured at most every
+    REPLICA_LAG_CHECK_INTERVAL. None if it can't be reached.
+    '''
+    now = time.time()
+    if now - _replica_state['checked_at'] < REPLICA_LAG_CHECK_INTERVAL:
+        return _replica_state['lag']
+
+    lag = None
+    try:
+        conn = _connect(DATABASE_REPLICA_URL)
         try:
-            conn = get_connection()
             cursor = conn.cursor()
-            ret_val = func(cursor, *args, **kwargs)
+            # An idle primary has nothing to replay, which isn't lag
+            cursor.execute('''SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                              ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END''')
+            row = cursor.fetchone()
+            lag = float(row[0]) if row and row[0] is not None else 0.0
         finally:
-            conn.commit()
             conn.close()
-        return ret_val
-    return wrapper
+    except Exception as e:
+        log.log_error('replica lag check failed: ' + str(e))
+
+    _replica_state['checked_at'] = now
+    _replica_state['lag'] = lag
+    return lag
+
+
+def get_connection(readonly=False):
+    '''
+    Returns:
+        tuple: (connection, route). Read only work goes to the replica when one
+               is configured, reachable and within MAX_REPLICA_LAG.
+    '''
+    if readonly and DATABASE_REPLICA_URL:
+        lag = replica_lag()
+        if lag is not None and lag <= MAX_REPLICA_LAG:
+            try:
+                return _connect(DATABASE_REPLICA_URL), ROUTE_REPLICA
+            except Exception as e:
+                log.log_error('replica connection failed: ' + str(e))
+        return _connect(DATABASE_URL), ROUTE_FALLBACK
+    return _connect(DATABASE_URL), ROUTE_PRIMARY
+
+
+# Holds the cursor of the batch transaction open on this thread, and the
+# changes to shared rows it has queued, see batch() and _defer()
+_batch = threading.local()
+
+
+def _cursor_decorator(readonly):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cursor = getattr(_batch, 'cursor', None)
+            if cursor is not None and not readonly:
+                return func(cursor, *args, **kwargs)
+            conn, route = get_connection(readonly)
+            start = time.time()
+            try:
+                cursor = conn.cursor()
+                ret_val = func(cursor, *args, **kwargs)
+                conn.commit()
+            except Exception:
+                # Never commit half of a function's writes
+                conn.rollback()
+                _record(route, time.time() - start, error=True)
+                raise
+            finally:
+                conn.close()
+            _record(route, time.time() - start)
+            return ret_val
+        return wrapper
+    return decorator
+
+
+# Reads and writes against the primary
+psycopg2_cur = _cursor_decorator(readonly=False)
+# Reads that tolerate replica lag, i.e. analytics
+psycopg2_read_cur = _cursor_decorator(readonly=True)
+
+
+@contextmanager
+def batch():
+    '''
+    Runs every primary database call made on this thread inside a single
+    transaction, committed when the block exits without an exception.
+    Changes queued with _defer() are applied just before the commit.
+    '''
+    conn, route = get_connection()
+    start = time.time()
+    _batch.cursor = conn.cursor()
+    _batch.pending = []
+    try:
+        yield _batch.cursor
+        _apply_pending(_batch.cursor, _batch.pending)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _record(route, time.time() - start, error=True)
+        raise
+    finally:
+        _batch.cursor = None
+        _batch.pending = None
+        conn.close()
+    _record(route, time.time() - start)
+
+
+def in_batch():
+    return getattr(_batch, 'cursor', None) is not None
+
+
+@contextmanager
+def savepoint(name='handler'):
+    '''
+    Undoes just the block's writes and deferred changes if it raises,
+    leaving the rest of the batch transaction intact
+    '''
+    from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+    cursor = _batch.cursor
+    queued = len(_batch.pending)
+    cursor.execute('SAVEPOINT ' + name)
+    try:
+        yield
+        if cursor.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            # A statement failed inside code that caught the error itself
+            raise RuntimeError('statement failed inside savepoint ' + name)
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT ' + name)
+        del _batch.pending[queued:]
+        raise
+    cursor.execute('RELEASE SAVEPOINT ' + name)
+
+
+def is_transient(error):
+    ''' True for connection level errors, which say nothing about the event being handled '''
+    import psycopg2
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def stream(query, args=None, batch_size=2000, readonly=True):
+    '''
+    Runs a read query on a server side cursor and yields rows as they're
+    fetched, so large results never sit in memory all at once
+    '''
+    conn, route = get_connection(readonly)
+    start = time.time()
+    try:
+        cursor = conn.cursor(name='stream_%d' % id(conn))
+        cursor.itersize = batch_size
+        cursor.execute(query, args)
+        for row in cursor:
+            yield row
+    finally:
+        conn.close()
+        _record(route, time.time() - start)
+
+
+@psycopg2_cur
+def create_tables(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    for table, index, columns in UNIQUE_KEYS:
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', (index, ))
+        if cursor.fetchone():
+            continue
+        _merge_duplicates(cursor, table, columns)
+        cursor.execute('CREATE UNIQUE INDEX {index} ON {table} ({columns})'
+                       .format(index=index, table=table, columns=', '.join(columns)))
+
+
+def _merge_duplicates(cursor, table, columns):
+    ''' Folds rows sharing a key into the first of them, summing their Counts if they have one '''
+    key = ', '.join(columns)
+    if table == 'Messages':
+        # Each copy was counted into the text aggregates, so they're no
+        # longer known complete until recompute.py --write rebuilds them
+        cursor.execute('''UPDATE AggregateState SET TextCountsRebuiltAt = NULL WHERE TeamID IN (
+                              SELECT TeamID FROM Messages GROUP BY TeamID, MessageID HAVING count(*) > 1)''')
+    else:
+        _sum_duplicates(cursor, table, key)
+    cursor.execute('''DELETE FROM {table} WHERE ctid IN (
+                          SELECT RowID FROM (
+                              SELECT ctid AS RowID, row_number() OVER (PARTITION BY {key} ORDER BY ctid) AS Rank
+                              FROM {table}) AS Ranked
+                          WHERE Rank > 1)'''.format(table=table, key=key))
+
+
+def _sum_duplicates(cursor, table, key):
+    cursor.execute('''WITH Ranked AS (
+                          SELECT ctid AS RowID,
+                                 row_number() OVER (PARTITION BY {key} ORDER BY ctid) AS Rank,
+                                 count(*) OVER (PARTITION BY {key}) AS Copies,
+                                 sum(Count) OVER (PARTITION BY {key}) AS Total
+                          FROM {table})
+                      UPDATE {table} SET Count = Ranked.Total FROM Ranked
+                      WHERE {table}.ctid = Ranked.RowID AND Ranked.Rank = 1 AND Ranked.Copies > 1'''
+                   .format(table=table, key=key))
+
+
+@psycopg2_cur
+def save_team(cursor, team_id, bot_user_id, bot_token, access_token):
+    cursor.execute('''INSERT INTO Teams (TeamID, BotUserID, BotToken, AccessToken)
+                      VALUES (%s, %s, %s, %s)
+                      ON CONFLICT (TeamID) DO UPDATE
+                      SET BotUserID = EXCLUDED.BotUserID,
+                          BotToken = EXCLUDED.BotToken,
+                          AccessToken = EXCLUDED.AccessToken''',
+                   (team_id, bot_user_id, bot_token, access_token))
+
+
+@psycopg2_cur
+def get_team(cursor, team_id):
+    cursor.execute('SELECT TeamID, BotUserID, BotToken, AccessToken FROM Teams WHERE TeamID = %s',
+                   (team_id, ))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {'team_id': row[0], 'bot_user_id': row[1], 'bot_token': row[2], 'access_token': row[3]}
+
+
+@psycopg2_cur
+def team_count(cursor):
+    cursor.execute('SELECT count(*) FROM Teams')
+    return cursor.fetchone()[0]
 
 
 @psycopg2_cur
-def remove_message(cursor, msg):
-    query = 'DELETE FROM MESSAGES WHERE MessageID = %s'
-    cursor.execute(query, (msg.msg_id,))
+def claim_unscoped_rows(cursor, team_id):
+    '''
+    Assigns rows written before installs were tracked per team (TeamID empty
+    or NULL) to the given team
+    '''
+    for table in ('Messages', 'MessageReacts', 'UserReacts'):
+        cursor.execute("UPDATE " + table + " SET TeamID = %s WHERE TeamID IS NULL OR TeamID = ''",
+                       (team_id, ))
+
+
+@psycopg2_cur
+def get_emoji(cursor, team_id):
+    '''
+    Returns:
+        tuple: (whether emoji.list has been stored for the team,
+                dict of emoji name -> name it's an alias for, or None)
+    '''
+    cursor.execute('SELECT 1 FROM EmojiSync WHERE TeamID = %s', (team_id, ))
+    synced = cursor.fetchone() is not None
+    cursor.execute('SELECT Name, AliasFor FROM Emoji WHERE TeamID = %s', (team_id, ))
+    return synced, dict(cursor.fetchall())
+
+
+@psycopg2_cur
+def replace_emoji(cursor, team_id, emoji):
+    '''
+    Args:
+        emoji (dict) : name -> (alias for, image URL)
+    '''
+    cursor.execute('DELETE FROM Emoji WHERE TeamID = %s', (team_id, ))
+    cursor.execute('''INSERT INTO EmojiSync (TeamID) VALUES (%s)
+                      ON CONFLICT (TeamID) DO UPDATE SET SyncedAt = now()''', (team_id, ))
+    if not emoji:
+        return
+    from psycopg2.extras import execute_values
+    execute_values(cursor, 'INSERT INTO Emoji (TeamID, Name, AliasFor, URL) VALUES %s',
+                   [(team_id, name, alias, url) for name, (alias, url) in sorted(emoji.items())])
+
+
+@psycopg2_cur
+def add_emoji(cursor, team_id, name, alias_for, url):
+    cursor.execute('''INSERT INTO Emoji (TeamID, Name, AliasFor, URL) VALUES (%s, %s, %s, %s)
+                      ON CONFLICT (TeamID, Name) DO UPDATE
+                      SET AliasFor = EXCLUDED.AliasFor, URL = EXCLUDED.URL''',
+                   (team_id, name, alias_for, url))
+
+
+@psycopg2_cur
+def remove_emoji(cursor, team_id, names):
+    cursor.execute('DELETE FROM Emoji WHERE TeamID = %s AND Name = ANY(%s)', (team_id, list(names)))
+
+
+@psycopg2_cur
+def rename_emoji(cursor, team_id, old_name, new_name):
+    cursor.execute('UPDATE Emoji SET Name = %s WHERE TeamID = %s AND Name = %s',
+                   (new_name, team_id, old_name))
+    cursor.execute('UPDATE Emoji SET AliasFor = %s WHERE TeamID = %s AND AliasFor = %s',
+                   (new_name, team_id, old_name))
+
+
+def _apply_deltas(cursor, table, column, team_id, deltas):
+    ''' Adds deltas to a (TeamID, key) -> Count table, dropping rows that reach zero '''
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    from psycopg2.extras import execute_values
+    # Sorted so concurrent writers lock rows in the same order
+    rows = [(team_id, key, deltas[key]) for key in sorted(deltas)]
+    execute_values(cursor,
+                   'INSERT INTO {table} (TeamID, {column}, Count) VALUES %s '
+                   'ON CONFLICT (TeamID, {column}) DO UPDATE '
+                   'SET Count = {table}.Count + EXCLUDED.Count'.format(table=table, column=column),
+                   rows)
+    cursor.execute('DELETE FROM {table} WHERE TeamID = %s AND {column} = ANY(%s) AND Count <= 0'
+                   .format(table=table, column=column), (team_id, sorted(deltas)))
+
+
+def _apply_text_counts(cursor, team_id, words, phrases, sign=1):
+    _defer(cursor, [(WORD_COUNTS, (team_id, word), sign * count) for word, count in words.items()] +
+           [(PHRASE_COUNTS, (team_id, phrase), sign * count) for phrase, count in phrases.items()])
+
+
+def _text_deltas(old, new):
+    delta = Counter(new)
+    delta.subtract(old)
+    return delta
+
+
+@psycopg2_cur
+def delete_message(cursor, team_id, msg_id, text_counts=None):
+    '''
+    Deletes a message and takes everything derived from it back out of the
+    aggregates in a single transaction
+
+    Args:
+        team_id     (str)      : Slack team ID
+        msg_id      (str)      : Message ID
+        text_counts (function) : Maps message text to (word Counter, phrase Counter)
+
+    Returns:
+        bool: whether the message was stored
+    '''
+    cursor.execute('DELETE FROM Messages WHERE TeamID = %s AND MessageID = %s RETURNING MessageText',
+                   (team_id, msg_id))
+    texts = [row[0] for row in cursor.fetchall()]
+    if text_counts:
+        for text in texts:
+            words, phrases = text_counts(text)
+            _apply_text_counts(cursor, team_id, words, phrases, -1)
+
+    cursor.execute('''DELETE FROM Reactions WHERE TeamID = %s AND MessageID = %s
+                      RETURNING UserID, ReactName''', (team_id, msg_id))
+    user_reacts = Counter(cursor.fetchall())
+    # Its MessageReacts rows go when the deferred changes are applied, along
+    # with any counts queued for it earlier in the batch
+    _defer(cursor, [(MESSAGE_DELETED, (team_id, msg_id), 1)] +
+           [(USER_REACTS, (team_id, user_id, react_name), -count)
+            for (user_id, react_name), count in user_reacts.items()] +
+           [(REACTIONS, (team_id, msg_id, react_name), -count)
+            for (_, react_name), count in user_reacts.items()])
+    return bool(texts)
+
+
+@psycopg2_cur
+def edit_message(cursor, msg, text_counts=None):
+    '''
+    Replaces a message's text and applies the difference between the old and
+    new text to the aggregates in a single transaction
+    '''
+    cursor.execute('''SELECT MessageText FROM Messages WHERE TeamID = %s AND MessageID = %s
+                      FOR UPDATE''', (msg.team_id, msg.msg_id))
+    row = cursor.fetchone()
+    if row is None:
+        # Edit of a message we never saw posted, store it as new
+        _insert_message(cursor, msg, text_counts)
+        return
+
+    old_text = row[0]
+    if old_text == msg.text:
+        return
+
+    cursor.execute('UPDATE Messages SET MessageText = %s WHERE TeamID = %s AND MessageID = %s',
+                   (msg.text, msg.team_id, msg.msg_id))
+    if text_counts:
+        old_words, old_phrases = text_counts(old_text)
+        new_words, new_phrases = text_counts(msg.text)
+        _apply_text_counts(cursor, msg.team_id, _text_deltas(old_words, new_words),
+                           _text_deltas(old_phrases, new_phrases))
+
+
+@psycopg2_cur
+def replace_text_counts(cursor, team_id, words, phrases):
+    ''' Replaces a team's text aggregates with freshly recomputed counts '''
+    cursor.execute('DELETE FROM WordCounts WHERE TeamID = %s', (team_id, ))
+    cursor.execute('DELETE FROM PhraseCounts WHERE TeamID = %s', (team_id, ))
+    _apply_text_counts(cursor, team_id, words, phrases)
+    cursor.execute('''INSERT INTO AggregateState (TeamID, TextCountsRebuiltAt) VALUES (%s, now())
+                      ON CONFLICT (TeamID) DO UPDATE SET TextCountsRebuiltAt = EXCLUDED.TextCountsRebuiltAt''',
+                   (team_id, ))
+
+
+@psycopg2_cur
+def mark_text_counts_complete(cursor, team_id):
+    ''' Marks a team's text aggregates complete if it has no messages stored yet '''
+    cursor.execute('''INSERT INTO AggregateState (TeamID, TextCountsRebuiltAt)
+                      SELECT %s, now() WHERE NOT EXISTS (SELECT 1 FROM Messages WHERE TeamID = %s)
+                      ON CONFLICT (TeamID) DO NOTHING''', (team_id, team_id))
+
+
+@psycopg2_read_cur
+def get_team_stats(cursor, team_id):
+    '''
+    Returns:
+        dict: messages stored for the team and when its text aggregates were
+              last known complete, or None
+    '''
+    cursor.execute('SELECT count(*) FROM Messages WHERE TeamID = %s', (team_id, ))
+    messages = cursor.fetchone()[0]
+    cursor.execute('SELECT TextCountsRebuiltAt FROM AggregateState WHERE TeamID = %s', (team_id, ))
+    row = cursor.fetchone()
+    return {'messages': messages, 'text_counts_rebuilt_at': row[0] if row else None}
+
+
+@psycopg2_read_cur
+def get_top_phrases(cursor, team_id, limit, offset=0):
+    cursor.execute('''SELECT Phrase, Count FROM PhraseCounts WHERE TeamID = %s AND Count > 0
+                      ORDER BY Count DESC, Phrase LIMIT %s OFFSET %s''', (team_id, limit, offset))
+    return cursor.fetchall()
+
+
+def _insert_message(cursor, msg, text_counts=None):
+    ''' Inserts a message unless it's already stored. Returns True if it was inserted. '''
+    # Two writers can store the same message at once, e.g. a Slack retry or
+    # an entry claimed while its first writer is still busy. The unique key
+    # makes the second wait for the first and then insert nothing.
+    cursor.execute('''INSERT INTO Messages (MessageID, TeamID, UserID, MessageText)
+                      VALUES (%s, %s, %s, %s) ON CONFLICT (TeamID, MessageID) DO NOTHING''',
+                   (msg.msg_id, msg.team_id, msg.user_id, msg.text))
+    inserted = cursor.rowcount == 1
+    if inserted and text_counts and msg.text:
+        words, phrases = text_counts(msg.text)
+        _apply_text_counts(cursor, msg.team_id, words, phrases)
+    return inserted
 
 
 @psycopg2_cur
 def add_messages(cursor, msgs):
     for m in msgs:
-        if not msg_exists(m.msg_id):
+        if not msg_exists(m.team_id, m.msg_id):
             try:
                 msg_tuple = (m.msg_id, m.team_id, m.user_id, m.text)
                 cursor.execute(
-                    'INSERT INTO Messages VALUES (%s, %s, %s, %s);', msg_tuple)
+                    '''INSERT INTO Messages (MessageID, TeamID, UserID, MessageText) VALUES (%s, %s, %s, %s)
+                       ON CONFLICT (TeamID, MessageID) DO NOTHING''',
+                    msg_tuple)
             except Exception as e:
-                log.log_error(e.message)
+                log.log_error(str(e))
 
 
 @psycopg2_cur
-def add_message(cursor, msg):
+def add_message(cursor, msg, text_counts=None):
     try:
-        cursor.execute('INSERT INTO Messages VALUES (%s, %s, %s, %s);',
-                       (msg.msg_id, msg.team_id, msg.user_id, msg.text))
+        _insert_message(cursor, msg, text_counts)
     except Exception as e:
         print(e)
         print(traceback.print_exc())
@@ -63,35 +673,247 @@ def add_reacts(cursor, reacts):
 
 @psycopg2_cur
 def add_react(cursor, react):
-    _add_react(cursor, react.msg_id, react.team_id,
-               react.user_id, react.react_name)
+    return _add_react(cursor, react.msg_id, react.team_id,
+                      react.user_id, react.react_name)
 
 
 def _add_react(cursor, msg_id, team_id, user_id, react_name):
+    ''' Returns True if this is the first time the react was added to the message '''
+    first_on_message = False
     try:
-        if _exists_in_message_reacts(cursor, msg_id, react_name):
-            query = ('''UPDATE MessageReacts
-                    SET Count = Count + 1
-                    WHERE MessageReacts.MessageID = %s
-                    AND MessageReacts.ReactName = %s''')
-            cursor.execute(query, (msg_id, react_name))
-        else:
-            cursor.execute(
-                'INSERT INTO MessageReacts VALUES(%s, %s, 1);', (msg_id, react_name))
-
-        if _exists_in_user_reacts(cursor, user_id, react_name):
-            cursor.execute('''UPDATE UserReacts
-                    SET Count = Count + 1
-                    WHERE UserReacts.UserID = %s
-                    AND UserReacts.TeamID = %s
-                    AND UserReacts.ReactName = %s''',
-                           (user_id, team_id, react_name))
-        else:
-            cursor.execute(
-                'INSERT INTO UserReacts VALUES(%s, %s, %s, 1);', (user_id, team_id, react_name))
+        # The count rows are the ones every writer on a busy message wants,
+        # so they're written once per batch, see _apply_pending
+        _defer(cursor, [(MESSAGE_REACTS, (team_id, msg_id, react_name), 1),
+                        (USER_REACTS, (team_id, user_id, react_name), 1)])
+        _insert_reaction(cursor, team_id, msg_id, user_id, react_name)
+        first_on_message = _reacted_count(cursor, team_id, msg_id, react_name) == 1
     except Exception as e:
         print(e)
         print(traceback.print_exc())
+    return first_on_message
+
+
+@psycopg2_cur
+def record_reaction(cursor, react):
+    '''
+    Stores who reacted with what without touching the counts, for when the
+    count increments are buffered and applied later by apply_react_deltas
+
+    Returns:
+        bool: True if no one else has this react on the message, as far as
+              this transaction can see. Only used for the approximate sketches,
+              ReactPairs doesn't depend on it.
+    '''
+    _insert_reaction(cursor, react.team_id, react.msg_id, react.user_id, react.react_name)
+    return _reacted_count(cursor, react.team_id, react.msg_id, react.react_name) == 1
+
+
+def _insert_reaction(cursor, team_id, msg_id, user_id, react_name):
+    cursor.execute('''INSERT INTO Reactions (TeamID, MessageID, UserID, ReactName)
+                      VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING''',
+                   (team_id, msg_id, user_id, react_name))
+    _defer(cursor, [(REACTIONS, (team_id, msg_id, react_name), cursor.rowcount)])
+
+
+@psycopg2_cur
+def remove_reaction(cursor, react):
+    _delete_reaction(cursor, react.team_id, react.msg_id, react.user_id, react.react_name)
+
+
+def _delete_reaction(cursor, team_id, msg_id, user_id, react_name):
+    cursor.execute('''DELETE FROM Reactions WHERE TeamID = %s AND MessageID = %s
+                      AND UserID = %s AND ReactName = %s''',
+                   (team_id, msg_id, user_id, react_name))
+    _defer(cursor, [(REACTIONS, (team_id, msg_id, react_name), -cursor.rowcount)])
+
+
+def _defer(cursor, changes):
+    '''
+    Queues (kind, key, delta) changes to rows that many writers update. In a
+    batch() they're applied together just before it commits, so busy rows
+    are locked once per batch and only until the commit. Otherwise they're
+    applied right away.
+    '''
+    changes = [change for change in changes if change[2]]
+    if getattr(_batch, 'cursor', None) is cursor:
+        _batch.pending.extend(changes)
+    elif changes:
+        _apply_pending(cursor, changes)
+
+
+def _apply_pending(cursor, pending):
+    '''
+    Applies deferred changes, summed per row. Every writer takes its locks
+    in the same order, messages, then MessageReacts, UserReacts, ReactPairs,
+    WordCounts and PhraseCounts rows, each sorted, so two batches finishing
+    at once queue up behind each other rather than deadlocking.
+    '''
+    reactions = defaultdict(Counter)
+    counts = defaultdict(Counter)
+    deleted = set()
+    for kind, key, delta in pending:
+        if kind == REACTIONS:
+            reactions[key[:2]][key[2]] += delta
+        elif kind == MESSAGE_DELETED:
+            deleted.add(key)
+            # Counts queued before the delete would bring its rows back
+            for react in [k for k in counts[MESSAGE_REACTS] if k[:2] == key]:
+                del counts[MESSAGE_REACTS][react]
+        else:
+            counts[kind][key] += delta
+
+    # MessageReacts rows are only written under their message's lock
+    _lock_messages(cursor, set(reactions) | deleted | {key[:2] for key in counts[MESSAGE_REACTS]})
+    pair_deltas = defaultdict(Counter)
+    for team_id, msg_id in sorted(reactions):
+        pair_deltas[team_id].update(_pair_changes(cursor, team_id, msg_id, reactions[(team_id, msg_id)]))
+    for team_id, msg_id in sorted(deleted):
+        cursor.execute('DELETE FROM MessageReacts WHERE TeamID = %s AND MessageID = %s', (team_id, msg_id))
+
+    _upsert_react_counts(cursor, 'MessageReacts', 'MessageID', counts[MESSAGE_REACTS])
+    _upsert_react_counts(cursor, 'UserReacts', 'UserID', counts[USER_REACTS])
+    for team_id in sorted(pair_deltas):
+        _apply_pair_deltas(cursor, team_id, pair_deltas[team_id])
+    for kind, column in ((WORD_COUNTS, 'Word'), (PHRASE_COUNTS, 'Phrase')):
+        by_team = defaultdict(dict)
+        for (team_id, key), delta in counts[kind].items():
+            by_team[team_id][key] = delta
+        for team_id in sorted(by_team):
+            _apply_deltas(cursor, kind, column, team_id, by_team[team_id])
+
+
+def _upsert_react_counts(cursor, table, column, deltas):
+    ''' Adds deltas keyed by (TeamID, column, ReactName) to a react count table '''
+    from psycopg2.extras import execute_values
+    # Sorted so concurrent writers lock rows in the same order
+    rows = [key + (delta, ) for key, delta in sorted(deltas.items()) if delta]
+    if rows:
+        execute_values(cursor,
+                       '''INSERT INTO {table} (TeamID, {column}, ReactName, Count) VALUES %s
+                          ON CONFLICT (TeamID, {column}, ReactName)
+                          DO UPDATE SET Count = {table}.Count + EXCLUDED.Count'''
+                       .format(table=table, column=column), rows)
+
+
+def _lock_messages(cursor, messages):
+    '''
+    Serializes changes to the messages' MessageReacts and ReactPairs rows
+    until the transaction ends. Which reacts a message gains or loses is
+    decided by reading its Reactions, and under READ COMMITTED another
+    writer's uncommitted rows are invisible, so two writers adding different
+    reacts would each miss the other's. Holding the lock, a writer sees
+    every earlier holder's committed rows.
+    '''
+    if not messages:
+        return
+    messages = sorted(messages)
+    cursor.execute('''SELECT pg_advisory_xact_lock(hashtext(TeamID), hashtext(MessageID))
+                      FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS Locks (TeamID, MessageID, Position)
+                      ORDER BY Position''',
+                   ([team_id for team_id, _ in messages], [msg_id for _, msg_id in messages]))
+
+
+def _reacted_count(cursor, team_id, msg_id, react_name):
+    ''' Number of users with react_name on the message '''
+    cursor.execute('''SELECT count(*) FROM Reactions
+                      WHERE TeamID = %s AND MessageID = %s AND ReactName = %s''',
+                   (team_id, msg_id, react_name))
+    return cursor.fetchone()[0]
+
+
+def _pair_changes(cursor, team_id, msg_id, changed):
+    '''
+    Args:
+        changed (Counter) : react name -> Reactions rows this transaction
+                            added to the message, less those it removed
+
+    Returns:
+        Counter: (ReactA, ReactB) -> change in ReactPairs for the reacts the
+                 message gained or lost
+    '''
+    cursor.execute('''SELECT ReactName, count(*) FROM Reactions
+                      WHERE TeamID = %s AND MessageID = %s GROUP BY ReactName''', (team_id, msg_id))
+    users = dict(cursor.fetchall())
+    after = set(users)
+    before = {react_name for react_name in after | set(changed)
+              if users.get(react_name, 0) - changed[react_name] > 0}
+
+    gained = after - before
+    lost = before - after
+    deltas = Counter()
+    for pair in combinations(sorted(after), 2):
+        if gained.intersection(pair):
+            deltas[pair] += 1
+    for pair in combinations(sorted(before), 2):
+        if lost.intersection(pair):
+            deltas[pair] -= 1
+    return deltas
+
+
+def _apply_pair_deltas(cursor, team_id, deltas):
+    ''' Adds deltas to ReactPairs, keyed by (ReactA, ReactB) with ReactA < ReactB '''
+    deltas = {pair: delta for pair, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    from psycopg2.extras import execute_values
+    rows = [(team_id, a, b, deltas[(a, b)]) for a, b in sorted(deltas)]
+    execute_values(cursor,
+                   '''INSERT INTO ReactPairs (TeamID, ReactA, ReactB, Count) VALUES %s
+                      ON CONFLICT (TeamID, ReactA, ReactB) DO UPDATE
+                      SET Count = ReactPairs.Count + EXCLUDED.Count''', rows)
+    cursor.execute('''DELETE FROM ReactPairs WHERE TeamID = %s AND Count <= 0
+                      AND (ReactA, ReactB) IN (SELECT * FROM unnest(%s::text[], %s::text[]))''',
+                   (team_id, [a for a, _ in sorted(deltas)], [b for _, b in sorted(deltas)]))
+
+
+@psycopg2_cur
+def rebuild_react_pairs(cursor, team_id):
+    '''
+    Recounts a team's ReactPairs from Reactions with a self join, counting
+    a react as on a message while anyone's reaction with it is stored, the
+    same way the incremental updates do. Only for backfilling, they keep it
+    current afterwards.
+    '''
+    cursor.execute('DELETE FROM ReactPairs WHERE TeamID = %s', (team_id, ))
+    cursor.execute('''WITH Reacted AS (SELECT DISTINCT MessageID, ReactName FROM Reactions
+                                         WHERE TeamID = %s)
+                      INSERT INTO ReactPairs (TeamID, ReactA, ReactB, Count)
+                      SELECT %s, a.ReactName, b.ReactName, count(*) FROM Reacted a
+                      INNER JOIN Reacted b ON b.MessageID = a.MessageID AND a.ReactName < b.ReactName
+                      GROUP BY a.ReactName, b.ReactName''', (team_id, team_id))
+
+
+@psycopg2_read_cur
+def get_react_pairs(cursor, team_id, react_name, limit, offset=0):
+    '''
+    Returns:
+        list: (other react, messages with both) for the reacts seen most often
+              on the same messages as react_name
+    '''
+    cursor.execute('''SELECT Other, Count FROM (
+                          (SELECT ReactB AS Other, Count FROM ReactPairs
+                           WHERE TeamID = %s AND ReactA = %s ORDER BY Count DESC LIMIT %s)
+                          UNION ALL
+                          (SELECT ReactA AS Other, Count FROM ReactPairs
+                           WHERE TeamID = %s AND ReactB = %s ORDER BY Count DESC LIMIT %s)) AS Neighbours
+                      ORDER BY Count DESC, Other LIMIT %s OFFSET %s''',
+                   (team_id, react_name, limit + offset, team_id, react_name, limit + offset,
+                    limit, offset))
+    return cursor.fetchall()
+
+
+@psycopg2_cur
+def apply_react_deltas(cursor, message_deltas, user_deltas):
+    '''
+    Adds buffered react count changes, one upsert per row however many
+    events went into each delta
+
+    Args:
+        message_deltas (dict) : (team_id, msg_id, react_name) -> change in count
+        user_deltas    (dict) : (team_id, user_id, react_name) -> change in count
+    '''
+    _apply_pending(cursor, [(MESSAGE_REACTS, key, delta) for key, delta in message_deltas.items()] +
+                   [(USER_REACTS, key, delta) for key, delta in user_deltas.items()])
 
 
 @psycopg2_cur
@@ -99,46 +921,17 @@ def remove_react(cursor, react):
     log.log_info('remove_react')
 
     try:
-        cursor.execute('''UPDATE MessageReacts
-                SET Count = Count - 1
-                WHERE MessageReacts.MessageID = %s
-                AND MessageReacts.ReactName = %s''', (react.msg_id, react.react_name))
+        _defer(cursor, [(MESSAGE_REACTS, (react.team_id, react.msg_id, react.react_name), -1),
+                        (USER_REACTS, (react.team_id, react.user_id, react.react_name), -1)])
+        _delete_reaction(cursor, react.team_id, react.msg_id, react.user_id, react.react_name)
     except Exception as e:
         print(e)
         print(traceback.print_exc())
 
-    try:
-        cursor.execute('''
-              UPDATE UserReacts
-              SET Count = Count - 1
-              WHERE UserReacts.UserID = %s AND UserReacts.ReactName = %s''', (react.user_id, react.react_name))
-    except Exception as e:
-        print(e)
-        print(traceback.print_exc())
-
-
-def _exists_in_message_reacts(cursor, msg_id, react_name):
-    cursor.execute("SELECT * FROM MessageReacts WHERE MessageReacts.MessageID = %s AND MessageReacts.ReactName = %s",
-                   (msg_id, react_name))
-    result = cursor.fetchone()
-    if not result:
-        return False
-    return True
-
-
-def _exists_in_user_reacts(cursor, user_id, react_name):
-    cursor.execute(
-        "SELECT * FROM UserReacts WHERE UserReacts.UserID = %s AND UserReacts.ReactName = %s",
-        (user_id, react_name))
-    result = cursor.fetchone()
-    if not result:
-        return False
-    return True
-
 
 @psycopg2_cur
-def msg_exists(cursor, msg_id):
-    cursor.execute('SELECT * FROM Messages WHERE MessageID = %s', (msg_id,))
+def msg_exists(cursor, team_id, msg_id):
+    cursor.execute('SELECT * FROM Messages WHERE TeamID = %s AND MessageID = %s', (team_id, msg_id))
     row = cursor.fetchone()
     exists = False
     if row:
@@ -146,13 +939,14 @@ def msg_exists(cursor, msg_id):
     return exists
 
 
-@psycopg2_cur
-def get_reacts_on_user(cursor, user_id):
-    msgs = get_messages_by_user(user_id)
-    msgs = [(m,) for m in msgs]
-
-    cursor.executemany(
-        "SELECT ReactName, sum(MessageReacts.Count) FROM MessageReacts WHERE MessageID = %s GROUP BY ReactName", msgs)
+@psycopg2_read_cur
+def get_reacts_on_user(cursor, team_id, user_id):
+    cursor.execute('''
+        SELECT MessageReacts.ReactName, sum(MessageReacts.Count) FROM MessageReacts
+        INNER JOIN Messages ON Messages.TeamID = MessageReacts.TeamID
+            AND Messages.MessageID = MessageReacts.MessageID
+        WHERE Messages.TeamID = %s AND Messages.UserID = %s
+        GROUP BY MessageReacts.ReactName''', (team_id, user_id))
     row = cursor.fetchone()
     reacts = {}
     while row:
@@ -161,21 +955,26 @@ def get_reacts_on_user(cursor, user_id):
     return reacts
 
 
-@psycopg2_cur
-def get_reacts_by_user(cursor, user_id):
+@psycopg2_read_cur
+def get_reacts_by_user(cursor, team_id, user_id, limit=None, offset=0):
     cursor.execute(
-        "SELECT UserReacts.ReactName, UserReacts.Count FROM UserReacts WHERE UserReacts.UserID = %s", (user_id, ))
+        '''SELECT UserReacts.ReactName, UserReacts.Count FROM UserReacts
+           WHERE UserReacts.TeamID = %s AND UserReacts.UserID = %s AND UserReacts.Count > 0
+           ORDER BY UserReacts.Count DESC, UserReacts.ReactName
+           LIMIT %s OFFSET %s''', (team_id, user_id, limit, offset))
     row = cursor.fetchone()
     reacts = {}
     while row:
         reacts[row[0]] = row[1]
-        row = c.fetchone()
+        row = cursor.fetchone()
     return reacts
 
 
-@psycopg2_cur
-def get_react_usage_totals(cursor):
-    cursor.execute('SELECT UserID, sum(Count) FROM UserReacts GROUP BY UserID')
+@psycopg2_read_cur
+def get_react_usage_totals(cursor, team_id, limit=None, offset=0):
+    cursor.execute('''SELECT UserID, sum(Count) FROM UserReacts WHERE TeamID = %s
+                      GROUP BY UserID ORDER BY sum(Count) DESC, UserID
+                      LIMIT %s OFFSET %s''', (team_id, limit, offset))
     users = {}
     row = cursor.fetchone()
     while row:
@@ -184,11 +983,43 @@ def get_react_usage_totals(cursor):
     return users
 
 
-@psycopg2_cur
-def get_reacts_on_message(cursor, msg_id, conn=None):
+@psycopg2_read_cur
+def get_most_active_users(cursor, team_id, limit, offset=0):
+    '''
+    Returns:
+        list: (user ID, messages posted) for the users who posted the most
+    '''
+    cursor.execute('''SELECT UserID, count(*) FROM Messages WHERE TeamID = %s
+                      GROUP BY UserID ORDER BY count(*) DESC, UserID
+                      LIMIT %s OFFSET %s''', (team_id, limit, offset))
+    return cursor.fetchall()
+
+
+@psycopg2_read_cur
+def get_top_reacts_by_users(cursor, team_id, user_ids, per_user):
+    '''
+    Returns:
+        dict: user ID -> {react name: count} of each user's per_user most used reacts
+    '''
+    cursor.execute('''SELECT UserID, ReactName, Count FROM (
+                          SELECT UserID, ReactName, Count, ROW_NUMBER() OVER (
+                              PARTITION BY UserID ORDER BY Count DESC, ReactName) AS Rank
+                          FROM UserReacts
+                          WHERE TeamID = %s AND UserID = ANY(%s) AND Count > 0) AS Ranked
+                      WHERE Rank <= %s ORDER BY UserID, Rank''', (team_id, list(user_ids), per_user))
+    reacts = {}
+    row = cursor.fetchone()
+    while row:
+        reacts.setdefault(row[0], {})[row[1]] = row[2]
+        row = cursor.fetchone()
+    return reacts
+
+
+@psycopg2_read_cur
+def get_reacts_on_message(cursor, team_id, msg_id):
     cursor.execute(
-        "SELECT ReactName, Count FROM MessageReacts WHERE MessageID = %s", (
-            msg_id, ))
+        "SELECT ReactName, Count FROM MessageReacts WHERE TeamID = %s AND MessageID = %s", (
+            team_id, msg_id))
     row = cursor.fetchone()
     reacts = {}
     while row:
@@ -197,10 +1028,11 @@ def get_reacts_on_message(cursor, msg_id, conn=None):
     return reacts
 
 
-@psycopg2_cur
-def get_reacts_on_all_messages(cursor):
+@psycopg2_read_cur
+def get_reacts_on_all_messages(cursor, team_id):
     cursor.execute(
-        "SELECT MessageReacts.MessageID, MessageReacts.ReactName, MessageReacts.Count FROM MessageReacts")
+        '''SELECT MessageReacts.MessageID, MessageReacts.ReactName, MessageReacts.Count
+           FROM MessageReacts WHERE MessageReacts.TeamID = %s''', (team_id, ))
     row = cursor.fetchone()
     reacts = {}
     while row:
@@ -214,10 +1046,11 @@ def get_reacts_on_all_messages(cursor):
     return reacts
 
 
-@psycopg2_cur
-def get_messages_by_user(cursor, user_id):
+@psycopg2_read_cur
+def get_messages_by_user(cursor, team_id, user_id):
     cursor.execute(
-        "SELECT MessageID FROM Messages WHERE Messages.UserID = %s", (user_id,))
+        "SELECT MessageID FROM Messages WHERE Messages.TeamID = %s AND Messages.UserID = %s",
+        (team_id, user_id))
     row = cursor.fetchone()
     msgs = []
     while row:
@@ -226,10 +1059,10 @@ def get_messages_by_user(cursor, user_id):
     return msgs
 
 
-@psycopg2_cur
+@psycopg2_read_cur
 def get_message_text(cursor, team_id, msg_id):
-    query = "SELECT MessageText FROM Messages WHERE Messages.MessageID = %s"
-    cursor.execute(query, (msg_id, ))
+    query = "SELECT MessageText FROM Messages WHERE Messages.TeamID = %s AND Messages.MessageID = %s"
+    cursor.execute(query, (team_id, msg_id))
     result = cursor.fetchone()
     if not result:
         return ''
@@ -238,9 +1071,9 @@ def get_message_text(cursor, team_id, msg_id):
     return text
 
 
-@psycopg2_cur
-def get_all_message_texts(cursor):
-    cursor.execute('SELECT MessageText from Messages')
+@psycopg2_read_cur
+def get_all_message_texts(cursor, team_id):
+    cursor.execute('SELECT MessageText from Messages WHERE TeamID = %s ORDER BY MessageID', (team_id, ))
     row = cursor.fetchone()
     texts = []
     while row:
@@ -249,20 +1082,69 @@ def get_all_message_texts(cursor):
     return texts
 
 
-@psycopg2_cur
-def get_message_text_from_ids(cursor, msg_ids):
-    query = "SELECT MessageText FROM Messages WHERE Messages.MessageID = %s"
+def iter_message_texts(team_id):
+    # In MessageID order so ties rank the same as in the sharded recompute
+    return iter_message_texts_in_range(team_id)
+
+
+def iter_message_texts_in_range(team_id, low=None, high=None):
+    ''' Yields the texts of messages with low <= MessageID < high in MessageID order '''
+    query = '''SELECT MessageText FROM Messages
+               WHERE TeamID = %s
+               AND (%s IS NULL OR MessageID >= %s)
+               AND (%s IS NULL OR MessageID < %s)
+               ORDER BY MessageID'''
+    for row in stream(query, (team_id, low, low, high, high)):
+        yield row[0]
+
+
+@psycopg2_read_cur
+def get_message_id_shards(cursor, team_id, shards):
+    '''
+    Splits a team's messages into roughly equal MessageID ranges
+
+    Returns:
+        list: (low, high) pairs covering low <= MessageID < high, with None
+              for an open bound
+    '''
+    cursor.execute('''SELECT min(MessageID) FROM (
+                          SELECT MessageID, ntile(%s) OVER (ORDER BY MessageID) AS Shard
+                          FROM Messages WHERE TeamID = %s) AS Shards
+                      GROUP BY Shard ORDER BY Shard''', (shards, team_id))
+    starts = [row[0] for row in cursor.fetchall()]
+    if not starts:
+        return []
+    bounds = [None] + starts[1:] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_react_message_texts(team_id):
+    ''' Yields (ReactName, MessageText) for every react currently on a message '''
+    query = '''SELECT MessageReacts.ReactName, Messages.MessageText FROM MessageReacts
+               INNER JOIN Messages ON Messages.TeamID = MessageReacts.TeamID
+                   AND Messages.MessageID = MessageReacts.MessageID
+               WHERE MessageReacts.TeamID = %s AND MessageReacts.Count > 0'''
+    for row in stream(query, (team_id, )):
+        yield row[0], row[1]
+
+
+@psycopg2_read_cur
+def get_message_text_from_ids(cursor, team_id, msg_ids):
+    query = '''SELECT MessageID, MessageText FROM Messages
+               WHERE Messages.TeamID = %s AND Messages.MessageID = ANY(%s)
+               ORDER BY MessageID'''
+    cursor.execute(query, (team_id, list(msg_ids)))
     result = {}
-    for msg_id in msg_ids:
-        cursor.execute(query, (msg_id, ))
+    row = cursor.fetchone()
+    while row:
+        result[row[0]] = row[1]
         row = cursor.fetchone()
-        result[msg_id] = row[0]
     return result
 
 
-@psycopg2_cur
-def get_message_ids(cursor):
-    cursor.execute("SELECT MessageID FROM Messages")
+@psycopg2_read_cur
+def get_message_ids(cursor, team_id):
+    cursor.execute("SELECT MessageID FROM Messages WHERE TeamID = %s", (team_id, ))
     row = cursor.fetchone()
     msg_ids = []
     while row:
@@ -271,10 +1153,11 @@ def get_message_ids(cursor):
     return msg_ids
 
 
-@psycopg2_cur
-def get_react_counts(cursor):
+@psycopg2_read_cur
+def get_react_counts(cursor, team_id):
     cursor.execute(
-        'SELECT ReactName, SUM(MessageReacts.Count) FROM MessageReacts GROUP BY ReactName')
+        '''SELECT ReactName, SUM(MessageReacts.Count) FROM MessageReacts
+           WHERE TeamID = %s GROUP BY ReactName''', (team_id, ))
     row = cursor.fetchone()
     reacts = {}
     while row:
@@ -283,10 +1166,10 @@ def get_react_counts(cursor):
     return reacts
 
 
-@psycopg2_cur
-def get_react_count(cursor, react_name):
-    query = 'SELECT sum(MessageReacts.Count) FROM MessageReacts WHERE ReactName = %s'
-    cursor.execute(query, (react_name, ))
+@psycopg2_read_cur
+def get_react_count(cursor, team_id, react_name):
+    query = 'SELECT sum(MessageReacts.Count) FROM MessageReacts WHERE TeamID = %s AND ReactName = %s'
+    cursor.execute(query, (team_id, react_name))
     row = cursor.fetchone()
     count = []
     while row:
@@ -295,18 +1178,20 @@ def get_react_count(cursor, react_name):
     return count
 
 
-@psycopg2_cur
-def get_messages_with_react(cursor, react_name, text=False):
+@psycopg2_read_cur
+def get_messages_with_react(cursor, team_id, react_name, text=False):
     if text:
         query = '''
                   SELECT MessageText FROM Messages
-                  INNER JOIN MessageReacts ON Messages.MessageID=MessageReacts.MessageID
-                  WHERE MessageReacts.ReactName = %s AND MessageReacts.Count > 0
+                  INNER JOIN MessageReacts ON Messages.TeamID=MessageReacts.TeamID
+                      AND Messages.MessageID=MessageReacts.MessageID
+                  WHERE MessageReacts.TeamID = %s AND MessageReacts.ReactName = %s
+                  AND MessageReacts.Count > 0
                   '''
     else:
-        query = "SELECT MessageID FROM MessageReacts WHERE ReactName = %s AND Count > 0"
+        query = "SELECT MessageID FROM MessageReacts WHERE TeamID = %s AND ReactName = %s AND Count > 0"
 
-    cursor.execute(query, (react_name, ))
+    cursor.execute(query, (team_id, react_name))
     row = cursor.fetchone()
     msgs = []
     while row:
@@ -315,9 +1200,12 @@ def get_messages_with_react(cursor, react_name, text=False):
     return msgs
 
 
-@psycopg2_cur
-def get_message_table(cursor):
-    cursor.execute('SELECT * FROM Messages')
+@psycopg2_read_cur
+def get_message_table(cursor, team_id=None):
+    if team_id is None:
+        cursor.execute('SELECT * FROM Messages')
+    else:
+        cursor.execute('SELECT * FROM Messages WHERE TeamID = %s', (team_id, ))
     row = cursor.fetchone()
     msgs = []
     while row:
@@ -326,9 +1214,12 @@ def get_message_table(cursor):
     return msgs
 
 
-@psycopg2_cur
-def get_user_reacts_table(cursor):
-    cursor.execute('SELECT * FROM UserReacts')
+@psycopg2_read_cur
+def get_user_reacts_table(cursor, team_id=None):
+    if team_id is None:
+        cursor.execute('SELECT * FROM UserReacts')
+    else:
+        cursor.execute('SELECT * FROM UserReacts WHERE TeamID = %s', (team_id, ))
     row = cursor.fetchone()
     reacts = []
     while row:
@@ -338,6 +1229,187 @@ def get_user_reacts_table(cursor):
 
 
 @psycopg2_cur
+def add_dead_letter(cursor, entry_id, event_type, event_info, error):
+    team_id = event_info.get('team_id') if isinstance(event_info, dict) else None
+    cursor.execute('''INSERT INTO DeadLetters (TeamID, EntryID, EventType, Event, Error)
+                      VALUES (%s, %s, %s, %s, %s)''',
+                   (team_id, entry_id, event_type, json.dumps(event_info), error))
+
+
+@psycopg2_cur
+def get_dead_letters(cursor, team_id=None, limit=100):
+    '''
+    Returns:
+        list: (ID, TeamID, EntryID, EventType, event dict, Error, FailedAt), newest first
+    '''
+    if team_id is None:
+        cursor.execute('''SELECT ID, TeamID, EntryID, EventType, Event, Error, FailedAt
+                          FROM DeadLetters ORDER BY ID DESC LIMIT %s''', (limit, ))
+    else:
+        cursor.execute('''SELECT ID, TeamID, EntryID, EventType, Event, Error, FailedAt
+                          FROM DeadLetters WHERE TeamID = %s ORDER BY FailedAt DESC LIMIT %s''',
+                       (team_id, limit))
+    return [row[:4] + (json.loads(row[4]), ) + row[5:] for row in cursor.fetchall()]
+
+
+@psycopg2_cur
+def add_trend_counts(cursor, team_id, counts, oldest_bucket):
+    '''
+    Args:
+        counts        (dict) : (kind, name, bucket) -> count to add
+        oldest_bucket (int)  : Buckets before this are deleted
+    '''
+    from psycopg2.extras import execute_values
+    rows = [(team_id, kind, name, bucket, count)
+            for (kind, name, bucket), count in sorted(counts.items())]
+    execute_values(cursor,
+                   '''INSERT INTO TrendCounts (TeamID, Kind, Name, Bucket, Count) VALUES %s
+                      ON CONFLICT (TeamID, Bucket, Kind, Name) DO UPDATE
+                      SET Count = TrendCounts.Count + EXCLUDED.Count''', rows)
+    cursor.execute('DELETE FROM TrendCounts WHERE TeamID = %s AND Bucket < %s', (team_id, oldest_bucket))
+
+
+@psycopg2_read_cur
+def get_trend_counts(cursor, team_id, since_bucket, hot_since_bucket, min_count):
+    '''
+    Returns:
+        list: (kind, name, bucket, count) from since_bucket on, for names used
+              at least min_count times since hot_since_bucket
+    '''
+    cursor.execute('''WITH Hot AS (
+                          SELECT Kind, Name FROM TrendCounts
+                          WHERE TeamID = %s AND Bucket >= %s
+                          GROUP BY Kind, Name HAVING sum(Count) >= %s)
+                      SELECT t.Kind, t.Name, t.Bucket, t.Count FROM TrendCounts t
+                      INNER JOIN Hot ON Hot.Kind = t.Kind AND Hot.Name = t.Name
+                      WHERE t.TeamID = %s AND t.Bucket >= %s''',
+                   (team_id, hot_since_bucket, min_count, team_id, since_bucket))
+    return cursor.fetchall()
+
+
+def _lock_sketches(cursor, team_id):
+    ''' Serializes rebuilds and checkpoints of a team's sketches until the transaction ends '''
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('sketches'), hashtext(%s))", (team_id, ))
+
+
+def _upsert_sketch_parts(cursor, team_id, parts):
+    import psycopg2
+    from psycopg2.extras import execute_values
+    execute_values(cursor,
+                   '''INSERT INTO Sketches (TeamID, Part, Data) VALUES %s
+                      ON CONFLICT (TeamID, Part) DO UPDATE SET Data = EXCLUDED.Data''',
+                   [(team_id, name, psycopg2.Binary(data)) for name, data in sorted(parts.items())])
+
+
+@psycopg2_cur
+def replace_sketch_parts(cursor, team_id, parts, built_at):
+    '''
+    Args:
+        parts    (dict)  : part name -> serialized sketch
+        built_at (float) : When the sketches were built, in epoch seconds
+    '''
+    _lock_sketches(cursor, team_id)
+    cursor.execute('DELETE FROM Sketches WHERE TeamID = %s', (team_id, ))
+    _upsert_sketch_parts(cursor, team_id, parts)
+    cursor.execute('''INSERT INTO AggregateState (TeamID, SketchesBuiltAt) VALUES (%s, to_timestamp(%s) AT TIME ZONE 'UTC')
+                      ON CONFLICT (TeamID) DO UPDATE SET SketchesBuiltAt = EXCLUDED.SketchesBuiltAt''',
+                   (team_id, built_at))
+
+
+@psycopg2_cur
+def merge_sketch_parts(cursor, team_id, deltas, merge):
+    '''
+    Merges sketch deltas into a team's stored sketches. Nothing is stored for
+    a team whose sketches were never built, building them reads the tables.
+
+    Args:
+        deltas (dict)     : part name -> serialized delta
+        merge  (function) : (stored part, delta) -> merged part, all serialized
+
+    Returns:
+        bool: whether the deltas were stored
+    '''
+    _lock_sketches(cursor, team_id)
+    cursor.execute('SELECT SketchesBuiltAt FROM AggregateState WHERE TeamID = %s', (team_id, ))
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return False
+    cursor.execute('SELECT Part, Data FROM Sketches WHERE TeamID = %s AND Part = ANY(%s)',
+                   (team_id, sorted(deltas)))
+    stored = dict(cursor.fetchall())
+    _upsert_sketch_parts(cursor, team_id, {name: merge(stored[name], delta) if name in stored else delta
+                                           for name, delta in deltas.items()})
+    return True
+
+
+@psycopg2_read_cur
+def get_sketch_parts(cursor, team_id):
+    '''
+    Returns:
+        tuple: (when the sketches were built in epoch seconds or None,
+                dict of part name -> serialized sketch)
+    '''
+    cursor.execute('SELECT EXTRACT(EPOCH FROM SketchesBuiltAt) FROM AggregateState WHERE TeamID = %s',
+                   (team_id, ))
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None, {}
+    cursor.execute('SELECT Part, Data FROM Sketches WHERE TeamID = %s', (team_id, ))
+    return float(row[0]), dict(cursor.fetchall())
+
+
+@psycopg2_cur
+def get_stored_message_text(cursor, team_id, msg_id):
+    ''' Reads a message through the open batch, so it sees messages stored earlier in it '''
+    cursor.execute('SELECT MessageText FROM Messages WHERE TeamID = %s AND MessageID = %s', (team_id, msg_id))
+    row = cursor.fetchone()
+    return row[0] if row else ''
+
+
+@psycopg2_read_cur
+def get_team_ids(cursor):
+    cursor.execute('SELECT TeamID FROM Teams UNION SELECT DISTINCT TeamID FROM Messages ORDER BY 1')
+    return [row[0] for row in cursor.fetchall() if row[0]]
+
+
+@psycopg2_read_cur
+def get_stored_cutoff(cursor, settle_seconds):
+    '''
+    Returns:
+        float: epoch seconds settle_seconds ago by the database's clock.
+               Batches open then have long since committed, and replicated
+               unless the replica is further behind than MAX_REPLICA_LAG.
+    '''
+    cursor.execute('SELECT extract(epoch FROM now()) - %s', (settle_seconds, ))
+    return float(cursor.fetchone()[0])
+
+
+@psycopg2_read_cur
+def get_message_days(cursor, team_id, stored_after=None, stored_until=None):
+    '''
+    Returns:
+        list: (UTC date posted, message count) for each day with messages
+              stored after stored_after and up to stored_until, oldest first
+    '''
+    cursor.execute('''SELECT (to_timestamp({ts}) AT TIME ZONE 'UTC')::date AS Day, count(*) FROM Messages
+                      WHERE TeamID = %s AND StoredAt > to_timestamp(%s) AND StoredAt <= to_timestamp(%s)
+                      GROUP BY Day ORDER BY Day'''.format(ts=MESSAGE_TS),
+                   (team_id, stored_after or 0, stored_until))
+    return cursor.fetchall()
+
+
+@psycopg2_read_cur
+def copy_to(cursor, query, args, out):
+    '''
+    Streams a query's result to a file object as CSV with a header row
+    using COPY, without materializing the rows in Python
+    '''
+    query = cursor.mogrify(query, args).decode('utf-8')
+    cursor.copy_expert('COPY (' + query + ') TO STDOUT WITH CSV HEADER', out)
+
+
+# Ad hoc SELECTs from analytics, so routed like the other reads
+@psycopg2_read_cur
 def execute(cursor, query, args=None):
     cursor.execute(query, args)
     result = []
@@ -0,0 +1,197 @@
+'''
+Per team catalog of custom emoji, persisted in the Emoji table and kept up
+to date from emoji_changed events so emoji.list only has to be downloaded
+once per workspace.
+
+Reaction names are normalized against it before they're stored: skin tone
+variants fold into the base emoji and aliases resolve to the emoji they
+point at, so every way of using an emoji is counted under one name. Built
+in emoji with several names are resolved with the short_names lists in
+emoji_aliases.json, or in the emoji-data emoji.json Slack's names come from
+if EMOJI_DATA_FILE points at one. Until a team's emoji.list is stored, only
+those and any aliases already stored are applied. A failed emoji.list, e.g.
+missing_scope or a rate limit, isn't retried until its backoff runs out.
+
+    python src/emoji_catalog.py TEAM_ID NAME    # print NAME's normalized form
+'''
+import json
+import os
+import re
+import threading
+import time
+
+import db
+import log
+
+# Cached catalogs are re-read from the database after this long so changes
+# applied by other writer processes are picked up
+CATALOG_MAX_AGE = float(os.environ.get('EMOJI_CATALOG_MAX_AGE', 300))
+ALIAS_PREFIX = 'alias:'
+# Alias chains longer than this are treated as a loop
+MAX_ALIAS_DEPTH = 5
+# A failed emoji.list is retried after this long, doubling on each failure
+SYNC_RETRY_MIN = float(os.environ.get('EMOJI_SYNC_RETRY_MIN', 60))
+SYNC_RETRY_MAX = float(os.environ.get('EMOJI_SYNC_RETRY_MAX', 3600))
+SKIN_TONE_EXPR = re.compile(r'::skin-tone-\d$')
+
+up_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDARD_ALIASES_FILE = os.environ.get('EMOJI_DATA_FILE', up_dir + '/emoji_aliases.json')
+_standard_aliases = None
+
+
+def standard_aliases():
+    '''
+    Returns:
+        dict: every other name of a built in emoji -> its first short name,
+              which is the one Slack sends
+    '''
+    global _standard_aliases
+    if _standard_aliases is None:
+        with open(STANDARD_ALIASES_FILE) as f:
+            entries = json.load(f)
+        aliases = {}
+        for entry in entries:
+            # emoji-data entries are objects, the bundled file only keeps their short_names
+            names = entry['short_names'] if isinstance(entry, dict) else entry
+            for name in names[1:]:
+                aliases[name] = names[0]
+        _standard_aliases = aliases
+    return _standard_aliases
+
+
+class Catalog(object):
+    def __init__(self, emoji=None, synced=False):
+        self.loaded_at = time.time()
+        # name -> the name it's an alias of, or None for an image
+        self.emoji = emoji or {}
+        # False until emoji.list has been stored for the team
+        self.synced = synced
+
+    def is_stale(self):
+        return time.time() - self.loaded_at > CATALOG_MAX_AGE
+
+    def resolve(self, name):
+        seen = 0
+        while seen < MAX_ALIAS_DEPTH:
+            target = self.emoji.get(name) or standard_aliases().get(name)
+            if not target:
+                return name
+            name = target
+            seen += 1
+        return name
+
+
+_catalogs = {}
+# team_id -> (when emoji.list may be tried again, failures in a row)
+_failures = {}
+_lock = threading.Lock()
+
+
+def parse_value(value):
+    '''
+    Splits an emoji.list value into (alias target, image URL), one of which
+    is None
+    '''
+    if value and value.startswith(ALIAS_PREFIX):
+        return value[len(ALIAS_PREFIX):], None
+    return None, value
+
+
+def get(team_id):
+    '''
+    Returns:
+        Catalog: the team's catalog, empty and not synced if emoji.list has
+                 never been stored for the team
+    '''
+    with _lock:
+        catalog = _catalogs.get(team_id)
+    if catalog is None or catalog.is_stale():
+        synced, emoji = db.get_emoji(team_id)
+        catalog = Catalog(emoji, synced)
+        with _lock:
+            _catalogs[team_id] = catalog
+    return catalog
+
+
+def sync(team_id, emoji_list):
+    '''
+    Replaces a team's catalog with a full emoji.list response
+
+    Args:
+        team_id    (str)  : Slack team ID
+        emoji_list (dict) : name -> image URL or 'alias:name'
+    '''
+    rows = {name: parse_value(value) for name, value in emoji_list.items()}
+    db.replace_emoji(team_id, rows)
+    with _lock:
+        _catalogs[team_id] = Catalog({name: alias for name, (alias, _) in rows.items()}, synced=True)
+        _failures.pop(team_id, None)
+
+
+def sync_due(team_id):
+    ''' True if the team's emoji.list isn't stored and no failed attempt is backing off '''
+    if get(team_id).synced:
+        return False
+    with _lock:
+        failure = _failures.get(team_id)
+    return failure is None or time.time() >= failure[0]
+
+
+def sync_failed(team_id, error):
+    ''' Records a failed emoji.list so it isn't retried until the backoff runs out '''
+    with _lock:
+        failures = _failures.get(team_id, (0, 0))[1] + 1
+        delay = min(SYNC_RETRY_MAX, SYNC_RETRY_MIN * 2 ** (failures - 1))
+        _failures[team_id] = (time.time() + delay, failures)
+    log.log_info('emoji.list failed for team %s (%s), retrying in %.0fs' % (team_id, error, delay))
+
+
+def apply_change(team_id, event):
+    ''' Applies an emoji_changed event to the stored catalog and this process' cache '''
+    subtype = event.get('subtype')
+    with _lock:
+        catalog = _catalogs.get(team_id)
+    if subtype == 'add':
+        alias, url = parse_value(event.get('value'))
+        db.add_emoji(team_id, event['name'], alias, url)
+        if catalog:
+            catalog.emoji[event['name']] = alias
+    elif subtype == 'remove':
+        names = event.get('names', [])
+        db.remove_emoji(team_id, names)
+        if catalog:
+            for name in names:
+                catalog.emoji.pop(name, None)
+    elif subtype == 'rename':
+        old_name, new_name = event['old_name'], event['new_name']
+        db.rename_emoji(team_id, old_name, new_name)
+        if catalog:
+            catalog.emoji[new_name] = catalog.emoji.pop(old_name, None)
+            for name, alias in catalog.emoji.items():
+                if alias == old_name:
+                    catalog.emoji[name] = new_name
+
+
+def strip_skin_tone(name):
+    return SKIN_TONE_EXPR.sub('', name)
+
+
+def normalize(team_id, name, catalog=None):
+    '''
+    Args:
+        team_id (str)     : Slack team ID
+        name    (str)     : Reaction name as sent by Slack, e.g. thumbsup::skin-tone-2
+        catalog (Catalog) : Team catalog if already fetched
+
+    Returns:
+        str: the name the react is stored and counted under
+    '''
+    name = strip_skin_tone(name.strip(':'))
+    if catalog is None:
+        catalog = get(team_id)
+    return catalog.resolve(name)
+
+
+if __name__ == '__main__':
+    import sys
+    print(normalize(sys.argv[1], sys.argv[2]))
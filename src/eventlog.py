@@ -0,0 +1,171 @@
+'''
+Durable event log between the web process and the DB writers, kept in a
+Redis stream. The web process only appends; writer processes read through a
+consumer group, acknowledge what they've stored, and claim entries left
+pending by writers that died.
+
+    python src/eventlog.py    # print stream length and lag per consumer
+'''
+import json
+import os
+import time
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+STREAM_KEY = os.getenv('EVENT_STREAM', 'reactanalytics:events')
+GROUP = os.getenv('EVENT_STREAM_GROUP', 'writers')
+# Approximate cap on retained entries, trimmed as new ones are added
+MAX_LEN = int(os.getenv('EVENT_STREAM_MAXLEN', 1000000))
+# Entries pending this long on another consumer are assumed orphaned
+CLAIM_IDLE_MS = int(os.getenv('EVENT_CLAIM_IDLE_MS', 60000))
+# Entries delivered this many times without an ack are given up on
+MAX_DELIVERIES = int(os.getenv('EVENT_MAX_DELIVERIES', 5))
+
+_redis = None
+_redis_pid = None
+
+
+def get_redis():
+    global _redis, _redis_pid
+    if _redis is None or _redis_pid != os.getpid():
+        import redis
+        _redis = redis.StrictRedis.from_url(REDIS_URL)
+        _redis_pid = os.getpid()
+    return _redis
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _pairs(flat):
+    ''' Turns a flat [key, value, key, value ...] reply into a dict '''
+    return {_decode(flat[i]): _decode(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+
+def _entries(raw):
+    ''' Parses [[entry_id, [field, value ...]] ...] into (entry_id, event_type, event_info) '''
+    entries = []
+    for entry_id, fields in raw:
+        if fields is None:
+            # Trimmed from the stream while it was pending
+            continue
+        fields = _pairs(fields)
+        entries.append((_decode(entry_id), int(fields['type']), json.loads(fields['event'])))
+    return entries
+
+
+def append(event_type, event_info):
+    ''' Appends an event to the log and returns its entry ID '''
+    entry_id = get_redis().execute_command('XADD', STREAM_KEY, 'MAXLEN', '~', MAX_LEN, '*',
+                                           'type', event_type,
+                                           'event', json.dumps(event_info))
+    return _decode(entry_id)
+
+
+def ensure_group():
+    from redis.exceptions import ResponseError
+    try:
+        get_redis().execute_command('XGROUP', 'CREATE', STREAM_KEY, GROUP, '0', 'MKSTREAM')
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def read(consumer, count=100, block_ms=5000, pending=False):
+    '''
+    Reads entries for this consumer
+
+    Args:
+        consumer (str)  : Consumer name, stable across restarts of the same writer
+        count    (int)  : Max entries to return
+        block_ms (int)  : How long to wait for new entries
+        pending  (bool) : Re-read entries delivered to this consumer but never
+                          acknowledged instead of new ones
+
+    Returns:
+        list: (entry_id, event_type, event_info) tuples
+    '''
+    args = ['XREADGROUP', 'GROUP', GROUP, consumer, 'COUNT', count]
+    if not pending:
+        args += ['BLOCK', block_ms]
+    args += ['STREAMS', STREAM_KEY, '0' if pending else '>']
+    reply = get_redis().execute_command(*args)
+    if not reply:
+        return []
+    return _entries(reply[0][1])
+
+
+def ack(entry_ids):
+    if entry_ids:
+        get_redis().execute_command('XACK', STREAM_KEY, GROUP, *entry_ids)
+
+
+def claim_stale(consumer, count=100, min_idle_ms=CLAIM_IDLE_MS, on_give_up=None):
+    '''
+    Takes over entries that other consumers have held without acknowledging
+    for at least min_idle_ms. Entries already delivered MAX_DELIVERIES times
+    are passed to on_give_up and acknowledged instead of being retried again.
+
+    Returns:
+        list: (entry_id, event_type, event_info) tuples now owned by consumer
+    '''
+    r = get_redis()
+    pending = r.execute_command('XPENDING', STREAM_KEY, GROUP, '-', '+', count)
+    stale = []
+    exhausted = []
+    for entry_id, owner, idle_ms, deliveries in pending:
+        if idle_ms < min_idle_ms:
+            continue
+        if deliveries >= MAX_DELIVERIES:
+            exhausted.append(_decode(entry_id))
+        else:
+            stale.append(_decode(entry_id))
+
+    if exhausted:
+        given_up = r.execute_command('XCLAIM', STREAM_KEY, GROUP, consumer, min_idle_ms, *exhausted)
+        if on_give_up:
+            for entry in _entries(given_up):
+                on_give_up(entry)
+        ack(exhausted)
+
+    if not stale:
+        return []
+    return _entries(r.execute_command('XCLAIM', STREAM_KEY, GROUP, consumer, min_idle_ms, *stale))
+
+
+def lag():
+    '''
+    Returns:
+        dict: stream length, entries not yet delivered to the group (when the
+              server reports it) and pending count / idle time per consumer
+    '''
+    r = get_redis()
+    info = {'length': r.execute_command('XLEN', STREAM_KEY), 'undelivered': None,
+            'pending': 0, 'consumers': {}}
+    for group in r.execute_command('XINFO', 'GROUPS', STREAM_KEY):
+        group = _pairs(group)
+        if group['name'] != GROUP:
+            continue
+        info['undelivered'] = group.get('lag')
+        info['pending'] = group['pending']
+        info['last_delivered_id'] = group['last-delivered-id']
+        for consumer in r.execute_command('XINFO', 'CONSUMERS', STREAM_KEY, GROUP):
+            consumer = _pairs(consumer)
+            info['consumers'][consumer['name']] = {'pending': consumer['pending'],
+                                                   'idle_ms': consumer['idle']}
+    return info
+
+
+def log_lag():
+    import log
+    info = lag()
+    log.log_info('event log: %s entries, %s undelivered, %s pending' %
+                 (info['length'], info['undelivered'], info['pending']))
+    for name, consumer in sorted(info['consumers'].items()):
+        log.log_info('  %s: %s pending, idle %sms' % (name, consumer['pending'], consumer['idle_ms']))
+
+
+if __name__ == '__main__':
+    print(json.dumps(lag(), indent=2, sort_keys=True))
@@ -0,0 +1,249 @@
+'''
+Offline export of the reaction data for bulk analysis.
+
+Streams Messages, MessageReacts and UserReacts out of the database with
+COPY into gzipped CSV, partitioned by team and by the UTC day a message was
+posted:
+
+    OUT_DIR/messages/team=T/day=2018-05-01/part-<watermark>.csv.gz
+    OUT_DIR/message_reacts/team=T/day=2018-05-01/reacts.csv.gz
+    OUT_DIR/user_reacts/team=T/snapshot.csv.gz
+    OUT_DIR/watermarks.json
+
+Messages are exported incrementally: each run only copies messages stored
+since the team's watermark, as a new part file in the day they were posted.
+The watermark is when messages were stored, not their Slack timestamp, so a
+message replayed, claimed late or backfilled with an old timestamp is still
+picked up. Messages stored in the last EXPORT_SETTLE_SECONDS are left for
+the next run, as a batch that started then may not have committed yet. MessageReacts and UserReacts
+have no timestamps of their own, so a day's reacts file is rewritten
+whenever that day is exported or falls in the last --refresh-days days, and
+UserReacts is a full snapshot per team.
+
+With --npy every partition also gets one .npy file per column next to its
+CSV. Numeric columns are stored as is and text ID columns as int32 codes
+into a <column>.vocab.json list, so they can be opened with
+numpy.load(path, mmap_mode='r') without reading the whole file. They're
+written by streaming the CSV into memory mapped arrays, so only the
+vocabularies are held in memory. Message text is only in the CSV.
+
+    python src/export.py OUT_DIR [--team TEAM_ID] [--full] [--refresh-days 2] [--npy]
+'''
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import os
+import shutil
+
+import db
+import log
+
+WATERMARK_FILE = 'watermarks.json'
+REFRESH_DAYS = 2
+SETTLE_SECONDS = float(os.environ.get('EXPORT_SETTLE_SECONDS', 300))
+
+MESSAGES_QUERY = '''SELECT MessageID, UserID, {ts} AS Timestamp, MessageText FROM Messages
+                    WHERE TeamID = %s AND StoredAt > to_timestamp(%s) AND StoredAt <= to_timestamp(%s)
+                    AND {ts} >= %s AND {ts} < %s
+                    ORDER BY {ts}'''.format(ts=db.MESSAGE_TS)
+MESSAGE_REACTS_QUERY = '''SELECT MessageID, ReactName, Count, {ts} AS Timestamp FROM MessageReacts
+                          WHERE TeamID = %s AND {ts} >= %s AND {ts} < %s AND Count > 0
+                          ORDER BY {ts}, ReactName'''.format(ts=db.MESSAGE_TS)
+USER_REACTS_QUERY = '''SELECT UserID, ReactName, Count FROM UserReacts
+                       WHERE TeamID = %s AND Count > 0 ORDER BY UserID, ReactName'''
+
+# CSV column -> numpy dtype, or None for text IDs that are dictionary encoded.
+# Columns not listed aren't written as .npy.
+NPY_COLUMNS = {'Timestamp': 'float64',
+               'Count': 'int64',
+               'MessageID': None,
+               'UserID': None,
+               'ReactName': None}
+# Rows converted at a time when writing .npy columns
+NPY_CHUNK_ROWS = 65536
+
+
+def day_bounds(day):
+    ''' Returns the epoch seconds [start, end) of a UTC date '''
+    start = datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+    return start.timestamp(), (start + datetime.timedelta(days=1)).timestamp()
+
+
+def load_watermarks(out_dir):
+    '''
+    Returns:
+        dict: team_id -> when the newest exported messages were stored
+    '''
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        watermarks = json.load(f)
+    # Older exports kept a bare Slack timestamp, those teams start over
+    return {team_id: value['stored_at'] for team_id, value in watermarks.items() if isinstance(value, dict)}
+
+
+def save_watermarks(out_dir, watermarks):
+    _write_json(os.path.join(out_dir, WATERMARK_FILE),
+                {team_id: {'stored_at': watermark} for team_id, watermark in watermarks.items()})
+
+
+def _write_json(path, value):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def copy_partition(query, args, path, npy=False):
+    '''
+    Writes a query's result to path as gzipped CSV, replacing the file only
+    once it's complete
+
+    Returns:
+        str: path written
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8', newline='') as out:
+        db.copy_to(query, args, out)
+    os.replace(tmp, path)
+    if npy:
+        write_columns(path)
+    return path
+
+
+def _csv_rows(csv_path):
+    ''' Yields a gzipped CSV's header and then its rows '''
+    with gzip.open(csv_path, 'rt', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            yield row
+
+
+def write_columns(csv_path, chunk_rows=NPY_CHUNK_ROWS):
+    '''
+    Writes a .npy file per column listed in NPY_COLUMNS alongside a gzipped
+    CSV, named <csv name>.<column>.npy. The CSV is read twice, once to size
+    the arrays and once to fill them chunk_rows at a time.
+    '''
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    base = csv_path[:-len('.csv.gz')]
+    rows = _csv_rows(csv_path)
+    header = next(rows)
+    row_count = sum(1 for _ in rows)
+
+    dtypes = {column.lower(): dtype for column, dtype in NPY_COLUMNS.items()}
+    columns = [(i, name, dtypes[name.lower()]) for i, name in enumerate(header) if name.lower() in dtypes]
+    if not row_count:
+        for _, name, dtype in columns:
+            np.save('%s.%s.npy' % (base, name), np.zeros(0, dtype=dtype or 'int32'))
+            if dtype is None:
+                _write_json('%s.%s.vocab.json' % (base, name), [])
+        return
+
+    arrays = {name: open_memmap('%s.%s.npy' % (base, name), mode='w+', dtype=dtype or 'int32',
+                                shape=(row_count, ))
+              for _, name, dtype in columns}
+    vocabs = {name: {} for _, name, dtype in columns if dtype is None}
+    rows = _csv_rows(csv_path)
+    next(rows)
+    start = 0
+    while start < row_count:
+        chunk = [row for _, row in zip(range(chunk_rows), rows)]
+        if not chunk:
+            break
+        end = start + len(chunk)
+        for i, name, dtype in columns:
+            if dtype is None:
+                vocab = vocabs[name]
+                arrays[name][start:end] = [vocab.setdefault(row[i], len(vocab)) for row in chunk]
+            else:
+                arrays[name][start:end] = np.asarray([row[i] for row in chunk], dtype='float64')
+        start = end
+    rows.close()
+
+    for array in arrays.values():
+        array.flush()
+    for name, vocab in vocabs.items():
+        _write_json('%s.%s.vocab.json' % (base, name), sorted(vocab, key=vocab.get))
+
+
+def export_team(out_dir, team_id, watermark=None, refresh_days=REFRESH_DAYS, npy=False):
+    '''
+    Exports one team's messages stored since watermark and refreshes the
+    react partitions they touch
+
+    Args:
+        out_dir      (str)   : Root of the export
+        team_id      (str)   : Slack team ID
+        watermark    (float) : When the newest message already exported was stored
+        refresh_days (int)   : Also rewrite reacts for this many days up to now,
+                               reacts keep arriving after a post
+        npy          (bool)  : Write .npy columns for every partition
+
+    Returns:
+        float: the new watermark
+    '''
+    if not watermark:
+        # Starting over, drop parts left by earlier incremental runs
+        shutil.rmtree(os.path.join(out_dir, 'messages', 'team=' + team_id), ignore_errors=True)
+
+    new_watermark = db.get_stored_cutoff(SETTLE_SECONDS)
+    if watermark and new_watermark <= watermark:
+        return watermark
+    days = db.get_message_days(team_id, watermark, new_watermark)
+    part = 'part-%s.csv.gz' % ('%.6f' % watermark if watermark else 'initial')
+    exported = 0
+    for day, count in days:
+        start, end = day_bounds(day)
+        path = os.path.join(out_dir, 'messages', 'team=' + team_id, 'day=' + day.isoformat(), part)
+        copy_partition(MESSAGES_QUERY, (team_id, watermark or 0, new_watermark, start, end), path, npy)
+        exported += count
+
+    react_days = {day for day, _ in days}
+    if watermark:
+        last_day = datetime.datetime.fromtimestamp(new_watermark, datetime.timezone.utc).date()
+        react_days.update(last_day - datetime.timedelta(days=i) for i in range(refresh_days))
+    for day in sorted(react_days):
+        start, end = day_bounds(day)
+        path = os.path.join(out_dir, 'message_reacts', 'team=' + team_id, 'day=' + day.isoformat(),
+                            'reacts.csv.gz')
+        copy_partition(MESSAGE_REACTS_QUERY, (team_id, start, end), path, npy)
+
+    copy_partition(USER_REACTS_QUERY, (team_id, ),
+                   os.path.join(out_dir, 'user_reacts', 'team=' + team_id, 'snapshot.csv.gz'), npy)
+
+    log.log_info('export: team %s, %d messages over %d days, %d react partitions'
+                 % (team_id, exported, len(days), len(react_days)))
+    return new_watermark
+
+
+def export(out_dir, team_ids=None, full=False, refresh_days=REFRESH_DAYS, npy=False):
+    os.makedirs(out_dir, exist_ok=True)
+    watermarks = {} if full else load_watermarks(out_dir)
+    for team_id in team_ids or db.get_team_ids():
+        watermark = export_team(out_dir, team_id, watermarks.get(team_id), refresh_days, npy)
+        if watermark:
+            watermarks[team_id] = watermark
+        # Saved after every team so an interrupted run doesn't redo finished teams
+        save_watermarks(out_dir, watermarks)
+    return watermarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export reaction data to partitioned files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--team', action='append', dest='teams',
+                        help='team to export, can be repeated. Defaults to every team')
+    parser.add_argument('--full', action='store_true', help='ignore the watermarks and export everything')
+    parser.add_argument('--refresh-days', type=int, default=REFRESH_DAYS)
+    parser.add_argument('--npy', action='store_true', help='also write memory mappable .npy columns')
+    args = parser.parse_args(argv)
+    export(args.out_dir, args.teams, args.full, args.refresh_days, args.npy)
+
+
+if __name__ == '__main__':
+    main()
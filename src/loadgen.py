@@ -0,0 +1,369 @@
+'''
+Load generator for the Flask endpoints.
+
+Sends synthetic, correctly signed Slack traffic at a fixed rate: message and
+reaction_added events to /listening and slash commands to
+/react_analytics. --viral sends most reactions to one message, the burst a
+popular post causes. Requests are scheduled open loop, so a slow app makes
+latency grow instead of quietly lowering the rate, and latency is measured
+from when each request was due.
+
+Reports sustained throughput, latency percentiles and errors, plus the
+backlog of the event log and the celery queue sampled during the run, for
+sizing gunicorn workers, writers and celery concurrency.
+
+Run the app against a local Postgres and a stub Slack API:
+
+    python src/loadgen.py --stub-slack 5055    # then, for the app processes:
+    SLACK_API_URL=http://localhost:5055/api/ DATABASE_URL=postgres://localhost/reacts \\
+        DATABASE_SSLMODE=disable VERIFICATION_TOKEN=loadtest SLACK_SIGNING_SECRET=loadtest \\
+        honcho start
+
+    python src/loadgen.py --url http://localhost:5000 --rate 200 --duration 60 --viral
+'''
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from util import sign_request
+
+REACTS = ['+1', 'joy', 'heart', 'fire', 'eyes', 'tada', 'thinking_face', 'clap', '100', 'pray']
+WORDS = ['deploy', 'lunch', 'meeting', 'release', 'coffee', 'bug', 'review', 'friday',
+         'standup', 'build', 'ship', 'it', 'today', 'the', 'new', 'office', 'party', 'demo']
+COMMANDS = ['most_reacts', 'most_used', 'most_reacted_to', 'most_unique', 'common_phrases',
+            'buzzwords :fire:', 'trending', 'most_reacts approx']
+# Event kind -> share of the traffic
+DEFAULT_MIX = {'reaction': 0.8, 'message': 0.15, 'command': 0.05}
+SAMPLE_INTERVAL = 1.0
+
+
+class Workspace(object):
+    ''' Fake team, users and channels, plus the messages posted so far '''
+
+    def __init__(self, team_id='TLOADTEST', users=200, channels=20, seed=None):
+        self.random = random.Random(seed)
+        self.team_id = team_id
+        self.users = ['U%08d' % i for i in range(users)]
+        self.channels = ['C%08d' % i for i in range(channels)]
+        self.messages = []
+        self.lock = threading.Lock()
+        self.event_id = 0
+
+    def next_ts(self):
+        return '%.6f' % time.time()
+
+    def new_message(self):
+        message = (self.random.choice(self.channels), self.next_ts())
+        with self.lock:
+            self.messages.append(message)
+            if len(self.messages) > 10000:
+                self.messages = self.messages[-5000:]
+        return message
+
+    def pick_message(self, viral):
+        with self.lock:
+            if not self.messages:
+                message = None
+            elif viral and self.random.random() < viral:
+                message = self.messages[0]
+            else:
+                message = self.random.choice(self.messages)
+        return message or self.new_message()
+
+    def envelope(self, token, event):
+        with self.lock:
+            self.event_id += 1
+            event_id = self.event_id
+        return {'token': token,
+                'team_id': self.team_id,
+                'api_app_id': 'ALOADTEST',
+                'type': 'event_callback',
+                'event_id': 'Ev%010d' % event_id,
+                'event_time': int(time.time()),
+                'event': event}
+
+    def message_event(self, token):
+        channel, ts = self.new_message()
+        text = ' '.join(self.random.choice(WORDS) for _ in range(self.random.randint(3, 15)))
+        return self.envelope(token, {'type': 'message', 'channel': channel, 'ts': ts,
+                                     'user': self.random.choice(self.users), 'text': text,
+                                     'event_ts': ts})
+
+    def reaction_event(self, token, viral=0):
+        channel, ts = self.pick_message(viral)
+        return self.envelope(token, {'type': 'reaction_added',
+                                     'user': self.random.choice(self.users),
+                                     'reaction': self.random.choice(REACTS),
+                                     'item': {'type': 'message', 'channel': channel, 'ts': ts},
+                                     'event_ts': self.next_ts()})
+
+    def slash_command(self, token):
+        return {'token': token,
+                'team_id': self.team_id,
+                'user_id': self.random.choice(self.users),
+                'command': '/reacts',
+                'text': self.random.choice(COMMANDS)}
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def record(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                self.errors += 1
+
+
+def percentile(values, p):
+    ''' Nearest rank percentile of a sorted list '''
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values), int(math.ceil(p / 100.0 * len(values)))) - 1)
+    return values[rank]
+
+
+class LoadGenerator(object):
+    def __init__(self, url, token, signing_secret=None, rate=50, duration=30, concurrency=50,
+                 mix=None, viral=0, workspace=None):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.signing_secret = signing_secret
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix or DEFAULT_MIX
+        self.viral = viral
+        self.workspace = workspace or Workspace()
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.stats = Stats()
+        self.backlog = []
+        self.session = None
+
+    def get_session(self):
+        if self.session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def signed_headers(self, body, content_type):
+        headers = {'Content-Type': content_type}
+        if self.signing_secret:
+            timestamp = str(int(time.time()))
+            headers['X-Slack-Request-Timestamp'] = timestamp
+            headers['X-Slack-Signature'] = sign_request(self.signing_secret, timestamp, body)
+        return headers
+
+    def build_request(self, kind):
+        ''' Returns (path, body, content type) for one request of the given kind '''
+        if kind == 'command':
+            from urllib.parse import urlencode
+            body = urlencode(self.workspace.slash_command(self.token))
+            return '/react_analytics', body, 'application/x-www-form-urlencoded'
+        if kind == 'message':
+            event = self.workspace.message_event(self.token)
+        else:
+            event = self.workspace.reaction_event(self.token, self.viral)
+        return '/listening', json.dumps(event), 'application/json'
+
+    def send(self, kind, due):
+        path, body, content_type = self.build_request(kind)
+        headers = self.signed_headers(body, content_type)
+        try:
+            resp = self.get_session().post(self.url + path, data=body.encode('utf-8'),
+                                           headers=headers, timeout=30)
+            status = resp.status_code
+        except Exception as e:
+            status = type(e).__name__
+        self.stats.record(time.time() - due, status)
+
+    def pick_kind(self):
+        point = self.workspace.random.random() * sum(self.mix.values())
+        for kind, share in sorted(self.mix.items()):
+            point -= share
+            if point <= 0:
+                return kind
+        return kind
+
+    def sample_backlog(self, stop):
+        while not stop.is_set():
+            self.backlog.append((time.time(), queue_backlog()))
+            stop.wait(SAMPLE_INTERVAL)
+
+    def run(self):
+        # Seed a few messages so early reactions have something to land on
+        for _ in range(10):
+            self.workspace.new_message()
+
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample_backlog, args=(stop, ))
+        sampler.daemon = True
+        sampler.start()
+
+        start = time.time()
+        interval = 1.0 / self.rate
+        sent = 0
+        while True:
+            due = start + sent * interval
+            if due - start >= self.duration:
+                break
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.executor.submit(self.send, self.pick_kind(), due)
+            sent += 1
+        self.executor.shutdown(wait=True)
+        elapsed = time.time() - start
+
+        stop.set()
+        sampler.join()
+        self.backlog.append((time.time(), queue_backlog()))
+        return self.report(sent, elapsed)
+
+    def report(self, sent, elapsed):
+        latencies = sorted(self.stats.latencies)
+        backlog = [sample for _, sample in self.backlog if sample]
+        result = {'sent': sent,
+                  'target_rate': self.rate,
+                  'elapsed_s': round(elapsed, 2),
+                  'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+                  'errors': self.stats.errors,
+                  'statuses': {str(k): v for k, v in self.stats.statuses.items()},
+                  'latency_ms': {name: round(1000 * percentile(latencies, p), 1)
+                                 for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))}}
+        if backlog:
+            result['backlog'] = {key: {'max': max(sample[key] for sample in backlog),
+                                       'final': backlog[-1][key]}
+                                 for key in backlog[-1]}
+        return result
+
+
+def queue_backlog():
+    '''
+    Returns:
+        dict: entries waiting in the event log for the writers and tasks
+              waiting in the celery queue, or None if Redis isn't reachable
+    '''
+    try:
+        import eventlog
+        info = eventlog.lag()
+        celery_queue = eventlog.get_redis().llen(os.getenv('CELERY_QUEUE', 'celery'))
+    except Exception:
+        return None
+    return {'event_log_undelivered': info['undelivered'] or 0,
+            'event_log_pending': info['pending'],
+            'celery_queue': celery_queue}
+
+
+STUB_RESPONSES = {
+    'auth.test': {'ok': True, 'user_id': 'UBOT', 'team_id': 'TLOADTEST'},
+    'im.open': {'ok': True, 'channel': {'id': 'DLOADTEST'}},
+    'im.list': {'ok': True, 'ims': []},
+    'chat.postMessage': {'ok': True, 'ts': '0.000000'},
+    'users.list': {'ok': True, 'members': [], 'response_metadata': {'next_cursor': ''}},
+    'emoji.list': {'ok': True, 'emoji': {'partyparrot': 'https://example.com/partyparrot.gif',
+                                         'parrot': 'alias:partyparrot'}},
+    'oauth.access': {'ok': False, 'error': 'stubbed'},
+}
+
+
+def run_stub_slack(port, latency_ms=0, users=200):
+    '''
+    Serves canned Web API responses on /api/<method> so the app can run
+    without Slack. Blocks until interrupted.
+    '''
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    responses = dict(STUB_RESPONSES)
+    responses['users.list'] = {'ok': True, 'response_metadata': {'next_cursor': ''},
+                               'members': [{'id': user_id, 'name': user_id.lower(),
+                                            'profile': {'display_name': user_id.lower()}}
+                                           for user_id in Workspace(users=users).users]}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            method = self.path.rstrip('/').split('/')[-1]
+            if latency_ms:
+                time.sleep(latency_ms / 1000.0)
+            body = json.dumps(responses.get(method, {'ok': True})).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('', port), Handler)
+    print('Stub Slack API on http://localhost:%d/api/' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, share = part.split('=')
+        mix[kind.strip()] = float(share)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay synthetic Slack traffic against the app')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--rate', type=float, default=50, help='requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='e.g. reaction=0.8,message=0.15,command=0.05')
+    parser.add_argument('--viral', nargs='?', type=float, const=0.9, default=0,
+                        help='share of reactions sent to a single message')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--team', default='TLOADTEST')
+    parser.add_argument('--token', default=os.environ.get('VERIFICATION_TOKEN', 'loadtest'))
+    parser.add_argument('--signing-secret', default=os.environ.get('SLACK_SIGNING_SECRET'))
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--stub-slack', type=int, metavar='PORT',
+                        help='run the stub Slack API on PORT instead of generating load')
+    parser.add_argument('--stub-latency-ms', type=float, default=0)
+    args = parser.parse_args(argv)
+
+    if args.stub_slack:
+        run_stub_slack(args.stub_slack, args.stub_latency_ms, args.users)
+        return
+
+    workspace = Workspace(args.team, args.users, seed=args.seed)
+    generator = LoadGenerator(args.url, args.token, args.signing_secret, args.rate, args.duration,
+                              args.concurrency, args.mix, args.viral, workspace)
+    print(json.dumps(generator.run(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+'''
+Picks how analytics answers each call.
+
+CACHE      a ranking computed by an earlier call, while it's younger than CACHE_MAX_AGE
+AGGREGATE  a table maintained by the writers, once it's known to cover the team
+SCAN       tokenizing and counting the raw message texts in this process
+
+The first usable one in that order is taken. Small teams skip the cache since
+scanning them is cheap and always current. Calls are answered inside web and
+Celery workers, so a scan is never sharded across a process pool here; pass
+shards= only from the command line, as recompute.py and benchmark() do. Each call logs the path taken and
+how long it took. Set ANALYTICS_STRATEGY, or pass strategy=, to force a path,
+and run this module to time each path for a team:
+
+    python src/planner.py TEAM_ID [--react fire] [--runs 3] [--shards 8]
+'''
+import argparse
+import os
+import threading
+import time
+
+import db
+import log
+
+CACHE = 'cache'
+AGGREGATE = 'aggregate'
+SCAN = 'scan'
+STRATEGIES = (CACHE, AGGREGATE, SCAN)
+
+CACHE_MAX_AGE = float(os.environ.get('ANALYTICS_CACHE_MAX_AGE', 300))
+# Teams with fewer messages than this aren't cached
+CACHE_THRESHOLD = int(os.environ.get('ANALYTICS_CACHE_THRESHOLD', 2000))
+STATS_MAX_AGE = float(os.environ.get('ANALYTICS_STATS_MAX_AGE', 600))
+FORCED_STRATEGY = os.environ.get('ANALYTICS_STRATEGY')
+
+_lock = threading.Lock()
+# (team_id, query, key) -> (computed at, Counter)
+_cache = {}
+# team_id -> (fetched at, stats)
+_stats = {}
+# (query, strategy) -> calls and seconds
+_metrics = {}
+
+
+class Plan(object):
+    def __init__(self, strategy, reason):
+        self.strategy = strategy
+        self.reason = reason
+
+    def __str__(self):
+        return '%s (%s)' % (self.strategy, self.reason)
+
+
+def team_stats(team_id):
+    '''
+    Returns:
+        dict: the team's message count and when its text aggregates were
+              last rebuilt, re-read at most every STATS_MAX_AGE
+    '''
+    with _lock:
+        cached = _stats.get(team_id)
+    if cached and time.time() - cached[0] < STATS_MAX_AGE:
+        return cached[1]
+    stats = db.get_team_stats(team_id)
+    with _lock:
+        _stats[team_id] = (time.time(), stats)
+    return stats
+
+
+def choose(team_id, cache_key, has_aggregate, strategy=None):
+    '''
+    Args:
+        team_id       (str)  : Slack team ID
+        cache_key     (tuple): Identifies the query and its arguments, less paging
+        has_aggregate (bool) : Whether the query can be answered from an aggregate
+        strategy      (str)  : Forces CACHE, AGGREGATE or SCAN
+
+    Returns:
+        Plan
+    '''
+    stats = team_stats(team_id)
+    with _lock:
+        cached = _cache.get(cache_key)
+    cache_age = time.time() - cached[0] if cached else None
+
+    strategy = strategy or FORCED_STRATEGY
+    if strategy:
+        if strategy not in STRATEGIES:
+            raise ValueError('unknown strategy ' + strategy)
+        if strategy == CACHE and cached is None:
+            return Plan(SCAN, 'forced cache but nothing cached')
+        if strategy == AGGREGATE and not has_aggregate:
+            raise ValueError('no aggregate for ' + cache_key[1])
+        return Plan(strategy, 'forced')
+
+    if cached is not None and cache_age < CACHE_MAX_AGE:
+        return Plan(CACHE, 'cached %.0fs ago' % cache_age)
+    if has_aggregate and stats['text_counts_rebuilt_at']:
+        return Plan(AGGREGATE, 'aggregate complete since %s' % stats['text_counts_rebuilt_at'])
+    reason = '%d messages' % stats['messages']
+    if has_aggregate:
+        reason += ', aggregate never rebuilt'
+    return Plan(SCAN, reason)
+
+
+def page(counter, count, offset):
+    return dict(counter.most_common(offset + count)[offset:])
+
+
+def execute(team_id, query, key, count, offset, scan, aggregate=None, strategy=None, finish=None):
+    '''
+    Answers one page of a ranking by the path choose() picks
+
+    Args:
+        team_id   (str)      : Slack team ID
+        query     (str)      : Name used in logs and metrics
+        key       (tuple)    : The query's arguments other than paging
+        count     (int)      : Number of results
+        offset    (int)      : Number of results to skip
+        scan      (function) : Returns the full Counter
+        aggregate (function) : Called with (count, offset), returns the page as a dict
+        strategy  (str)      : Forces a path
+        finish    (function) : Maps the scanned or cached Counter to the one that's
+                               paged. Anything the call depends on beyond key goes
+                               here, since only scan's output is cached
+
+    Returns:
+        dict: result -> count for the page, most common first
+    '''
+    cache_key = (team_id, query) + tuple(key)
+    plan = choose(team_id, cache_key, aggregate is not None, strategy)
+    start = time.time()
+
+    if plan.strategy == CACHE:
+        with _lock:
+            counter = _cache[cache_key][1]
+        result = page(finish(counter) if finish else counter, count, offset)
+    elif plan.strategy == AGGREGATE:
+        result = aggregate(count, offset)
+    else:
+        counter = scan()
+        if team_stats(team_id)['messages'] >= CACHE_THRESHOLD:
+            with _lock:
+                _cache[cache_key] = (time.time(), counter)
+        result = page(finish(counter) if finish else counter, count, offset)
+
+    elapsed = time.time() - start
+    with _lock:
+        metrics = _metrics.setdefault((query, plan.strategy), {'calls': 0, 'seconds': 0.0})
+        metrics['calls'] += 1
+        metrics['seconds'] += elapsed
+    log.log_info('%s for team %s: %s in %.1fms' % (query, team_id, plan, elapsed * 1000))
+    return result
+
+
+def metrics():
+    '''
+    Returns:
+        dict: (query, strategy) -> calls and total seconds, for this process
+    '''
+    with _lock:
+        return {key: dict(value) for key, value in _metrics.items()}
+
+
+def metric_lines():
+    '''
+    Returns:
+        list: one line per query and path, most time spent first
+    '''
+    rows = sorted(metrics().items(), key=lambda item: item[1]['seconds'], reverse=True)
+    return ['%s via %s: %d calls, %.1fms avg' % (query, strategy, m['calls'], m['seconds'] * 1000 / m['calls'])
+            for (query, strategy), m in rows]
+
+
+def clear_cache(team_id=None):
+    with _lock:
+        for key in [k for k in _cache if team_id is None or k[0] == team_id]:
+            del _cache[key]
+
+
+def benchmark(team_id, react_name=None, runs=3, shards=None):
+    '''
+    Times every path of each planned query for a team, scanning in this
+    many process pool shards if given
+
+    Returns:
+        dict: query -> strategy -> best of runs in ms
+    '''
+    import analytics
+    def phrases(strategy):
+        return analytics.get_common_phrases(team_id, shards=shards, strategy=strategy)
+
+    queries = {'common_phrases': (phrases, (SCAN, AGGREGATE, CACHE))}
+    if react_name:
+        queries['react_buzzword'] = (lambda strategy: analytics.react_buzzword(team_id, react_name, {}, {},
+                                                                                shards=shards, strategy=strategy),
+                                     (SCAN, CACHE))
+    results = {}
+    for query, (run, strategies) in sorted(queries.items()):
+        clear_cache(team_id)
+        results[query] = {}
+        # Scan runs first so the cache path has something to read
+        for strategy in strategies:
+            timings = []
+            for _ in range(runs):
+                start = time.time()
+                run(strategy)
+                timings.append((time.time() - start) * 1000)
+            results[query][strategy] = round(min(timings), 1)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each analytics execution path for a team')
+    parser.add_argument('team_id')
+    parser.add_argument('--react', help='also time react_buzzword for this react')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--shards', type=int, default=None, help='scan in this many parallel shards')
+    args = parser.parse_args(argv)
+    for query, timings in sorted(benchmark(args.team_id, args.react, args.runs, args.shards).items()):
+        print(query)
+        for strategy, ms in sorted(timings.items(), key=lambda item: item[1]):
+            print('  %-10s %8.1fms' % (strategy, ms))
+
+
+if __name__ == '__main__':
+    main()
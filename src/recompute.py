@@ -0,0 +1,148 @@
+'''
+Sharded recompute of the text analytics.
+
+Splits a team's messages into MessageID ranges, tokenizes and counts each
+range in a process pool while streaming it from the database, and merges the
+partial Counters in shard order. Merging in MessageID order means the result
+is identical to the serial path, ties included.
+
+    python src/recompute.py TEAM_ID [--shards 8] [--workers 4] [--count 10] [--write]
+
+With --write the result replaces the team's WordCounts and PhraseCounts,
+e.g. after the stop word list changes, and ReactPairs is recounted.
+'''
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import analytics
+import db
+import log
+
+
+def log_progress(done, total, messages):
+    log.log_info('recompute: %d/%d shards done, %d messages counted' % (done, total, messages))
+
+
+def count_texts(texts):
+    '''
+    Returns:
+        tuple: (messages counted, per message unique word Counter, phrase Counter)
+    '''
+    words = Counter()
+    phrases = Counter()
+    messages = 0
+    for text in texts:
+        if not text:
+            continue
+        messages += 1
+        words.update(analytics.message_words(text))
+        phrases.update(analytics.message_phrases(text))
+    return messages, words, phrases
+
+
+def _count_range(args):
+    index, team_id, low, high = args
+    return (index, ) + count_texts(db.iter_message_texts_in_range(team_id, low, high))
+
+
+def _count_ids(args):
+    index, team_id, msg_ids = args
+    texts = db.get_message_text_from_ids(team_id, msg_ids)
+    return (index, ) + count_texts(texts[msg_id] for msg_id in sorted(texts))
+
+
+def _run(tasks, worker, max_workers, progress):
+    ''' Runs the shard tasks and merges their Counters in shard order '''
+    results = {}
+    messages = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker, task) for task in tasks]
+        for future in as_completed(futures):
+            index, shard_messages, words, phrases = future.result()
+            results[index] = (words, phrases)
+            messages += shard_messages
+            if progress:
+                progress(len(results), len(tasks), messages)
+
+    words = Counter()
+    phrases = Counter()
+    for index in sorted(results):
+        words.update(results[index][0])
+        phrases.update(results[index][1])
+    return words, phrases
+
+
+def default_shards():
+    return os.cpu_count() or 1
+
+
+def recompute(team_id, shards=None, max_workers=None, progress=log_progress):
+    '''
+    Recounts a team's whole corpus in parallel
+
+    Args:
+        team_id     (str)      : Slack team ID
+        shards      (int)      : Number of MessageID ranges to split into
+        max_workers (int)      : Process pool size, defaults to the CPU count
+        progress    (function) : Called with (shards done, total shards, messages counted)
+
+    Returns:
+        tuple: (per message unique word Counter, phrase Counter)
+    '''
+    shards = shards or default_shards()
+    ranges = db.get_message_id_shards(team_id, shards)
+    tasks = [(i, team_id, low, high) for i, (low, high) in enumerate(ranges)]
+    return _run(tasks, _count_range, max_workers, progress)
+
+
+def unique_words(team_id, msg_ids, shards=None, max_workers=None, progress=log_progress):
+    '''
+    Parallel version of analytics.get_unique_words' counting step for an
+    explicit set of messages
+
+    Returns:
+        Counter: untranslated words, counted once per message
+    '''
+    shards = shards or default_shards()
+    msg_ids = sorted(msg_ids)
+    size = max(1, -(-len(msg_ids) // shards))
+    tasks = [(i, team_id, msg_ids[start:start + size])
+             for i, start in enumerate(range(0, len(msg_ids), size))]
+    words, _ = _run(tasks, _count_ids, max_workers, progress)
+    return words
+
+
+def rebuild_aggregates(team_id, shards=None, max_workers=None, progress=log_progress):
+    ''' Recomputes a team's text aggregates and stores them '''
+    words, phrases = recompute(team_id, shards, max_workers, progress)
+    db.replace_text_counts(team_id, words, Counter({' '.join(p): c for p, c in phrases.items()}))
+    db.rebuild_react_pairs(team_id)
+    return words, phrases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recompute text analytics for a team in parallel')
+    parser.add_argument('team_id')
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--write', action='store_true',
+                        help='store the result as the team\'s text aggregates')
+    args = parser.parse_args(argv)
+
+    if args.write:
+        words, phrases = rebuild_aggregates(args.team_id, args.shards, args.workers)
+    else:
+        words, phrases = recompute(args.team_id, args.shards, args.workers)
+    print('Common phrases:')
+    for phrase, count in phrases.most_common(args.count):
+        print('  %s : %d' % (' '.join(phrase), count))
+    print('Most used words:')
+    for word, count in words.most_common(args.count):
+        print('  %s : %d' % (word, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+'''
+Bounded memory sketches behind the approximate commands.
+
+Each team's sketches are stored in the Sketches table, one row per part.
+The query process builds them from the database the first time they're
+asked for and again once they're SKETCH_MAX_AGE old. In between, writers
+fold what they ingest into a per-team delta and merge it into the stored
+parts every CHECKPOINT_INTERVAL, like trending does with TrendCounts. The
+query process rereads the stored parts at most every REFRESH_INTERVAL.
+Every sketch here is mergeable, so a merged delta keeps its error bounds.
+Parts are stored as JSON of their counters and registers, never pickled,
+so reading the table can't run code.
+'''
+import base64
+import hashlib
+import heapq
+import json
+import math
+import os
+import struct
+import threading
+import time
+
+import db
+import log
+from util import StagedCalls
+
+# Sketches only grow, so deleted and edited messages are only taken out
+# of them by a rebuild from the database, which happens this often
+SKETCH_MAX_AGE = float(os.environ.get('SKETCH_MAX_AGE', 86400))
+REFRESH_INTERVAL = float(os.environ.get('SKETCH_REFRESH_INTERVAL', 60))
+CHECKPOINT_INTERVAL = float(os.environ.get('SKETCH_CHECKPOINT_INTERVAL', 60))
+PHRASE_CAPACITY = int(os.environ.get('SKETCH_PHRASE_CAPACITY', 2000))
+USER_CAPACITY = int(os.environ.get('SKETCH_USER_CAPACITY', 500))
+WORD_CAPACITY = int(os.environ.get('SKETCH_WORD_CAPACITY', 200))
+MAX_TRACKED_REACTS = int(os.environ.get('SKETCH_MAX_TRACKED_REACTS', 500))
+
+
+def _hashes(key, count):
+    ''' Returns count independent 32 bit hashes of key '''
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    digest = hashlib.blake2b(key, digest_size=4 * count).digest()
+    return struct.unpack('<%dI' % count, digest)
+
+
+class CountMinSketch(object):
+    '''
+    Point frequency estimates in width * depth counters. Estimates never
+    undercount and overcount by at most error_bound() with probability
+    1 - e^-depth.
+    '''
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.tables = [[0] * width for _ in range(depth)]
+
+    def add(self, key, count=1):
+        self.total += count
+        for row, h in enumerate(_hashes(key, self.depth)):
+            self.tables[row][h % self.width] += count
+
+    def estimate(self, key):
+        return min(self.tables[row][h % self.width]
+                   for row, h in enumerate(_hashes(key, self.depth)))
+
+    def error_bound(self):
+        return int(math.ceil(math.e / self.width * self.total))
+
+    def merge(self, other):
+        for table, other_table in zip(self.tables, other.tables):
+            for i, count in enumerate(other_table):
+                table[i] += count
+        self.total += other.total
+
+    def to_state(self):
+        return {'width': self.width, 'depth': self.depth, 'total': self.total, 'tables': self.tables}
+
+    @classmethod
+    def from_state(cls, state):
+        counts = cls(state['width'], state['depth'])
+        counts.total = int(state['total'])
+        counts.tables = [[int(count) for count in table] for table in state['tables']]
+        if len(counts.tables) != counts.depth or any(len(table) != counts.width for table in counts.tables):
+            raise ValueError('count-min tables are not depth x width')
+        return counts
+
+
+class SpaceSaving(object):
+    '''
+    Tracks the heaviest hitters of a stream in at most capacity counters.
+    Each reported count overestimates the true count by at most its error,
+    and no item's error exceeds total / capacity.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # Lazily invalidated min-heap of (count, key)
+        self.heap = []
+
+    def add(self, key, count=1):
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            min_count, min_key = self._pop_min()
+            del self.counts[min_key]
+            del self.errors[min_key]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+        heapq.heappush(self.heap, (self.counts[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def min_count(self):
+        ''' Most an item that isn't tracked can have been counted, 0 until the summary fills '''
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        '''
+        Adds another summary's counts. An item only one side tracks is
+        credited the other side's min_count() as both count and error, so
+        estimates still never undercount and errors stay within the bound.
+        '''
+        floor, other_floor = self.min_count(), other.min_count()
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, floor) + other.counts.get(key, other_floor)
+            errors[key] = self.errors.get(key, floor) + other.errors.get(key, other_floor)
+        keep = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = {key: counts[key] for key in keep}
+        self.errors = {key: errors[key] for key in keep}
+        self.total += other.total
+        self.heap = [(c, k) for k, c in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def to_state(self):
+        # The heap is rebuilt on load rather than stored
+        return {'capacity': self.capacity, 'total': self.total,
+                'items': [[key, count, self.errors[key]] for key, count in self.counts.items()]}
+
+    @classmethod
+    def from_state(cls, state):
+        summary = cls(int(state['capacity']))
+        summary.total = int(state['total'])
+        for key, count, error in state['items']:
+            # JSON turns tuple keys, like phrases, into lists
+            key = tuple(key) if isinstance(key, list) else key
+            summary.counts[key] = int(count)
+            summary.errors[key] = int(error)
+        summary.heap = [(c, k) for k, c in summary.counts.items()]
+        heapq.heapify(summary.heap)
+        return summary
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return count, key
+
+    def top(self, k):
+        '''
+        Returns:
+            list: (item, estimated count, max overestimate) for the k heaviest items
+        '''
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(key, count, self.errors[key]) for key, count in items]
+
+    def error_bound(self):
+        return int(math.ceil(self.total / float(self.capacity)))
+
+
+class HyperLogLog(object):
+    ''' Distinct count estimate in 2^precision registers '''
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, key):
+        h1, h2 = _hashes(key, 2)
+        x = (h1 << 32) | h2
+        index = x >> (64 - self.precision)
+        rest = (x << self.precision) & ((1 << 64) - 1)
+        rank = 1
+        while rank <= 64 - self.precision and not rest & (1 << 63):
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.m * math.log(self.m / float(zeros))
+        return int(round(estimate))
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def to_state(self):
+        return {'precision': self.precision,
+                'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_state(cls, state):
+        distinct = cls(int(state['precision']))
+        registers = bytearray(base64.b64decode(state['registers']))
+        if len(registers) != distinct.m:
+            raise ValueError('expected %d registers, got %d' % (distinct.m, len(registers)))
+        distinct.registers = registers
+        return distinct
+
+
+class TeamSketches(object):
+    '''
+    Bounded memory summaries of one team's data, kept up to date as events
+    are ingested
+    '''
+
+    # Prefix of the part each react's word summary is stored under
+    REACT_WORDS = 'react_words/'
+
+    def __init__(self, built_at=None):
+        self.built_at = built_at or time.time()
+        self.phrases = SpaceSaving(PHRASE_CAPACITY)
+        self.reactors = SpaceSaving(USER_CAPACITY)
+        self.react_counts = CountMinSketch()
+        self.distinct_reacts = HyperLogLog()
+        # react name -> SpaceSaving of words on messages carrying that react
+        self.react_words = {}
+
+    def is_stale(self):
+        return time.time() - self.built_at > SKETCH_MAX_AGE
+
+    def add_message_phrases(self, phrases):
+        for phrase in phrases:
+            self.phrases.add(phrase)
+
+    def add_react(self, user_id, react_name, count=1):
+        self.reactors.add(user_id, count)
+        self.react_counts.add(react_name, count)
+        self.distinct_reacts.add(react_name)
+
+    def add_react_words(self, react_name, words):
+        sketch = self.react_words.get(react_name)
+        if sketch is None:
+            if len(self.react_words) >= MAX_TRACKED_REACTS:
+                # Keep memory bounded by dropping the least used react
+                coldest = min(self.react_words, key=lambda r: self.react_words[r].total)
+                del self.react_words[coldest]
+            sketch = self.react_words[react_name] = SpaceSaving(WORD_CAPACITY)
+        for word in words:
+            sketch.add(word)
+
+    def parts(self):
+        '''
+        Returns:
+            dict: part name -> sketch, as stored in the Sketches table
+        '''
+        parts = {'phrases': self.phrases,
+                 'reactors': self.reactors,
+                 'react_counts': self.react_counts,
+                 'distinct_reacts': self.distinct_reacts}
+        for react_name, words in self.react_words.items():
+            parts[self.REACT_WORDS + react_name] = words
+        return parts
+
+    def merge(self, other):
+        parts = self.parts()
+        for name, part in other.parts().items():
+            if name in parts:
+                parts[name].merge(part)
+            else:
+                self.react_words[name[len(self.REACT_WORDS):]] = part
+
+    @classmethod
+    def from_parts(cls, parts, built_at):
+        '''
+        Args:
+            parts    (dict)  : part name -> sketch
+            built_at (float) : When the stored sketches were last built
+        '''
+        sketches = cls(built_at)
+        for name, part in parts.items():
+            if name.startswith(cls.REACT_WORDS):
+                sketches.react_words[name[len(cls.REACT_WORDS):]] = part
+            elif name in ('phrases', 'reactors', 'react_counts', 'distinct_reacts'):
+                setattr(sketches, name, part)
+        if len(sketches.react_words) > MAX_TRACKED_REACTS:
+            # Writers add reacts without evicting, keep the most used
+            keep = heapq.nlargest(MAX_TRACKED_REACTS, sketches.react_words,
+                                  key=lambda r: sketches.react_words[r].total)
+            sketches.react_words = {r: sketches.react_words[r] for r in keep}
+        return sketches
+
+
+# Sketch classes a stored part can be, by the name it's stored under
+PART_TYPES = {cls.__name__: cls for cls in (CountMinSketch, SpaceSaving, HyperLogLog)}
+
+
+def dumps(part):
+    state = part.to_state()
+    state['type'] = type(part).__name__
+    return json.dumps(state, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    '''
+    Raises:
+        ValueError: data isn't a stored sketch, like parts pickled by older
+                    versions, which are rebuilt rather than read
+    '''
+    try:
+        state = json.loads(bytes(data).decode('utf-8'))
+        return PART_TYPES[state['type']].from_state(state)
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('unreadable sketch part: %r' % e)
+
+
+def merge_part(stored, delta):
+    '''
+    Merges a serialized delta into a serialized stored part. An unreadable
+    stored part is left as it is, so the query process rebuilds the team's
+    sketches from the tables, which include the delta.
+    '''
+    try:
+        part = loads(stored)
+    except ValueError:
+        return stored
+    part.merge(loads(delta))
+    return dumps(part)
+
+
+_lock = threading.Lock()
+# team_id -> (loaded at, TeamSketches) in the process answering queries
+_teams = {}
+# team_id -> TeamSketches of what this writer ingested since its last checkpoint
+_pending = {}
+_last_checkpoint = [time.time()]
+# Observations made while handling a batch of events wait here until it commits
+staged = StagedCalls()
+
+
+def get(team_id):
+    ''' Returns the team's sketches if they were loaded within REFRESH_INTERVAL '''
+    with _lock:
+        loaded = _teams.get(team_id)
+    if loaded is None or time.time() - loaded[0] > REFRESH_INTERVAL:
+        return None
+    return loaded[1]
+
+
+def replace(team_id, sketches):
+    with _lock:
+        _teams[team_id] = (time.time(), sketches)
+
+
+def load(team_id):
+    '''
+    Returns:
+        TeamSketches: the team's stored sketches, or None if they've never
+                      been built or are older than SKETCH_MAX_AGE
+    '''
+    built_at, parts = db.get_sketch_parts(team_id)
+    if built_at is None:
+        return None
+    try:
+        parts = {name: loads(data) for name, data in parts.items()}
+    except ValueError as e:
+        log.log_info('rebuilding sketches for %s: %s' % (team_id, e))
+        return None
+    sketches = TeamSketches.from_parts(parts, built_at)
+    if sketches.is_stale():
+        return None
+    replace(team_id, sketches)
+    return sketches
+
+
+def save(team_id, sketches):
+    ''' Stores freshly built sketches in place of the team's current ones '''
+    db.replace_sketch_parts(team_id, {name: dumps(part) for name, part in sketches.parts().items()},
+                            sketches.built_at)
+    replace(team_id, sketches)
+
+
+def observe(team_id, update, *args):
+    '''
+    Applies update(delta, *args) to the team's pending delta, once the batch
+    being handled commits
+
+    Args:
+        update (function) : A TeamSketches method, e.g. TeamSketches.add_react
+    '''
+    staged.call(_observe, team_id, update, args)
+
+
+def _observe(team_id, update, args):
+    with _lock:
+        delta = _pending.get(team_id)
+        if delta is None:
+            delta = _pending[team_id] = TeamSketches()
+        update(delta, *args)
+
+
+def checkpoint():
+    ''' Merges every team's pending delta into its stored sketches '''
+    with _lock:
+        pending = list(_pending.items())
+        _pending.clear()
+    for i, (team_id, delta) in enumerate(pending):
+        try:
+            db.merge_sketch_parts(team_id, {name: dumps(part) for name, part in delta.parts().items()},
+                                  merge_part)
+        except Exception:
+            # Put the rest back so the next checkpoint retries them
+            with _lock:
+                for team_id, delta in pending[i:]:
+                    if team_id in _pending:
+                        delta.merge(_pending[team_id])
+                    _pending[team_id] = delta
+            raise
+    _last_checkpoint[0] = time.time()
+
+
+def maybe_checkpoint():
+    if time.time() - _last_checkpoint[0] > CHECKPOINT_INTERVAL:
+        try:
+            checkpoint()
+        except Exception as e:
+            log.log_error('sketch checkpoint failed: ' + str(e))
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import log
+
+# Point this at a local stub server to run without talking to Slack
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api/')
+POOL_SIZE = int(os.environ.get('SLACK_POOL_SIZE', 10))
+REQUEST_TIMEOUT = float(os.environ.get('SLACK_TIMEOUT', 10))
+MAX_RETRIES = 3
+PAGE_LIMIT = 200
+# Errors meaning the client's token no longer works, see SlackWebClient.revoked
+AUTH_ERRORS = ('invalid_auth', 'token_revoked', 'account_inactive')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''
+    Returns the process wide keep-alive session. Sessions aren't fork safe,
+    so a new one is created if we're in a different process than the one
+    that built it.
+    '''
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+class RateLimiter(object):
+    '''
+    Tracks Retry-After windows per API method so every caller in the process
+    backs off once Slack starts returning 429s for that method
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocked_until = {}
+
+    def delay(self, method):
+        with self.lock:
+            return max(0.0, self.blocked_until.get(method, 0.0) - time.time())
+
+    def block(self, method, seconds):
+        with self.lock:
+            until = time.time() + seconds
+            if until > self.blocked_until.get(method, 0.0):
+                self.blocked_until[method] = until
+
+
+rate_limiter = RateLimiter()
+
+
+class SlackWebClient(object):
+    def __init__(self, token, base_url=None):
+        self.token = token
+        self.base_url = base_url or SLACK_API_URL
+        if not self.base_url.endswith('/'):
+            self.base_url += '/'
+        self.dm_channels = {}
+        # Set once a call fails because the token was revoked, so whoever
+        # cached this client can replace it
+        self.revoked = False
+
+    def _request(self, method, params):
+        '''
+        Makes a single call to the Web API
+
+        Returns:
+            tuple: (response dict, seconds to wait before retrying or None)
+        '''
+        import requests
+        data = dict(params)
+        data.setdefault('token', self.token)
+        try:
+            resp = get_session().post(self.base_url + method, data=data, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            return {'ok': False, 'error': str(e)}, None
+
+        if resp.status_code == 429:
+            retry_after = float(resp.headers.get('Retry-After', 1))
+            return {'ok': False, 'error': 'ratelimited'}, retry_after
+
+        try:
+            return resp.json(), None
+        except ValueError:
+            return {'ok': False, 'error': 'invalid_response', 'status': resp.status_code}, None
+
+    def api_call(self, method, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            wait = rate_limiter.delay(method)
+            if wait:
+                time.sleep(wait)
+            result, retry_after = self._request(method, kwargs)
+            if retry_after is None:
+                if result.get('error') in AUTH_ERRORS:
+                    self.revoked = True
+                return result
+            log.log_info('%s rate limited, retrying in %ss' % (method, retry_after))
+            rate_limiter.block(method, retry_after)
+        return result
+
+    def paginate(self, method, **kwargs):
+        '''
+        Yields each page of a cursor paginated method, stopping on the first
+        failed response
+        '''
+        kwargs.setdefault('limit', PAGE_LIMIT)
+        while True:
+            page = self.api_call(method, **kwargs)
+            yield page
+            if not page.get('ok'):
+                return
+            next_cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not next_cursor:
+                return
+            kwargs['cursor'] = next_cursor
+
+    def dm_channel(self, user_id):
+        ''' Returns the DM channel ID for a user, only calling im.open on a cache miss '''
+        channel_id = self.dm_channels.get(user_id)
+        if channel_id:
+            return channel_id
+
+        resp = self.api_call('im.open', user=user_id)
+        if not resp.get('ok'):
+            return None
+        channel_id = resp['channel']['id']
+        self.dm_channels[user_id] = channel_id
+        return channel_id
+
+    def post_dm(self, user_id, text, **kwargs):
+        channel_id = self.dm_channel(user_id)
+        if not channel_id:
+            return {'ok': False, 'error': 'im_open_failed'}
+
+        resp = self.api_call('chat.postMessage', channel=channel_id, text=text, **kwargs)
+        if resp.get('error') in ('channel_not_found', 'is_archived'):
+            # The cached channel went stale, open a fresh one and retry once
+            self.dm_channels.pop(user_id, None)
+            channel_id = self.dm_channel(user_id)
+            if channel_id:
+                resp = self.api_call('chat.postMessage', channel=channel_id, text=text, **kwargs)
+        return resp
+
+
+
+class AsyncSlackWebClient(object):
+    '''
+    asyncio entry point for SlackWebClient. Each call runs the blocking
+    client on a pool no bigger than the connection pool, so it shares the
+    keep-alive session, the DM channel cache and the rate limiter.
+    '''
+
+    def __init__(self, token, base_url=None, concurrency=POOL_SIZE):
+        self.client = SlackWebClient(token, base_url)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def api_call(self, method, **kwargs):
+        return await self._run(self.client.api_call, method, **kwargs)
+
+    async def api_call_many(self, calls):
+        '''
+        Runs a batch of calls concurrently
+
+        Args:
+            calls (list) : (method, kwargs) tuples
+
+        Returns:
+            list: responses in the same order as calls
+        '''
+        return await asyncio.gather(*[self.api_call(method, **kwargs) for method, kwargs in calls])
+
+    async def post_dm(self, user_id, text, **kwargs):
+        return await self._run(self.client.post_dm, user_id, text, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,92 @@
+'''
+Startup-time benchmark for the web/worker entry point.
+
+Runs ``python -X importtime -c "import app"`` in a fresh interpreter and
+fails if the cumulative import time goes over budget or if any module that
+should only be loaded on first use shows up during import.
+
+    python src/startup_bench.py [--module app] [--budget-ms 750] [--runs 5]
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', 750))
+
+# Modules that must stay off the import path of the entry point
+LAZY_MODULES = ['nltk', 'requests', 'psycopg2']
+
+
+def parse_importtime(stderr):
+    '''
+    Parses the output of -X importtime
+
+    Returns:
+        list: (module, self_us, cumulative_us) tuples in import order
+    '''
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # header row
+            continue
+        rows.append((fields[2].strip(), self_us, cumulative_us))
+    return rows
+
+
+def measure(module):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          cwd=SRC_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    rows = parse_importtime(proc.stderr)
+    if proc.returncode != 0:
+        raise RuntimeError('Importing %s failed:\n%s' % (module, proc.stderr[-2000:]))
+    total_us = next(cum for name, _, cum in reversed(rows) if name == module)
+    return total_us, rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    timings = []
+    rows = []
+    for _ in range(args.runs):
+        total_us, rows = measure(args.module)
+        timings.append(total_us / 1000.0)
+    best_ms = min(timings)
+
+    print('import %s: best %.1f ms, median %.1f ms over %d runs (budget %.1f ms)'
+          % (args.module, best_ms, sorted(timings)[len(timings) // 2], args.runs, args.budget_ms))
+    print('Slowest modules (self time):')
+    for name, self_us, cum_us in sorted(rows, key=lambda r: r[1], reverse=True)[:args.top]:
+        print('  %8.1f ms  %8.1f ms  %s' % (self_us / 1000.0, cum_us / 1000.0, name))
+
+    failed = False
+    loaded = {name.split('.')[0] for name, _, _ in rows}
+    eager = [m for m in LAZY_MODULES if m in loaded]
+    if eager:
+        print('FAIL: imported eagerly at startup: ' + ', '.join(eager))
+        failed = True
+    if best_ms > args.budget_ms:
+        print('FAIL: startup %.1f ms exceeds budget of %.1f ms' % (best_ms, args.budget_ms))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
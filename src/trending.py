@@ -0,0 +1,235 @@
+'''
+Trending reacts and phrases: what's being used much more in the last hour
+or day than its recent baseline.
+
+Usage is counted in fixed size time buckets. Writers only sum the events
+they ingest per bucket and checkpoint those sums to the TrendCounts table
+every CHECKPOINT_INTERVAL, which is also how the process answering /reacts
+trending sees them: it loads the team's recent buckets into a ring per react
+and phrase, ranks everything once and serves pages of the ranking until it's
+REFRESH_INTERVAL old.
+'''
+import os
+import threading
+import time
+from array import array
+
+import db
+import log
+from util import StagedCalls
+
+BUCKET_SECONDS = int(os.environ.get('TREND_BUCKET_SECONDS', 3600))
+# Enough buckets for the day window plus a week of baseline before it
+RING_BUCKETS = int(os.environ.get('TREND_RING_BUCKETS', 24 * 8))
+CHECKPOINT_INTERVAL = float(os.environ.get('TREND_CHECKPOINT_INTERVAL', 60))
+REFRESH_INTERVAL = float(os.environ.get('TREND_REFRESH_INTERVAL', 120))
+# Usage in the window below this is never trending
+MIN_COUNT = int(os.environ.get('TREND_MIN_COUNT', 3))
+# ...and needs to be at least this many times its baseline
+MIN_RATIO = float(os.environ.get('TREND_MIN_RATIO', 2))
+# Rankings keep this many entries, which bounds the pages that can be asked for
+MAX_RANKED = 500
+
+KIND_REACT = 'react'
+KIND_PHRASE = 'phrase'
+
+HOUR = 'hour'
+DAY = 'day'
+# window -> (buckets in the window, windows of baseline before it)
+WINDOWS = {HOUR: (max(1, 3600 // BUCKET_SECONDS), 24),
+           DAY: (max(1, 86400 // BUCKET_SECONDS), 7)}
+
+
+def bucket_of(ts=None):
+    return int((ts or time.time()) // BUCKET_SECONDS)
+
+
+class RingCounter(object):
+    ''' Counts per bucket for the last RING_BUCKETS buckets '''
+
+    def __init__(self, size=RING_BUCKETS):
+        self.size = size
+        self.counts = array('l', [0]) * size
+        # Newest bucket written, slots older than size buckets before it are stale
+        self.head = None
+
+    def add(self, bucket, count=1):
+        if self.head is None:
+            self.head = bucket
+        elif bucket > self.head:
+            # Clear the slots being reused for buckets between head and bucket
+            for b in range(self.head + 1, min(bucket, self.head + self.size) + 1):
+                self.counts[b % self.size] = 0
+            self.head = bucket
+        elif bucket <= self.head - self.size:
+            # Too old to keep
+            return
+        self.counts[bucket % self.size] += count
+
+    def window(self, end, length):
+        ''' Sums the length buckets ending with bucket end '''
+        if self.head is None:
+            return 0
+        total = 0
+        for b in range(end - length + 1, end + 1):
+            if self.head - self.size < b <= self.head:
+                total += self.counts[b % self.size]
+        return total
+
+    def total(self):
+        return sum(self.counts)
+
+
+class TrendCounters(object):
+    '''
+    Counts for one team. Writers only fill pending, which checkpoint empties;
+    the rings per kind and key are only built by load() for ranking.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rings = {KIND_REACT: {}, KIND_PHRASE: {}}
+        # (kind, key, bucket) -> count not yet checkpointed
+        self.pending = {}
+
+    def add(self, kind, key, bucket, count=1):
+        with self.lock:
+            pending_key = (kind, key, bucket)
+            self.pending[pending_key] = self.pending.get(pending_key, 0) + count
+
+    def add_checkpointed(self, kind, key, bucket, count):
+        with self.lock:
+            ring = self.rings[kind].get(key)
+            if ring is None:
+                ring = self.rings[kind][key] = RingCounter()
+            ring.add(bucket, count)
+
+    def take_pending(self):
+        ''' Returns and clears the counts added since the last call '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def rank(self, window, now_bucket=None):
+        '''
+        Scores every key by how far its usage in the window is above its
+        average over the baseline windows before it
+
+        Returns:
+            dict: kind -> list of (key, count in window, baseline average, ratio),
+                  hottest first
+        '''
+        length, baseline_windows = WINDOWS[window]
+        end = now_bucket if now_bucket is not None else bucket_of()
+        ranked = {}
+        with self.lock:
+            for kind, rings in self.rings.items():
+                scores = []
+                for key, ring in rings.items():
+                    current = ring.window(end, length)
+                    if current < MIN_COUNT:
+                        continue
+                    baseline = ring.window(end - length, length * baseline_windows) / float(baseline_windows)
+                    ratio = (current + 1) / (baseline + 1)
+                    if ratio >= MIN_RATIO:
+                        scores.append((key, current, baseline, ratio))
+                scores.sort(key=lambda score: (score[3], score[1]), reverse=True)
+                ranked[kind] = scores[:MAX_RANKED]
+        return ranked
+
+
+_counters = {}
+_counters_lock = threading.Lock()
+_last_checkpoint = [time.time()]
+# Observations made while handling a batch of events wait here until it commits
+staged = StagedCalls()
+# (team_id, window) -> (ranked at, ranking)
+_rankings = {}
+
+
+def counters(team_id):
+    with _counters_lock:
+        team_counters = _counters.get(team_id)
+        if team_counters is None:
+            team_counters = _counters[team_id] = TrendCounters()
+        return team_counters
+
+
+def observe_react(team_id, react_name, ts=None):
+    staged.call(_observe_react, team_id, react_name, ts)
+
+
+def _observe_react(team_id, react_name, ts):
+    counters(team_id).add(KIND_REACT, react_name, bucket_of(ts))
+
+
+def observe_phrases(team_id, phrases, ts=None):
+    staged.call(_observe_phrases, team_id, list(phrases), ts)
+
+
+def _observe_phrases(team_id, phrases, ts):
+    team_counters = counters(team_id)
+    bucket = bucket_of(ts)
+    for phrase in phrases:
+        team_counters.add(KIND_PHRASE, ' '.join(phrase), bucket)
+
+
+def checkpoint():
+    ''' Writes every team's new counts to the database and drops expired buckets '''
+    with _counters_lock:
+        teams = list(_counters.items())
+    oldest = bucket_of() - RING_BUCKETS
+    for team_id, team_counters in teams:
+        pending = team_counters.take_pending()
+        if not pending:
+            continue
+        try:
+            db.add_trend_counts(team_id, pending, oldest)
+        except Exception:
+            # Put them back so the next checkpoint retries them
+            with team_counters.lock:
+                for key, count in pending.items():
+                    team_counters.pending[key] = team_counters.pending.get(key, 0) + count
+            raise
+    _last_checkpoint[0] = time.time()
+
+
+def maybe_checkpoint():
+    if time.time() - _last_checkpoint[0] > CHECKPOINT_INTERVAL:
+        try:
+            checkpoint()
+        except Exception as e:
+            log.log_error('trend checkpoint failed: ' + str(e))
+
+
+def load(team_id):
+    '''
+    Rebuilds a team's counters from the checkpointed buckets
+
+    Returns:
+        TrendCounters
+    '''
+    now = bucket_of()
+    length, _ = WINDOWS[DAY]
+    team_counters = TrendCounters()
+    rows = db.get_trend_counts(team_id, now - RING_BUCKETS + 1, now - length + 1, MIN_COUNT)
+    for kind, key, bucket, count in rows:
+        team_counters.add_checkpointed(kind, key, bucket, count)
+    return team_counters
+
+
+def trending(team_id, window=HOUR, count=10, offset=0):
+    '''
+    Args:
+        team_id (str) : Slack team ID
+        window  (str) : HOUR or DAY
+        count   (int) : Entries per kind
+        offset  (int) : Entries to skip
+
+    Returns:
+        dict: kind -> list of (key, count in window, baseline average, ratio)
+    '''
+    cached = _rankings.get((team_id, window))
+    if cached is None or time.time() - cached[0] > REFRESH_INTERVAL:
+        cached = _rankings[(team_id, window)] = (time.time(), load(team_id).rank(window))
+    return {kind: ranked[offset:offset + count] for kind, ranked in cached[1].items()}
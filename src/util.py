@@ -1,3 +1,22 @@
+import hashlib
+import hmac
+import re
+
+def ngrams(sequence, n):
+    '''
+    Yields every run of n consecutive items in sequence as a tuple,
+    matching nltk.util.ngrams without padding
+    '''
+    sequence = list(sequence)
+    return zip(*(sequence[i:] for i in range(n)))
+
+def sign_request(secret, timestamp, body):
+    ''' Computes Slack's v0 request signature for a raw request body '''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    base = ('v0:%s:' % timestamp).encode('utf-8') + body
+    return 'v0=' + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+
 def msg_id_string(channel_id, time_stamp):
     return channel_id + time_stamp
 
@@ -15,6 +34,110 @@ class Message:
         self.user_id = user_id
         self.text = text
 
+# Block Kit limits for a section's text and for blocks per message
+BLOCK_TEXT_LIMIT = 3000
+BLOCKS_PER_MESSAGE = 50
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+PAGE_ARG_EXPR = re.compile(r'\b(count|page)=(\d+)')
+
+class Page:
+    def __init__(self, count=DEFAULT_PAGE_SIZE, number=1):
+        self.count = max(1, min(count, MAX_PAGE_SIZE))
+        self.number = max(1, number)
+        self.offset = (self.number - 1) * self.count
+
+def parse_page(text):
+    '''
+    Pulls count=N and page=N out of slash command arguments
+
+    Returns:
+        tuple: (remaining text, Page)
+    '''
+    args = dict((key, int(value)) for key, value in PAGE_ARG_EXPR.findall(text))
+    text = PAGE_ARG_EXPR.sub('', text).strip()
+    return text, Page(args.get('count', DEFAULT_PAGE_SIZE), args.get('page', 1))
+
+class StagedCalls:
+    '''
+    Defers in-memory updates made while a batch transaction is open so they
+    only take effect if it commits, like coalesce.ReactBuffer does for counts
+    '''
+    def __init__(self):
+        self.staged = None
+
+    def call(self, func, *args):
+        if self.staged is not None:
+            self.staged.append((func, args))
+        else:
+            func(*args)
+
+    def stage(self):
+        ''' Holds further calls back until commit_staged() or discard_staged() '''
+        self.staged = []
+
+    def mark(self):
+        return len(self.staged) if self.staged is not None else 0
+
+    def commit_staged(self):
+        staged, self.staged = self.staged or [], None
+        for func, args in staged:
+            func(*args)
+
+    def discard_staged(self, mark=None):
+        ''' Drops the calls staged since mark, or all of them and stops staging '''
+        if mark is None:
+            self.staged = None
+        elif self.staged is not None:
+            del self.staged[mark:]
+
+def truncate(text, length=300):
+    if len(text) <= length:
+        return text
+    return text[:length - 1] + '…'
+
+def chunk_blocks(lines, text_limit=BLOCK_TEXT_LIMIT, max_blocks=BLOCKS_PER_MESSAGE):
+    '''
+    Packs lines into Block Kit section blocks, yielding a message's worth of
+    blocks as soon as it fills so long results can be sent progressively
+    '''
+    blocks = []
+    for text in _block_texts(lines, text_limit):
+        blocks.append(_section(text))
+        if len(blocks) >= max_blocks:
+            yield blocks
+            blocks = []
+    if blocks:
+        yield blocks
+
+def _block_texts(lines, text_limit):
+    ''' Joins lines into texts of at most text_limit characters '''
+    current = []
+    size = 0
+    for line in lines:
+        split = False
+        while len(line) > text_limit:
+            # A single line too long for a block gets split across blocks
+            head, line = line[:text_limit], line[text_limit:]
+            if current:
+                yield '\n'.join(current)
+                current, size = [], 0
+            yield head
+            split = True
+        if split and not line:
+            continue
+        if size + len(line) + 1 > text_limit and current:
+            yield '\n'.join(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        yield '\n'.join(current)
+
+def _section(text):
+    return {'type': 'section', 'text': {'type': 'mrkdwn', 'text': text}}
+
 def time_it(func):
     from functools import wraps
     @wraps(func)
@@ -0,0 +1,27 @@
+'''
+Event log writer. Run as many of these as ingestion needs; they share the
+stream through the consumer group.
+
+    python src/writer.py [consumer-name]
+
+The consumer name must be stable across restarts so a restarted writer
+replays its own unacknowledged entries. It defaults to the Heroku dyno name.
+'''
+import os
+import signal
+import socket
+import sys
+
+from bot import Bot
+
+
+def consumer_name():
+    if len(sys.argv) > 1:
+        return sys.argv[1]
+    return os.environ.get('DYNO') or socket.gethostname()
+
+
+if __name__ == '__main__':
+    # Exit through SystemExit on SIGTERM so the writer can flush what it holds
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    Bot().run_writer(consumer_name())
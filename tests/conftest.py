@@ -0,0 +1,26 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# The app's modules import each other flat, as they do when run from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def database():
+    '''
+    Points db at TEST_DATABASE_URL and yields a team ID no other test uses.
+    Tests using it are skipped when no test database is configured.
+    '''
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL not set')
+    import db
+    db.DATABASE_URL = TEST_DATABASE_URL
+    db.DATABASE_REPLICA_URL = None
+    db.DATABASE_SSLMODE = os.environ.get('TEST_DATABASE_SSLMODE', 'disable')
+    db.create_tables()
+    yield 'T' + uuid.uuid4().hex[:10].upper()
@@ -0,0 +1,138 @@
+import bot
+
+
+def routed(event):
+    handled = []
+
+    class RecordingBot(bot.Bot):
+        def message_posted(self, slack_event):
+            handled.append('posted')
+
+        def message_removed(self, slack_event):
+            handled.append('removed')
+
+        def message_edited(self, slack_event):
+            handled.append('edited')
+
+    RecordingBot().handle_api_event(bot.Event(bot.EVENT_TYPE_API_EVENT, {'team_id': 'T1', 'event': event}))
+    return handled
+
+
+def test_user_messages_are_stored():
+    assert routed({'type': 'message', 'user': 'U1', 'text': 'hi', 'channel': 'C1', 'ts': '1.0'}) == ['posted']
+    assert routed({'type': 'message', 'subtype': 'thread_broadcast', 'user': 'U1', 'text': 'hi',
+                   'channel': 'C1', 'ts': '1.0'}) == ['posted']
+
+
+def test_notices_without_a_user_are_skipped():
+    for subtype in ('bot_message', 'channel_join', 'channel_topic', 'message_replied'):
+        assert routed({'type': 'message', 'subtype': subtype, 'channel': 'C1', 'ts': '1.0'}) == []
+
+
+def test_edits_and_deletes_are_routed():
+    assert routed({'type': 'message', 'subtype': 'message_changed', 'channel': 'C1'}) == ['edited']
+    assert routed({'type': 'message', 'subtype': 'message_deleted', 'channel': 'C1'}) == ['removed']
+
+
+def test_failing_event_is_quarantined_and_the_rest_commit(monkeypatch):
+    from contextlib import contextmanager
+
+    import db
+    import eventlog
+    import trending
+
+    team_id = 'TBATCH'
+    ts = 1500000000.0
+    dead_letters = []
+    acked = []
+    transactions = []
+
+    @contextmanager
+    def batch():
+        transactions.append('begin')
+        yield None
+        transactions.append('commit')
+
+    @contextmanager
+    def savepoint(name='handler'):
+        try:
+            yield
+        except Exception:
+            transactions.append('rollback to savepoint')
+            raise
+
+    monkeypatch.setattr(db, 'batch', batch)
+    monkeypatch.setattr(db, 'savepoint', savepoint)
+    monkeypatch.setattr(db, 'is_transient', lambda error: False)
+    monkeypatch.setattr(db, 'add_dead_letter', lambda *args: dead_letters.append(args[0]))
+    monkeypatch.setattr(eventlog, 'ack', acked.extend)
+
+    class ReactingBot(bot.Bot):
+        def handle_event(self, event):
+            trending.observe_react(team_id, event.event_info['react'], ts)
+            if event.event_info.get('malformed'):
+                raise KeyError('user')
+
+    entries = [('1-0', bot.EVENT_TYPE_API_EVENT, {'react': 'fire'}),
+               ('2-0', bot.EVENT_TYPE_API_EVENT, {'react': 'tada', 'malformed': True}),
+               ('3-0', bot.EVENT_TYPE_API_EVENT, {'react': 'eyes'})]
+    ReactingBot().handle_log_entries(entries)
+
+    assert transactions == ['begin', 'rollback to savepoint', 'commit']
+    assert dead_letters == ['2-0']
+    # Quarantined entries are acknowledged along with the ones stored
+    assert acked == ['1-0', '2-0', '3-0']
+    pending = trending.counters(team_id).pending
+    assert sorted(key for kind, key, bucket in pending) == ['eyes', 'fire']
+
+
+def token_bot(monkeypatch, teams):
+    import db
+    import slack_api
+    reads = []
+
+    def get_team(team_id):
+        reads.append(team_id)
+        return teams.get(team_id)
+
+    monkeypatch.setattr(db, 'get_team', get_team)
+    monkeypatch.setattr(bot, 'authed_teams', {})
+    monkeypatch.setattr(slack_api.SlackWebClient, '_request',
+                        lambda self, method, params: ({'ok': self.token != 'xoxb-old', 'error': 'token_revoked'}, None))
+    return bot.Bot(), reads
+
+
+def test_revoked_token_is_reread_and_its_client_replaced(monkeypatch):
+    teams = {'T1': {'team_id': 'T1', 'bot_user_id': 'B1', 'bot_token': 'xoxb-old', 'access_token': 'xoxp-old'}}
+    tokens_bot, reads = token_bot(monkeypatch, teams)
+    client = tokens_bot.bot_client('T1')
+    assert tokens_bot.bot_client('T1') is client
+    assert reads == ['T1']
+
+    # Reinstalled: the old token is revoked and a new one stored
+    teams['T1'] = dict(teams['T1'], bot_token='xoxb-new')
+    assert not client.api_call('chat.postMessage')['ok']
+    assert client.revoked
+
+    replaced = tokens_bot.bot_client('T1')
+    assert replaced.token == 'xoxb-new'
+    assert replaced.api_call('chat.postMessage')['ok']
+    assert reads == ['T1', 'T1']
+
+
+def test_team_tokens_are_reread_once_stale(monkeypatch):
+    teams = {'T1': {'team_id': 'T1', 'bot_user_id': 'B1', 'bot_token': 'xoxb-old', 'access_token': 'xoxp-old'}}
+    tokens_bot, reads = token_bot(monkeypatch, teams)
+    assert tokens_bot.bot_client('T1').token == 'xoxb-old'
+
+    teams['T1'] = dict(teams['T1'], bot_token='xoxb-new')
+    assert tokens_bot.bot_client('T1').token == 'xoxb-old'
+    read_at = bot.authed_teams['T1'][0]
+    monkeypatch.setattr(bot.time, 'time', lambda: read_at + bot.TEAM_TOKENS_MAX_AGE + 1)
+    assert tokens_bot.bot_client('T1').token == 'xoxb-new'
+
+    # Uninstalled teams stop being served from the cache
+    del teams['T1']
+    monkeypatch.setattr(bot.time, 'time', lambda: read_at + 2 * bot.TEAM_TOKENS_MAX_AGE + 2)
+    assert tokens_bot.team_tokens('T1') is None
+    assert 'T1' not in bot.authed_teams
@@ -0,0 +1,37 @@
+import pytest
+
+import bot
+import coalesce
+import db
+import eventlog
+from util import React
+
+
+def test_interrupted_flush_keeps_the_counts_and_acks_nothing(monkeypatch):
+    written = []
+
+    def apply_react_deltas(message_deltas, user_deltas):
+        if not written:
+            written.append(None)
+            raise SystemExit(0)
+        written.append((dict(message_deltas), dict(user_deltas)))
+
+    acked = []
+    monkeypatch.setattr(db, 'apply_react_deltas', apply_react_deltas)
+    monkeypatch.setattr(eventlog, 'ack', acked.extend)
+    monkeypatch.setattr(coalesce, 'buffer', coalesce.ReactBuffer(window=60))
+    coalesce.buffer.add(React('T1', 'C1', '1.0', 'U1', 'fire'), 1)
+    coalesce.buffer.add(React('T1', 'C1', '1.0', 'U2', 'fire'), 1)
+    writer = bot.Bot()
+    writer.held_acks = ['1-0', '2-0']
+
+    # SIGTERM arrives while the deltas are being written
+    with pytest.raises(SystemExit):
+        writer.flush_writes(force=True)
+    assert not coalesce.buffer.is_empty()
+    assert acked == []
+
+    # run_writer's final flush then writes them before acknowledging
+    writer.flush_writes(force=True)
+    assert written[1] == ({('T1', 'C11.0', 'fire'): 2}, {('T1', 'U1', 'fire'): 1, ('T1', 'U2', 'fire'): 1})
+    assert acked == ['1-0', '2-0']
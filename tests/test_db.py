@@ -0,0 +1,168 @@
+import pytest
+
+from util import React
+
+
+def react_counts(team_id):
+    import db
+    return (db.execute('SELECT MessageID, ReactName, Count FROM MessageReacts WHERE TeamID = %s '
+                       'ORDER BY MessageID, ReactName', (team_id, )),
+            db.execute('SELECT UserID, ReactName, Count FROM UserReacts WHERE TeamID = %s '
+                       'ORDER BY UserID, ReactName', (team_id, )))
+
+
+def test_batch_applies_counts_summed_and_drops_a_failed_event(database):
+    import db
+    team_id = database
+    with db.batch():
+        for user_id in ('U1', 'U2', 'U3'):
+            with db.savepoint():
+                db.add_react(React(team_id, 'C1', '1.000100', user_id, 'fire'))
+        with pytest.raises(ValueError):
+            with db.savepoint():
+                db.add_react(React(team_id, 'C1', '1.000100', 'U4', 'tada'))
+                raise ValueError('malformed event')
+        with db.savepoint():
+            db.remove_react(React(team_id, 'C1', '1.000100', 'U3', 'fire'))
+
+    messages, users = react_counts(team_id)
+    assert messages == [('C11.000100', 'fire', 2)]
+    # U3's add and remove cancel out before anything is written
+    assert users == [('U1', 'fire', 1), ('U2', 'fire', 1)]
+    assert db.execute('SELECT count(*) FROM Reactions WHERE TeamID = %s', (team_id, )) == [(2, )]
+
+
+def test_deleting_a_message_drops_counts_queued_for_it(database):
+    import db
+    team_id = database
+    with db.batch():
+        db.add_react(React(team_id, 'C1', '2.000100', 'U1', 'fire'))
+        db.add_react(React(team_id, 'C1', '2.000100', 'U2', 'tada'))
+        db.delete_message(team_id, 'C12.000100')
+
+    messages, users = react_counts(team_id)
+    assert messages == []
+    assert all(count == 0 for _, _, count in users)
+    assert db.execute('SELECT count(*) FROM ReactPairs WHERE TeamID = %s', (team_id, )) == [(0, )]
+
+
+class FakeConnection(object):
+    def __init__(self, dsn, lag_row=(0.0, )):
+        self.dsn = dsn
+        self.lag_row = lag_row
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        pass
+
+    def fetchone(self):
+        return self.lag_row
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def routing(monkeypatch):
+    '''
+    Points db at a fake primary and replica. Yields the replica's settings:
+    reachable, and the lag it reports.
+    '''
+    import db
+    replica = {'reachable': True, 'lag': 0.0, 'connects': 0}
+
+    def connect(dsn):
+        if dsn == 'replica':
+            replica['connects'] += 1
+            if not replica['reachable']:
+                raise IOError('could not connect to replica')
+            return FakeConnection(dsn, (replica['lag'], ))
+        return FakeConnection(dsn)
+
+    monkeypatch.setattr(db, 'DATABASE_URL', 'primary')
+    monkeypatch.setattr(db, 'DATABASE_REPLICA_URL', 'replica')
+    monkeypatch.setattr(db, '_connect', connect)
+    monkeypatch.setattr(db, '_metrics', type(db._metrics)(db._metrics.default_factory))
+    monkeypatch.setattr(db, '_replica_state', {'checked_at': 0.0, 'lag': None})
+    yield replica
+
+
+def connected_to():
+    import db
+
+    @db.psycopg2_read_cur
+    def read(cursor):
+        return cursor.dsn
+
+    return read()
+
+
+def test_reads_go_to_a_replica_within_the_lag_limit(routing):
+    import db
+
+    @db.psycopg2_cur
+    def write(cursor):
+        return cursor.dsn
+
+    assert connected_to() == 'replica'
+    assert write() == 'primary'
+    metrics = db.route_metrics()
+    assert metrics[db.ROUTE_REPLICA]['calls'] == 1
+    assert metrics[db.ROUTE_PRIMARY]['calls'] == 1
+    assert metrics['replica_lag'] == 0.0
+
+
+def test_reads_fall_back_to_the_primary_when_the_replica_lags(routing, monkeypatch):
+    import db
+    routing['lag'] = db.MAX_REPLICA_LAG + 1
+    assert connected_to() == 'primary'
+    # The lag is only re-measured every REPLICA_LAG_CHECK_INTERVAL
+    routing['lag'] = 0.0
+    assert connected_to() == 'primary'
+    assert routing['connects'] == 1
+
+    checked_at = db._replica_state['checked_at']
+    monkeypatch.setattr(db.time, 'time', lambda: checked_at + db.REPLICA_LAG_CHECK_INTERVAL + 1)
+    assert connected_to() == 'replica'
+    assert db.route_metrics()[db.ROUTE_FALLBACK]['calls'] == 2
+
+
+def test_reads_fall_back_to_the_primary_when_the_replica_is_unreachable(routing):
+    import db
+    routing['reachable'] = False
+    assert connected_to() == 'primary'
+    assert db.route_metrics()['replica_lag'] is None
+    lines = db.route_metric_lines()
+    assert lines[0].startswith('replica_fallback: 1 calls, 0 errors, ')
+    assert lines[1:] == ['replica lag: unreachable']
+
+
+def test_replica_connection_failing_after_the_lag_check_falls_back(routing, monkeypatch):
+    import db
+    db.replica_lag()
+    routing['reachable'] = False
+    assert connected_to() == 'primary'
+    assert db.route_metrics()[db.ROUTE_FALLBACK]['calls'] == 1
+
+
+def test_failed_calls_are_counted_as_errors_on_their_route(routing):
+    import db
+
+    @db.psycopg2_read_cur
+    def failing(cursor):
+        raise ValueError('bad query')
+
+    with pytest.raises(ValueError):
+        failing()
+    assert connected_to() == 'replica'
+    metrics = db.route_metrics()[db.ROUTE_REPLICA]
+    assert (metrics['calls'], metrics['errors']) == (2, 1)
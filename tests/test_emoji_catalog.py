@@ -0,0 +1,77 @@
+import json
+
+import emoji_catalog
+
+
+def test_built_in_aliases_resolve_to_their_target():
+    catalog = emoji_catalog.Catalog()
+    assert catalog.resolve('thumbsup') == '+1'
+    assert catalog.resolve('poop') == 'hankey'
+    assert catalog.resolve('shit') == 'hankey'
+    assert catalog.resolve('+1') == '+1'
+    assert emoji_catalog.normalize('T1', ':thumbsup::skin-tone-3:', catalog) == '+1'
+
+
+def test_custom_aliases_chain_into_built_in_ones():
+    catalog = emoji_catalog.Catalog({'yes': 'thumbsup', 'party': None}, synced=True)
+    assert catalog.resolve('yes') == '+1'
+    assert catalog.resolve('party') == 'party'
+
+
+def test_reads_emoji_data_entries(tmp_path, monkeypatch):
+    path = tmp_path / 'emoji.json'
+    path.write_text(json.dumps([{'unified': '1F44D', 'short_names': ['+1', 'thumbsup']},
+                                {'unified': '1F600', 'short_names': ['grinning']}]))
+    monkeypatch.setattr(emoji_catalog, 'STANDARD_ALIASES_FILE', str(path))
+    monkeypatch.setattr(emoji_catalog, '_standard_aliases', None)
+    assert emoji_catalog.standard_aliases() == {'thumbsup': '+1'}
+
+
+class FailingClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append(method)
+        return {'ok': False, 'error': 'missing_scope'}
+
+
+def reacting_bot(monkeypatch, client):
+    import bot
+    import db
+    monkeypatch.setattr(db, 'get_emoji', lambda team_id: (False, {'yes': 'thumbsup'}))
+    monkeypatch.setattr(emoji_catalog, '_catalogs', {})
+    monkeypatch.setattr(emoji_catalog, '_failures', {})
+    reacting = bot.Bot()
+    monkeypatch.setattr(reacting, 'workspace_client', lambda team_id: client)
+    return reacting
+
+
+def test_failed_sync_backs_off_and_normalizes_with_known_aliases(monkeypatch):
+    client = FailingClient()
+    reacting = reacting_bot(monkeypatch, client)
+    names = [reacting.normalize_react('T1', name) for name in ('yes', 'thumbsup', 'fire', 'yes', 'poop')]
+
+    assert names == ['+1', '+1', 'fire', '+1', 'hankey']
+    assert client.calls == ['emoji.list']
+
+    # ...and is tried again once the backoff runs out
+    retry_at, failures = emoji_catalog._failures['T1']
+    monkeypatch.setattr(emoji_catalog.time, 'time', lambda: retry_at + 1)
+    reacting.normalize_react('T1', 'fire')
+    assert client.calls == ['emoji.list', 'emoji.list']
+    assert emoji_catalog._failures['T1'][1] == failures + 1
+
+
+def test_writers_sync_after_the_batch(monkeypatch):
+    import db
+    client = FailingClient()
+    reacting = reacting_bot(monkeypatch, client)
+    monkeypatch.setattr(db, 'in_batch', lambda: True)
+    assert reacting.normalize_react('T1', 'yes') == '+1'
+    assert client.calls == []
+
+    monkeypatch.setattr(db, 'in_batch', lambda: False)
+    reacting.sync_emoji()
+    reacting.sync_emoji()
+    assert client.calls == ['emoji.list']
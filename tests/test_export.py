@@ -0,0 +1,34 @@
+import csv
+import glob
+import gzip
+import os
+
+import export
+from util import Message
+
+
+def exported_ids(out_dir, team_id):
+    ids = []
+    for path in sorted(glob.glob(os.path.join(out_dir, 'messages', 'team=' + team_id, '*', '*.csv.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            ids.extend(row['MessageID'] for row in csv.DictReader(f))
+    return sorted(ids)
+
+
+def test_late_stored_old_message_is_exported(database, tmp_path, monkeypatch):
+    import db
+    team_id = database
+    monkeypatch.setattr(export, 'SETTLE_SECONDS', 0)
+    out_dir = str(tmp_path)
+    db.add_message(Message(team_id, 'C1', '1600000000.000100', 'U1', 'posted on time'))
+    export.export(out_dir, [team_id])
+    assert exported_ids(out_dir, team_id) == ['C11600000000.000100']
+
+    # A replayed event stores a message posted long before the watermark
+    db.add_message(Message(team_id, 'C1', '1500000000.000100', 'U1', 'stored late'))
+    export.export(out_dir, [team_id])
+    assert exported_ids(out_dir, team_id) == ['C11500000000.000100', 'C11600000000.000100']
+
+    # ...and nothing is exported twice
+    export.export(out_dir, [team_id])
+    assert exported_ids(out_dir, team_id) == ['C11500000000.000100', 'C11600000000.000100']
@@ -0,0 +1,52 @@
+from collections import Counter
+
+import analytics
+import db
+import planner
+
+
+def test_cache_holds_raw_counts_and_each_call_translates(monkeypatch):
+    team_id = 'TPLANNER'
+    scans = []
+
+    def scan():
+        scans.append(team_id)
+        return Counter({'<@U1>': 3, 'deploy': 2, '<#C2>': 1})
+
+    def names(users, channels):
+        return lambda words: analytics.translate_words(words, users, channels)
+
+    monkeypatch.setattr(db, 'get_team_stats', lambda team_id: {'messages': 10 ** 6,
+                                                               'text_counts_rebuilt_at': None})
+    planner.clear_cache(team_id)
+
+    # planner.benchmark's call, with no names to apply
+    untranslated = planner.execute(team_id, 'react_buzzword', ('fire', ), 5, 0, scan, finish=names({}, {}))
+    translated = planner.execute(team_id, 'react_buzzword', ('fire', ), 5, 0, scan,
+                                 finish=names({'U1': {'display_name': 'ada'}}, {'C2': 'general'}))
+    planner.clear_cache(team_id)
+
+    # One in-process scan for a large team, then the cache
+    assert scans == [team_id]
+    assert untranslated == {'<@U1>': 3, 'deploy': 2, '<#C2>': 1}
+    assert translated == {'ada': 3, 'deploy': 2, 'general': 1}
+    assert any(line.startswith('react_buzzword via cache: 1 calls') for line in planner.metric_lines())
+
+
+def test_large_teams_scan_in_the_calling_process(monkeypatch):
+    import recompute
+    team_id = 'TLARGE'
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('slash commands must not start a process pool')
+
+    monkeypatch.setattr(recompute, '_run', no_pool)
+    monkeypatch.setattr(db, 'get_team_stats', lambda team_id: {'messages': 10 ** 6,
+                                                               'text_counts_rebuilt_at': None})
+    monkeypatch.setattr(db, 'get_messages_with_react', lambda team_id, react_name, approx: ['C1/1', 'C1/2'])
+    monkeypatch.setattr(db, 'get_message_text_from_ids',
+                        lambda team_id, msgs: {'C1/1': 'deploy staging', 'C1/2': 'deploy'})
+    planner.clear_cache(team_id)
+
+    assert analytics.react_buzzword(team_id, 'fire', {}, {}) == {'deploy': 2, 'staging': 1}
+    planner.clear_cache(team_id)
@@ -0,0 +1,125 @@
+import random
+import threading
+
+from util import React, msg_id_string
+
+
+def pair_counts(team_id):
+    import db
+    rows = db.execute('SELECT ReactA, ReactB, Count FROM ReactPairs WHERE TeamID = %s AND Count > 0',
+                      (team_id, ))
+    return {(a, b): count for a, b, count in rows}
+
+
+def rebuilt_pair_counts(team_id):
+    import db
+    db.rebuild_react_pairs(team_id)
+    return pair_counts(team_id)
+
+
+def test_incremental_pairs_match_rebuild(database):
+    import db
+    team_id = database
+    rng = random.Random(41)
+    reacts = ['fire', 'tada', '+1', 'eyes', 'joy']
+    users = ['U%d' % i for i in range(6)]
+    timestamps = ['%d.000100' % i for i in range(8)]
+    present = set()
+    for _ in range(400):
+        react = React(team_id, 'C1', rng.choice(timestamps), rng.choice(users), rng.choice(reacts))
+        key = (react.msg_id, react.user_id, react.react_name)
+        if key in present and rng.random() < 0.5:
+            db.remove_react(react)
+            present.discard(key)
+        elif key not in present:
+            db.add_react(react)
+            present.add(key)
+    db.delete_message(team_id, msg_id_string('C1', timestamps[0]))
+
+    incremental = pair_counts(team_id)
+    assert incremental
+    assert incremental == rebuilt_pair_counts(team_id)
+
+
+def test_rebuild_counts_from_reactions(database):
+    import db
+    team_id = database
+    msg_id = msg_id_string('C1', '1000.000300')
+    db.add_react(React(team_id, 'C1', '1000.000300', 'U1', 'fire'))
+    db.add_react(React(team_id, 'C1', '1000.000300', 'U2', 'tada'))
+    # Counts in MessageReacts without rows in Reactions, like those of reacts
+    # stored before Reactions existed, don't make pairs
+    db.apply_react_deltas({(team_id, msg_id, 'eyes'): 2, (team_id, 'C1-other', 'fire'): 1,
+                           (team_id, 'C1-other', 'joy'): 1}, {})
+
+    assert rebuilt_pair_counts(team_id) == {('fire', 'tada'): 1}
+
+
+def test_concurrent_reacts_count_each_pair_once(database):
+    import db
+    team_id = database
+    # Every user adds a different react to the same new message at once
+    reacts = ['r%d' % i for i in range(8)]
+    barrier = threading.Barrier(len(reacts))
+
+    def add(i):
+        barrier.wait()
+        db.record_reaction(React(team_id, 'C1', '1000.000200', 'U%d' % i, reacts[i]))
+
+    threads = [threading.Thread(target=add, args=(i, )) for i in range(len(reacts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = {(a, b): 1 for a in reacts for b in reacts if a < b}
+    assert pair_counts(team_id) == expected
+
+    # ...and then all take them off again
+    barrier = threading.Barrier(len(reacts))
+
+    def remove(i):
+        barrier.wait()
+        db.remove_reaction(React(team_id, 'C1', '1000.000200', 'U%d' % i, reacts[i]))
+
+    threads = [threading.Thread(target=remove, args=(i, )) for i in range(len(reacts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert pair_counts(team_id) == {}
+
+
+def test_batches_touching_the_same_messages_in_opposite_orders(database):
+    import db
+    team_id = database
+    timestamps = ['2000.000%d00' % i for i in range(4)]
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def writer(i):
+        # Each batch reacts to the messages in the other's reverse order
+        order = timestamps if i == 0 else timestamps[::-1]
+        try:
+            with db.batch():
+                for ts in order:
+                    db.record_reaction(React(team_id, 'C1', ts, 'U%d' % i, 'r%d' % i))
+                    db.add_react(React(team_id, 'C1', ts, 'U%d' % i, 'shared'))
+                # Both hold their Reactions rows until the other has written too
+                barrier.wait(timeout=30)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(i, )) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    expected = {('r0', 'r1'): 4, ('r0', 'shared'): 4, ('r1', 'shared'): 4}
+    assert pair_counts(team_id) == expected
+    assert rebuilt_pair_counts(team_id) == expected
+    assert db.execute('SELECT DISTINCT Count FROM MessageReacts WHERE TeamID = %s AND ReactName = %s',
+                      (team_id, 'shared')) == [(2, )]
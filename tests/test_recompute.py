@@ -0,0 +1,35 @@
+import analytics
+import planner
+from util import Message, React
+
+
+def ranking(result):
+    return list(result.items())
+
+
+def test_sharded_counts_rank_ties_like_one_shard(database):
+    import db
+    team_id = database
+    # Every phrase and most words are used equally often, spread over the
+    # whole MessageID range so each shard sees some of every tie
+    texts = ['ship the %s release today' % name for name in ('alpha', 'beta', 'gamma', 'delta')]
+    texts += ['review the %s branch again' % name for name in ('alpha', 'beta', 'gamma', 'delta')]
+    for i in range(60):
+        db.add_message(Message(team_id, 'C1', '%d.000100' % (1000 + i), 'U1', texts[i % len(texts)]))
+        if i % 3 == 0:
+            db.add_react(React(team_id, 'C1', '%d.000100' % (1000 + i), 'U2', 'fire'))
+
+    def phrases(shards):
+        return ranking(analytics.get_common_phrases(team_id, count=50, shards=shards, strategy=planner.SCAN))
+
+    def words(shards, offset=0):
+        return ranking(analytics.react_buzzword(team_id, 'fire', {}, {}, count=5, shards=shards,
+                                                offset=offset, strategy=planner.SCAN))
+
+    serial = phrases(None)
+    assert len(set(uses for _, uses in serial)) < len(serial)
+    for shards in (1, 3, 7):
+        assert phrases(shards) == serial
+        # Paging through ties lands on the same words
+        assert words(shards) == words(None)
+        assert words(shards, offset=5) == words(None, offset=5)
@@ -0,0 +1,169 @@
+import json
+import math
+import pickle
+import random
+from collections import Counter
+
+import analytics
+import sketch
+
+WORDS = ['react%d' % i for i in range(400)]
+
+
+def corpus(seed, events=20000):
+    ''' A fixed, heavily skewed stream of keys like real react and phrase usage '''
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) ** 1.1 for rank in range(len(WORDS))]
+    return rng.choices(WORDS, weights, k=events)
+
+
+def check_space_saving(summary, exact, k=20):
+    bound = summary.error_bound()
+    assert bound <= math.ceil(sum(exact.values()) / float(summary.capacity))
+    top = summary.top(k)
+    for key, count, error in top:
+        # Never undercounts, and overcounts by at most the reported error
+        assert count - error <= exact[key] <= count
+        assert error <= bound
+    # Everything heavier than the bound is tracked
+    tracked = set(summary.counts)
+    assert all(key in tracked for key, count in exact.items() if count > bound)
+    # ...so the true top k is reported in order, up to ties within the error
+    reported = [key for key, _, _ in top]
+    for key, count in exact.most_common(k):
+        if count > top[-1][1]:
+            assert key in reported
+
+
+def check_count_min(counts, exact):
+    bound = counts.error_bound()
+    within = 0
+    for key in WORDS:
+        estimate = counts.estimate(key)
+        assert estimate >= exact[key]
+        within += estimate - exact[key] <= bound
+    # Each estimate is within the bound with probability 1 - e^-depth
+    assert within >= (1 - math.exp(-counts.depth)) * len(WORDS)
+
+
+def check_hyperloglog(distinct, exact_distinct):
+    assert abs(distinct.count() - exact_distinct) <= 3 * distinct.relative_error() * exact_distinct
+
+
+def test_sketches_match_exact_counts():
+    stream = corpus(29)
+    exact = Counter(stream)
+    summary = sketch.SpaceSaving(100)
+    counts = sketch.CountMinSketch(width=256, depth=4)
+    distinct = sketch.HyperLogLog()
+    for key in stream:
+        summary.add(key)
+        counts.add(key)
+        distinct.add(key)
+
+    check_space_saving(summary, exact)
+    check_count_min(counts, exact)
+    check_hyperloglog(distinct, len(exact))
+
+
+def test_merged_deltas_keep_the_bounds():
+    # A stored sketch plus deltas checkpointed by two writers
+    streams = [corpus(seed, 8000) for seed in (1, 2, 3)]
+    exact = Counter()
+    merged = None
+    for stream in streams:
+        exact.update(stream)
+        parts = {'summary': sketch.SpaceSaving(100),
+                 'counts': sketch.CountMinSketch(width=256, depth=4),
+                 'distinct': sketch.HyperLogLog()}
+        for key in stream:
+            parts['summary'].add(key)
+            parts['counts'].add(key)
+            parts['distinct'].add(key)
+        delta = {name: sketch.dumps(part) for name, part in parts.items()}
+        if merged is None:
+            merged = delta
+        else:
+            merged = {name: sketch.merge_part(merged[name], delta[name]) for name in merged}
+
+    summary = sketch.loads(merged['summary'])
+    assert summary.total == sum(exact.values())
+    check_space_saving(summary, exact)
+    check_count_min(sketch.loads(merged['counts']), exact)
+    check_hyperloglog(sketch.loads(merged['distinct']), len(exact))
+
+    # Still usable as a stream summary after a round trip
+    summary.add('react0', 5)
+    assert summary.counts['react0'] >= exact['react0'] + 5
+
+
+def test_phrase_sketch_matches_common_phrases():
+    rng = random.Random(7)
+    vocabulary = ['ship', 'it', 'today', 'looks', 'good', 'to', 'me', 'on', 'call', 'again']
+    texts = [' '.join(rng.choice(vocabulary[:rng.randint(3, len(vocabulary))])
+                      for _ in range(rng.randint(3, 12))) for _ in range(3000)]
+
+    exact = Counter()
+    team = sketch.TeamSketches()
+    # Far fewer counters than distinct phrases
+    team.phrases = sketch.SpaceSaving(50)
+    for text in texts:
+        phrases = analytics.message_phrases(text)
+        exact.update(phrases)
+        team.add_message_phrases(phrases)
+
+    check_space_saving(team.phrases, exact, k=10)
+
+
+def test_writer_deltas_round_trip_through_parts():
+    sketch.staged.stage()
+    sketch.observe('TDELTA', sketch.TeamSketches.add_react, 'U1', 'fire')
+    mark = sketch.staged.mark()
+    # Rolled back with its event
+    sketch.observe('TDELTA', sketch.TeamSketches.add_react, 'U2', 'tada')
+    sketch.staged.discard_staged(mark)
+    sketch.observe('TDELTA', sketch.TeamSketches.add_react_words, 'fire', {'ship', 'it'})
+    sketch.staged.commit_staged()
+
+    delta = sketch._pending.pop('TDELTA')
+    stored = sketch.TeamSketches()
+    stored.add_react('U1', 'fire', 4)
+    stored.merge(delta)
+    parts = {name: sketch.loads(sketch.dumps(part)) for name, part in stored.parts().items()}
+    loaded = sketch.TeamSketches.from_parts(parts, stored.built_at)
+
+    assert loaded.react_counts.estimate('fire') == 5
+    assert loaded.react_counts.estimate('tada') == 0
+    assert loaded.reactors.top(5) == [('U1', 5, 0)]
+    assert sorted(key for key, _, _ in loaded.react_words['fire'].top(5)) == ['it', 'ship']
+
+
+def test_parts_are_stored_as_json_of_their_counters():
+    team = sketch.TeamSketches()
+    team.add_message_phrases([('ship', 'it', 'today'), ('ship', 'it', 'today'), ('looks', 'good', 'to')])
+    team.add_react('U1', 'fire', 3)
+    data = sketch.dumps(team.phrases)
+    assert json.loads(data.decode('utf-8'))['type'] == 'SpaceSaving'
+
+    phrases = sketch.loads(data)
+    assert phrases.top(1) == [(('ship', 'it', 'today'), 2, 0)]
+    assert sketch.loads(sketch.dumps(team.distinct_reacts)).count() == 1
+    assert sketch.loads(sketch.dumps(team.react_counts)).estimate('fire') == 3
+
+
+def test_pickled_parts_are_rebuilt_not_unpickled(monkeypatch):
+    import db
+
+    class Unpickled(object):
+        def __reduce__(self):
+            return (exec, ('raise AssertionError("unpickled")', ))
+
+    pickled = pickle.dumps(Unpickled())
+    delta = sketch.dumps(sketch.SpaceSaving(10))
+    assert sketch.merge_part(pickled, delta) == pickled
+
+    stored = sketch.TeamSketches()
+    parts = {name: sketch.dumps(part) for name, part in stored.parts().items()}
+    parts['reactors'] = pickled
+    monkeypatch.setattr(db, 'get_sketch_parts', lambda team_id: (stored.built_at, parts))
+    assert sketch.load('TPICKLED') is None
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+pytest.importorskip('requests')
+
+import slack_api
+
+
+class StubSlack(object):
+    '''
+    Local Web API stub. Each method answers with its queued responses in
+    order, then keeps repeating the last one.
+    '''
+
+    def __init__(self):
+        self.responses = {}
+        self.calls = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+                method = self.path.rstrip('/').split('/')[-1]
+                stub.calls.append((method, params))
+                queued = stub.responses.get(method) or [(200, {}, {'ok': True})]
+                status, headers, payload = queued.pop(0) if len(queued) > 1 else queued[0]
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def queue(self, method, *responses):
+        self.responses[method] = list(responses)
+
+    def methods(self):
+        return [method for method, params in self.calls]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    slept = []
+    monkeypatch.setattr(slack_api, 'rate_limiter', slack_api.RateLimiter())
+    monkeypatch.setattr(slack_api.time, 'sleep', slept.append)
+    server = StubSlack()
+    server.slept = slept
+    yield server
+    server.close()
+
+
+def test_retries_after_429_for_the_retry_after_window(stub):
+    stub.queue('users.info',
+               (429, {'Retry-After': '7'}, {'ok': False, 'error': 'ratelimited'}),
+               (200, {}, {'ok': True, 'user': {'id': 'U1'}}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+
+    resp = client.api_call('users.info', user='U1')
+
+    assert resp['user']['id'] == 'U1'
+    assert stub.methods() == ['users.info', 'users.info']
+    assert len(stub.slept) == 1 and 6 < stub.slept[0] <= 7
+    # Other callers of the same method wait out the window too
+    assert slack_api.rate_limiter.delay('users.info') > 0
+    assert slack_api.rate_limiter.delay('chat.postMessage') == 0
+
+
+def test_gives_up_when_still_rate_limited(stub):
+    stub.queue('users.info', (429, {'Retry-After': '1'}, {'ok': False}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+
+    resp = client.api_call('users.info', user='U1')
+
+    assert resp['error'] == 'ratelimited'
+    assert len(stub.calls) == slack_api.MAX_RETRIES + 1
+
+
+def test_dm_channel_is_opened_once_per_user(stub):
+    stub.queue('im.open', (200, {}, {'ok': True, 'channel': {'id': 'D1'}}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+
+    client.post_dm('U1', 'first')
+    client.post_dm('U1', 'second')
+
+    assert stub.methods() == ['im.open', 'chat.postMessage', 'chat.postMessage']
+    assert [params['channel'] for method, params in stub.calls[1:]] == ['D1', 'D1']
+    assert stub.calls[1][1]['token'] == 'xoxb-test'
+
+
+def test_stale_dm_channel_is_reopened_and_retried(stub):
+    stub.queue('im.open',
+               (200, {}, {'ok': True, 'channel': {'id': 'D1'}}),
+               (200, {}, {'ok': True, 'channel': {'id': 'D2'}}))
+    stub.queue('chat.postMessage',
+               (200, {}, {'ok': True}),
+               (200, {}, {'ok': False, 'error': 'channel_not_found'}),
+               (200, {}, {'ok': True}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+    client.post_dm('U1', 'first')
+
+    resp = client.post_dm('U1', 'second')
+
+    assert resp['ok']
+    assert stub.methods() == ['im.open', 'chat.postMessage', 'chat.postMessage',
+                              'im.open', 'chat.postMessage']
+    assert stub.calls[-1][1]['channel'] == 'D2'
+    assert client.dm_channels == {'U1': 'D2'}
+
+
+def test_paginate_follows_cursors_until_the_last_page(stub):
+    stub.queue('users.list',
+               (200, {}, {'ok': True, 'members': [{'id': 'U1'}], 'response_metadata': {'next_cursor': 'c2'}}),
+               (200, {}, {'ok': True, 'members': [{'id': 'U2'}], 'response_metadata': {'next_cursor': ''}}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+
+    pages = list(client.paginate('users.list'))
+
+    assert [member['id'] for page in pages for member in page['members']] == ['U1', 'U2']
+    assert 'cursor' not in stub.calls[0][1]
+    assert stub.calls[1][1]['cursor'] == 'c2'
+    assert stub.calls[0][1]['limit'] == str(slack_api.PAGE_LIMIT)
+
+
+def test_paginate_stops_on_a_failed_page(stub):
+    stub.queue('users.list', (200, {}, {'ok': False, 'error': 'invalid_cursor',
+                                        'response_metadata': {'next_cursor': 'c2'}}))
+    client = slack_api.SlackWebClient('xoxb-test', stub.url)
+
+    pages = list(client.paginate('users.list'))
+
+    assert [page['error'] for page in pages] == ['invalid_cursor']
+    assert len(stub.calls) == 1
+
+
+def test_async_client_runs_a_batch_of_calls(stub):
+    stub.queue('im.open', (200, {}, {'ok': True, 'channel': {'id': 'D1'}}))
+    client = slack_api.AsyncSlackWebClient('xoxb-test', stub.url, concurrency=2)
+
+    async def run():
+        responses = await client.api_call_many([('users.info', {'user': 'U%d' % i}) for i in range(3)])
+        await client.post_dm('U1', 'hi')
+        return responses
+
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(run())
+    finally:
+        loop.close()
+        client.close()
+
+    assert [resp['ok'] for resp in responses] == [True, True, True]
+    assert sorted(params['user'] for method, params in stub.calls if method == 'users.info') == ['U0', 'U1', 'U2']
+    assert client.client.dm_channels == {'U1': 'D1'}
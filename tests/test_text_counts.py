@@ -0,0 +1,62 @@
+import threading
+import time
+
+import analytics
+from util import Message
+
+
+def text_counts(team_id):
+    import db
+    words = db.execute('SELECT Word, Count FROM WordCounts WHERE TeamID = %s AND Count <> 0', (team_id, ))
+    phrases = db.execute('SELECT Phrase, Count FROM PhraseCounts WHERE TeamID = %s AND Count <> 0', (team_id, ))
+    return dict(words), dict(phrases)
+
+
+def test_posts_edits_and_deletes_match_a_rebuild(database):
+    import db
+    import recompute
+    team_id = database
+    texts = ['ship the release today before lunch', 'the release looks good to me',
+             'ship it ship it now', 'review the release branch today', 'lunch is at noon today']
+    for i, text in enumerate(texts * 3):
+        db.add_message(Message(team_id, 'C1', '%d.000100' % (3000 + i), 'U%d' % (i % 4), text),
+                       analytics.text_counts)
+    with db.batch():
+        for i in range(0, 15, 4):
+            db.edit_message(Message(team_id, 'C1', '%d.000100' % (3000 + i), 'U1', 'edited ' + texts[(i + 1) % 5]),
+                            analytics.text_counts)
+        # An edit of a message never seen posted stores it
+        db.edit_message(Message(team_id, 'C2', '3100.000100', 'U2', 'ship the release branch'),
+                        analytics.text_counts)
+        for i in range(1, 15, 5):
+            db.delete_message(team_id, 'C1%d.000100' % (3000 + i), analytics.text_counts)
+    db.delete_message(team_id, 'C1never.stored', analytics.text_counts)
+
+    incremental = text_counts(team_id)
+    assert incremental[0] and incremental[1]
+    recompute.rebuild_aggregates(team_id, shards=2, max_workers=2, progress=None)
+    assert text_counts(team_id) == incremental
+
+
+def test_message_stored_by_two_writers_at_once_counts_once(database):
+    import db
+    team_id = database
+    msg = Message(team_id, 'C1', '4000.000100', 'U1', 'ship the release today')
+    stored = threading.Event()
+
+    def first_writer():
+        with db.batch():
+            db.add_message(msg, analytics.text_counts)
+            stored.set()
+            # Still uncommitted while the second writer tries to store it
+            time.sleep(0.5)
+
+    first = threading.Thread(target=first_writer)
+    first.start()
+    stored.wait(timeout=30)
+    db.add_message(msg, analytics.text_counts)
+    first.join()
+
+    assert db.execute('SELECT count(*) FROM Messages WHERE TeamID = %s', (team_id, )) == [(1, )]
+    words, _ = text_counts(team_id)
+    assert set(words.values()) == {1}
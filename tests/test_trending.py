@@ -0,0 +1,72 @@
+import trending
+
+
+def window_count(team_id, kind, key, bucket):
+    return trending.counters(team_id).pending.get((kind, key, bucket), 0)
+
+
+def test_observations_only_count_once_the_batch_commits():
+    team_id = 'TSTAGED'
+    ts = 1500000000.0
+    bucket = trending.bucket_of(ts)
+
+    trending.staged.stage()
+    trending.observe_react(team_id, 'fire', ts)
+    mark = trending.staged.mark()
+    # An event rolled back to its savepoint and dead-lettered
+    trending.observe_react(team_id, 'fire', ts)
+    trending.observe_phrases(team_id, [('hello', 'there')], ts)
+    trending.staged.discard_staged(mark)
+    assert window_count(team_id, trending.KIND_REACT, 'fire', bucket) == 0
+    trending.staged.commit_staged()
+
+    assert window_count(team_id, trending.KIND_REACT, 'fire', bucket) == 1
+    assert window_count(team_id, trending.KIND_PHRASE, 'hello there', bucket) == 0
+
+
+def test_aborted_batch_counts_nothing():
+    team_id = 'TABORTED'
+    ts = 1500000000.0
+
+    trending.staged.stage()
+    trending.observe_react(team_id, 'tada', ts)
+    trending.staged.discard_staged()
+    # Redelivered and stored by the next batch
+    trending.staged.stage()
+    trending.observe_react(team_id, 'tada', ts)
+    trending.staged.commit_staged()
+
+    assert window_count(team_id, trending.KIND_REACT, 'tada', trending.bucket_of(ts)) == 1
+
+
+def test_writers_only_keep_counts_until_checkpointed(monkeypatch):
+    import db
+
+    team_id = 'TWRITER'
+    ts = 1500000000.0
+    bucket = trending.bucket_of(ts)
+    checkpointed = []
+    monkeypatch.setattr(db, 'add_trend_counts', lambda team, pending, oldest: checkpointed.append(pending))
+
+    trending.staged.stage()
+    trending.observe_phrases(team_id, [('hello', 'there'), ('hello', 'there')], ts)
+    trending.staged.commit_staged()
+    trending.checkpoint()
+
+    assert {(trending.KIND_PHRASE, 'hello there', bucket): 2} in checkpointed
+    team_counters = trending.counters(team_id)
+    assert team_counters.pending == {}
+    assert team_counters.rings == {trending.KIND_REACT: {}, trending.KIND_PHRASE: {}}
+
+
+def test_load_builds_rings_from_checkpointed_counts(monkeypatch):
+    import db
+
+    now = trending.bucket_of()
+    rows = [(trending.KIND_REACT, 'fire', now, 5), (trending.KIND_REACT, 'fire', now - 30, 1)]
+    monkeypatch.setattr(db, 'get_trend_counts', lambda *args: rows)
+
+    loaded = trending.load('TLOAD')
+    assert loaded.pending == {}
+    assert loaded.rings[trending.KIND_REACT]['fire'].window(now, 1) == 5
+    assert loaded.rank(trending.HOUR, now)[trending.KIND_REACT][0][:2] == ('fire', 5)
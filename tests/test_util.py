@@ -0,0 +1,26 @@
+from util import chunk_blocks, BLOCK_TEXT_LIMIT, BLOCKS_PER_MESSAGE
+
+
+def block_texts(messages):
+    return [block['text']['text'] for blocks in messages for block in blocks]
+
+
+def test_long_line_never_overflows_a_message():
+    # 49 full blocks queued, then a line long enough to add two more at once
+    lines = ['x' * (BLOCK_TEXT_LIMIT - 1)] * 49 + ['y' * 10, 'z' * (2 * BLOCK_TEXT_LIMIT + 5)]
+    messages = list(chunk_blocks(lines))
+    assert all(len(blocks) <= BLOCKS_PER_MESSAGE for blocks in messages)
+    assert all(0 < len(text) <= BLOCK_TEXT_LIMIT for text in block_texts(messages))
+    assert ''.join(block_texts(messages)[-3:]) == 'z' * (2 * BLOCK_TEXT_LIMIT + 5)
+
+
+def test_lines_are_kept_in_order_and_whole():
+    lines = ['line %d' % i for i in range(2000)]
+    messages = list(chunk_blocks(lines))
+    assert all(len(blocks) <= BLOCKS_PER_MESSAGE for blocks in messages)
+    assert '\n'.join(block_texts(messages)).split('\n') == lines
+
+
+def test_split_line_leaves_no_empty_block():
+    messages = list(chunk_blocks(['a' * (2 * BLOCK_TEXT_LIMIT), 'b']))
+    assert block_texts(messages) == ['a' * BLOCK_TEXT_LIMIT, 'a' * BLOCK_TEXT_LIMIT, 'b']